@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Agent 步进引擎：用显式循环代替 chat() 的递归
+1. 每个请求有步数上限、墙钟截止时间和 token 预算，任意一个用尽就提前结束
+2. 记录每一步（模型调用 / 工具调用）的耗时和 token 消耗
+3. 模型与工具都以回调注入，可以用 ScriptedModel 离线测试（python agent_engine.py）
+4. 可传入 CancelToken：取消时正在进行的模型调用、工具调用会被立即取消（关闭流式连接、通知MCP服务端），
+   以 stop_reason="cancelled" 结束
+"""
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+# 默认预算
+DEFAULT_MAX_STEPS = 6
+DEFAULT_DEADLINE_SECONDS = 110.0
+DEFAULT_TOKEN_BUDGET = 30000
+
+STOP_MESSAGES = {
+    "max_steps": "已达到单次请求的最大步数，以下为目前的结果。",
+    "deadline": "请求处理超时，已提前结束。",
+    "token_budget": "本次请求消耗的token已超出预算，已提前结束。",
+    "stopped": "请求已被终止。",
+    "cancelled": "请求已取消。",
+}
+
+
+class RequestCancelled(Exception):
+    """请求被取消（用户发出了新消息或关闭了气泡）"""
+
+
+class CancelToken:
+    """
+    一个请求的取消令牌，由事件循环所在线程调用 cancel()
+    run(coro) 运行协程，令牌被取消时取消该协程（取消会沿 await 链传递到模型的流式连接和MCP调用），并抛出 RequestCancelled
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self.reason = ""
+        self._tasks = set()
+
+    def cancel(self, reason=""):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        self.reason = reason
+        for task in list(self._tasks):
+            task.cancel()
+
+    def check(self):
+        if self.cancelled:
+            raise RequestCancelled(self.reason)
+
+    async def run(self, coro):
+        if self.cancelled:
+            coro.close()
+            raise RequestCancelled(self.reason)
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if self.cancelled and task.cancelled():
+                raise RequestCancelled(self.reason) from None
+            raise
+        finally:
+            self._tasks.discard(task)
+
+
+def estimate_tokens(messages):
+    """没有usage信息时粗略估算token数（中文约1字1token，英文约4字符1token）"""
+    text = json.dumps(messages, ensure_ascii=False, default=str)
+    return len(text) // 2
+
+
+class AgentResult:
+    """一次请求的执行结果，content 与模型返回的 message 一样可以直接取用"""
+
+    def __init__(self, content, stop_reason, steps, tokens_used, elapsed):
+        self.role = "assistant"
+        self.content = content
+        self.stop_reason = stop_reason  # completed / max_steps / deadline / token_budget / stopped
+        self.steps = steps
+        self.tokens_used = tokens_used
+        self.elapsed = elapsed
+
+    def summary(self):
+        parts = [f"{step['kind']}#{step['step']}={step['elapsed_ms']:.0f}ms" for step in self.steps]
+        return (f"结束原因={self.stop_reason} 步数={len({s['step'] for s in self.steps})} "
+                f"token={self.tokens_used} 总耗时={self.elapsed * 1000:.0f}ms [{', '.join(parts)}]")
+
+
+class AgentEngine:
+    """
+    complete(messages, on_delta, use_tools) -> 具有 message(content, tool_calls) 和 usage 的结果
+    run_tools(tool_calls) -> 与 tool_calls 一一对应的结果文本列表
+    """
+
+    def __init__(self, complete, run_tools, max_steps=DEFAULT_MAX_STEPS,
+                 deadline_seconds=DEFAULT_DEADLINE_SECONDS, token_budget=DEFAULT_TOKEN_BUDGET):
+        self.complete = complete
+        self.run_tools = run_tools
+        self.max_steps = max_steps
+        self.deadline_seconds = deadline_seconds
+        self.token_budget = token_budget
+
+    async def run(self, messages, on_delta=None, should_stop=None, cancel_token=None):
+        """
+        执行 模型 -> 工具 -> 模型 ... 的循环，直到模型不再调用工具或预算用尽
+        should_stop: 可选的无参回调，返回True时在下一步开始前提前结束
+        cancel_token: 可选的 CancelToken，取消时立即中断当前的模型或工具调用
+        """
+        start = time.perf_counter()
+        deadline = start + self.deadline_seconds
+        steps = []
+        tokens_used = 0
+        last_content = ""
+
+        def finish(reason, content=None):
+            if content is None:
+                content = (last_content + "\n\n" if last_content else "") + STOP_MESSAGES[reason]
+            return AgentResult(content, reason, steps, tokens_used, time.perf_counter() - start)
+
+        def guarded(coro):
+            return cancel_token.run(coro) if cancel_token is not None else coro
+
+        for step in range(1, self.max_steps + 1):
+            if cancel_token is not None and cancel_token.cancelled:
+                return finish("cancelled")
+            if should_stop and should_stop():
+                return finish("stopped")
+            if tokens_used >= self.token_budget:
+                return finish("token_budget")
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return finish("deadline")
+
+            # 最后一步不再提供工具，强制模型根据已有结果作答
+            use_tools = step < self.max_steps
+            step_start = time.perf_counter()
+            streamed = []
+
+            async def step_on_delta(text):
+                streamed.append(text)
+                if on_delta:
+                    await on_delta(text)
+
+            try:
+                response = await asyncio.wait_for(guarded(self.complete(messages, step_on_delta, use_tools)),
+                                                  timeout=remaining)
+            except asyncio.TimeoutError:
+                # 已经推送给悬浮球的文本保留在结果里，超时说明附在后面，而不是把它替换掉
+                last_content = "".join(streamed) or last_content
+                return finish("deadline")
+            except RequestCancelled:
+                return finish("cancelled")
+            step_tokens = response.usage.total_tokens if getattr(response, "usage", None) else estimate_tokens(messages)
+            tokens_used += step_tokens
+            steps.append({"step": step, "kind": "llm", "tokens": step_tokens,
+                          "elapsed_ms": (time.perf_counter() - step_start) * 1000})
+
+            message = response.message
+            last_content = message.content or last_content
+            if not message.tool_calls:
+                return finish("completed" if use_tools else "max_steps", message.content or "")
+
+            for index, tool_call in enumerate(message.tool_calls):
+                if not tool_call.id:
+                    tool_call.id = f"call_{step}_{index}"
+            messages.append({
+                'role': 'assistant',
+                'content': message.content or "",
+                'tool_calls': [
+                    {
+                        'id': tool_call.id,
+                        'type': 'function',
+                        'function': {'name': tool_call.function.name, 'arguments': tool_call.function.arguments}
+                    }
+                    for tool_call in message.tool_calls
+                ]
+            })
+
+            if cancel_token is not None and cancel_token.cancelled:
+                return finish("cancelled")
+            if should_stop and should_stop():
+                return finish("stopped")
+            tools_start = time.perf_counter()
+            try:
+                results = await asyncio.wait_for(guarded(self.run_tools(message.tool_calls)),
+                                                 timeout=max(deadline - time.perf_counter(), 0.001))
+            except asyncio.TimeoutError:
+                return finish("deadline")
+            except RequestCancelled:
+                return finish("cancelled")
+            steps.append({"step": step, "kind": "tools", "tokens": 0,
+                          "tools": [tool_call.function.name for tool_call in message.tool_calls],
+                          "elapsed_ms": (time.perf_counter() - tools_start) * 1000})
+            for tool_call, result in zip(message.tool_calls, results):
+                messages.append({
+                    'role': 'tool',
+                    'tool_call_id': tool_call.id,
+                    'content': result
+                })
+
+        return finish("max_steps")
+
+
+def make_tool_call(name, arguments=None, call_id=""):
+    """构造与流式拼装结果同构的工具调用对象"""
+    return SimpleNamespace(
+        id=call_id,
+        type="function",
+        function=SimpleNamespace(name=name, arguments=json.dumps(arguments or {}, ensure_ascii=False))
+    )
+
+
+class ScriptedModel:
+    """
+    按预定脚本回复的假模型，用于离线测试
+    script 中每一项为一轮回复：字符串表示最终文本，列表表示一组工具调用 [(工具名, 参数), ...]
+    """
+
+    def __init__(self, script, latency=0.0, tokens_per_call=100):
+        self.script = list(script)
+        self.latency = latency
+        self.tokens_per_call = tokens_per_call
+        self.calls = 0
+
+    async def complete(self, messages, on_delta=None, use_tools=True):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        turn = self.script.pop(0) if self.script else "（脚本已结束）"
+        usage = SimpleNamespace(total_tokens=self.tokens_per_call)
+        if isinstance(turn, str) or not use_tools:
+            text = turn if isinstance(turn, str) else "根据已有结果作答。"
+            if on_delta:
+                await on_delta(text)
+            return SimpleNamespace(message=SimpleNamespace(content=text, tool_calls=None), usage=usage)
+        tool_calls = [make_tool_call(name, arguments) for name, arguments in turn]
+        return SimpleNamespace(message=SimpleNamespace(content="", tool_calls=tool_calls), usage=usage)
+
+
+if __name__ == '__main__':
+    async def fake_tools(tool_calls):
+        await asyncio.sleep(0.01)
+        return [f"{tool_call.function.name} 执行完成" for tool_call in tool_calls]
+
+    async def demo(label, script, **budget):
+        model = ScriptedModel(script, latency=0.02)
+        engine = AgentEngine(model.complete, fake_tools, **budget)
+        result = await engine.run([{"role": "user", "content": "搜索X并告诉我天气"}])
+        print(f"[{label}] 模型调用{model.calls}次 {result.summary()}")
+        print(f"    回复: {result.content}")
+
+    async def main():
+        await demo("一轮并发工具", [[("search_chat", {"content": "X"}), ("fetch_current_weather_for_city", {})],
+                                 "X的搜索结果如下，今天晴。"])
+        await demo("步数上限", [[("search_chat", {"content": str(i)})] for i in range(10)], max_steps=3)
+        await demo("token预算", [[("search_chat", {"content": str(i)})] for i in range(10)], token_budget=250)
+        await demo("截止时间", [[("search_chat", {"content": str(i)})] for i in range(10)], deadline_seconds=0.05)
+
+        # 取消：模型调用进行到一半时取消，引擎应立即返回而不是等模型回复完
+        model = ScriptedModel([[("search_chat", {"content": "X"})], "不会用到的回复"], latency=1.0)
+        token = CancelToken()
+        asyncio.get_running_loop().call_later(0.1, token.cancel, "用户发出了新消息")
+        start = time.perf_counter()
+        result = await AgentEngine(model.complete, fake_tools).run([{"role": "user", "content": "X"}],
+                                                                    cancel_token=token)
+        print(f"[取消] {(time.perf_counter() - start) * 1000:.0f}ms 后返回（模型单次耗时1000ms） {result.summary()}")
+
+    asyncio.run(main())
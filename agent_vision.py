@@ -1,25 +1,21 @@
-from openai import OpenAI
-import os
-import base64
 from dotenv import load_dotenv
-import random
 from write_file import write_and_open_txt
+from image_preprocess import prepare_image
+from resilient_llm import llm_caller
+from llm_clients import get_client
 
 load_dotenv()  # 默认会加载根目录下的.env文件
 
-#  base 64 编码格式
+#  base 64 编码格式（先缩小并重新编码，见 image_preprocess.py）
 def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+    return prepare_image(image_path).data_url()
 
 def get_image_response(user_content, path="imgs/test.png"):
     try:
-        base64_image = encode_image(path)
-        client = OpenAI(
-            api_key=os.getenv("ALIBABA_CLOUD_ACCESS_KEY_ID"),
-            base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-        )
-        completion = client.chat.completions.create(
+        image_url = encode_image(path)
+        # 共享的客户端和连接池（llm_clients），不再每次调用都重新建立连接和TLS握手
+        client = get_client()
+        completion = llm_caller.call(lambda timeout: client.chat.completions.create(
             model="qwen-vl-plus",
             messages=[
                 {
@@ -32,7 +28,7 @@ def get_image_response(user_content, path="imgs/test.png"):
                     {
                       "type": "image_url",
                       "image_url": {
-                        "url": f"data:image/jpeg;base64,{base64_image}"
+                        "url": image_url
                       }
                     }
                   ]
@@ -40,7 +36,8 @@ def get_image_response(user_content, path="imgs/test.png"):
               ],
               # stream=True,
               # stream_options={"include_usage":True}
-            )
+              timeout=timeout,
+            ), key="qwen-vl-plus")
         # 提取content内容
         content = completion.choices[0].message.content
         print(content)
@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+请求的环境信息（活跃窗口、当前文件路径）提供者
+1. 后台线程定时采样前台窗口（廉价的 win32gui + psutil 调用），只有窗口变化时才通过 COM/PowerShell
+   重新解析文件路径，这些慢调用不再出现在请求路径上，空闲时也不会反复启动
+2. snapshot() 直接返回缓存的最近一次快照，不阻塞；快照超过 max_age 时唤醒采样线程重新解析路径
+   （例如资源管理器在同一个窗口里切换了目录），下一次请求拿到新的
+3. 前台是本进程的窗口（悬浮球、截图框）时不更新快照，保留用户之前操作的窗口，
+   不必再像原来那样先等0.5秒让焦点回到原窗口
+4. 非Windows环境（以及测试）使用 StubContextSource，可以设定窗口和模拟慢调用的延迟
+5. python context_provider.py 会对比原来每条消息同步获取与读取缓存快照的准备耗时
+"""
+import os
+import platform
+import threading
+import time
+
+# 前台窗口的采样间隔（秒）
+CONTEXT_POLL_INTERVAL = float(os.getenv("OPEN_ASSISTANT_CONTEXT_POLL", "0.3"))
+# 快照的有效期（秒）：请求读到更旧的快照时，即使窗口没有变化也重新解析一次路径
+CONTEXT_MAX_AGE = float(os.getenv("OPEN_ASSISTANT_CONTEXT_MAX_AGE", "5"))
+
+
+class ContextSnapshot:
+    """某一时刻的环境信息"""
+
+    def __init__(self, active_window="", file_path="", window_title="", sampled_at=0.0):
+        self.active_window = active_window
+        self.file_path = file_path
+        self.window_title = window_title
+        self.sampled_at = sampled_at
+
+    def age(self):
+        return time.monotonic() - self.sampled_at if self.sampled_at else float("inf")
+
+    def __repr__(self):
+        return f"ContextSnapshot({self.active_window!r}, {self.file_path!r}, age={self.age():.2f}s)"
+
+
+class WindowsContextSource:
+    """通过 get_active_window 获取前台窗口和文件路径（COM/PowerShell，可能需要数百毫秒）"""
+
+    def init_thread(self):
+        # COM 在每个使用它的线程中都需要初始化
+        import pythoncom
+        pythoncom.CoInitialize()
+
+    def foreground(self):
+        from get_active_window import get_active_window_info
+        return get_active_window_info()
+
+    def file_path(self):
+        from get_active_window import get_activate_path
+        return get_activate_path() or ""
+
+
+class StubContextSource:
+    """
+    测试和非Windows环境使用的桩：前台窗口由 set() 指定
+    probe_delay / resolve_delay 模拟获取窗口和解析路径的同步调用耗时（秒）
+    """
+
+    def __init__(self, process_name="", file_path="", window_title="", pid=1, probe_delay=0.0, resolve_delay=0.0):
+        self.probe_delay = probe_delay
+        self.resolve_delay = resolve_delay
+        self._lock = threading.Lock()
+        self.set(process_name, file_path, window_title, pid)
+
+    def set(self, process_name, file_path="", window_title="", pid=1):
+        with self._lock:
+            self._info = {'window_title': window_title or process_name, 'process_name': process_name, 'pid': pid}
+            self._file_path = file_path
+
+    def init_thread(self):
+        pass
+
+    def foreground(self):
+        time.sleep(self.probe_delay)
+        with self._lock:
+            return dict(self._info)
+
+    def file_path(self):
+        time.sleep(self.resolve_delay)
+        with self._lock:
+            return self._file_path
+
+
+def default_context_source():
+    return WindowsContextSource() if platform.system() == "Windows" else StubContextSource()
+
+
+class ContextProvider:
+    """
+    source: 提供 init_thread() / foreground() / file_path() 的对象，默认按平台选择
+    ignore_pids: 不计入的进程（默认是本进程，即悬浮球所在进程）
+    """
+
+    def __init__(self, source=None, interval=CONTEXT_POLL_INTERVAL, max_age=CONTEXT_MAX_AGE, ignore_pids=None):
+        self.source = source or default_context_source()
+        self.interval = interval
+        self.max_age = max_age
+        self.ignore_pids = {os.getpid()} if ignore_pids is None else set(ignore_pids)
+
+        self._snapshot = ContextSnapshot()
+        self._window_key = None
+        self._wake = threading.Event()
+        self._refresh = threading.Event()  # 请求读到过旧的快照，下一次采样重新解析路径
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"samples": 0, "resolves": 0, "resolve_ms": 0.0, "errors": 0, "stale_reads": 0}
+
+    def start(self):
+        """启动后台采样线程（重复调用无副作用）"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="context-provider", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def snapshot(self):
+        """返回最近一次快照，不阻塞；快照过旧时唤醒采样线程，下一次请求拿到新的"""
+        snapshot = self._snapshot
+        if snapshot.age() > self.max_age:
+            self.stats["stale_reads"] += 1
+            self._refresh.set()
+            self._wake.set()
+        return snapshot
+
+    def wait_ready(self, timeout=None):
+        """等待第一次采样完成（启动时使用），返回是否已有快照"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._snapshot.sampled_at:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def _run(self):
+        try:
+            self.source.init_thread()
+        except Exception as e:
+            print(f"[上下文] 采样线程初始化失败: {e}")
+        while not self._stop.is_set():
+            self.sample()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def sample(self):
+        """采样一次：窗口变化或有请求读到过旧的快照时才重新解析文件路径"""
+        try:
+            info = self.source.foreground()
+            self.stats["samples"] += 1
+            if info.get('pid') in self.ignore_pids:
+                return
+            key = (info.get('pid'), info.get('window_title'))
+            if key == self._window_key and not self._refresh.is_set():
+                return
+            self._refresh.clear()
+            start = time.perf_counter()
+            file_path = self.source.file_path()
+            self.stats["resolves"] += 1
+            self.stats["resolve_ms"] += (time.perf_counter() - start) * 1000
+            self._window_key = key
+            self._snapshot = ContextSnapshot(info.get('process_name', ""), file_path,
+                                             info.get('window_title', ""), time.monotonic())
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"[上下文] 获取活跃窗口失败: {e}")
+
+    def summary(self):
+        resolves = self.stats["resolves"]
+        average = self.stats["resolve_ms"] / resolves if resolves else 0.0
+        return (f"采样{self.stats['samples']}次 解析路径{resolves}次(平均{average:.0f}ms) "
+                f"出错{self.stats['errors']}次 读到过旧快照{self.stats['stale_reads']}次")
+
+
+if __name__ == '__main__':
+    # 模拟Windows上的耗时：前台窗口约20ms，COM/PowerShell解析路径约300ms
+    source = StubContextSource("winword.exe", "D:\\报告.docx", pid=100, probe_delay=0.02, resolve_delay=0.3)
+    rounds = 5
+
+    # 修改前：每条消息先sleep 0.5秒，再同步获取窗口名和文件路径
+    start = time.perf_counter()
+    for _ in range(rounds):
+        time.sleep(0.5)
+        active_window = source.foreground()['process_name']
+        source.foreground()
+        active_file_path = source.file_path()
+    legacy_ms = (time.perf_counter() - start) / rounds * 1000
+
+    provider = ContextProvider(source, interval=0.1, max_age=0.2).start()
+    provider.wait_ready()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        snapshot = provider.snapshot()
+    cached_ms = (time.perf_counter() - start) / rounds * 1000
+    print(f"[同步获取(修改前)] {legacy_ms:.0f}ms/条   [缓存快照] {cached_ms:.4f}ms/条  {snapshot}")
+
+    source.set("excel.exe", "D:\\预算.xlsx", pid=200)
+    time.sleep(0.5)
+    print(f"[切换窗口] {provider.snapshot()}")
+    source.set("python.exe", "", pid=os.getpid())
+    time.sleep(0.3)
+    print(f"[前台是本进程，保留之前的窗口] {provider.snapshot()}")
+    # 窗口不变、没有请求时不再按 max_age 反复解析路径（修改前空闲1秒会解析约5次）
+    source.set("excel.exe", "D:\\预算.xlsx", pid=200)
+    time.sleep(0.6)  # 上面读到过旧的快照，等这次按需解析完成
+    resolves = provider.stats["resolves"]
+    time.sleep(1.0)
+    print(f"[窗口不变、空闲1秒] 新增解析{provider.stats['resolves'] - resolves}次")
+    provider.stop()
+    print(provider.summary())
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+按token预算管理的对话记忆
+1. 每条消息入库时估算token数并缓存，历史按token预算而不是按条数裁剪
+2. 超出预算时把较早的若干轮对话压缩进一段滚动摘要（可在后台异步生成，不阻塞下一次提问）
+3. 单条超长消息（粘贴的文档、大段搜索结果）在成为历史后只保留首尾，避免拖垮之后的每一次请求
+4. messages() 返回的消息总量始终不超过预算，提示词大小可预测
+5. python conversation_memory.py 会模拟一段包含大段工具结果的对话，对比按条数裁剪与按token预算的提示词大小
+"""
+import asyncio
+import json
+import os
+import re
+
+# 历史消息（含摘要）的token预算
+HISTORY_TOKEN_BUDGET = int(os.getenv("OPEN_ASSISTANT_HISTORY_TOKENS", "6000"))
+# 压缩后保留的近期消息占预算的比例，留出余量避免每轮都触发压缩
+COMPACT_TARGET_RATIO = 0.5
+# 单条历史消息的上限（最新一条消息不受限制）
+MAX_MESSAGE_TOKENS = 1500
+# 摘要本身的长度上限
+SUMMARY_MAX_TOKENS = 500
+# 每条消息的格式开销（role等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PREFIX = "[之前对话的摘要]\n"
+
+_CJK = re.compile(r"[　-〿㐀-䶿一-鿿＀-￯]")
+
+
+def count_tokens(text):
+    """估算文本的token数：中日韩字符约1字1token，其余约4字符1token"""
+    if not text:
+        return 0
+    if not isinstance(text, str):
+        text = json.dumps(text, ensure_ascii=False)
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_tokens(message):
+    return count_tokens(message.get("content")) + MESSAGE_OVERHEAD_TOKENS
+
+
+def clip_text(text, max_tokens):
+    """超出上限的文本只保留开头和结尾，中间替换为省略说明"""
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    keep = max(int(len(text) * max_tokens / tokens) - 20, 0)
+    head, tail = text[:keep * 2 // 3], text[len(text) - keep // 3:] if keep // 3 else ""
+    return f"{head}\n……[中间省略约{len(text) - len(head) - len(tail)}字]……\n{tail}"
+
+
+def build_summary_request(previous_summary, messages):
+    """生成摘要用的提示词"""
+    lines = [f"{message['role']}: {clip_text(message['content'], MAX_MESSAGE_TOKENS)}" for message in messages]
+    return [
+        {"role": "system", "content": "你负责压缩对话记录。请把已有摘要和新的对话合并为一段简洁的中文摘要，"
+                                      f"保留用户的偏好、关键事实、文件路径和未完成的任务，不超过{SUMMARY_MAX_TOKENS}字。"},
+        {"role": "user", "content": f"已有摘要：\n{previous_summary or '（无）'}\n\n新的对话：\n" + "\n".join(lines)},
+    ]
+
+
+def fallback_summary(previous_summary, messages):
+    """没有摘要模型或摘要失败时的退化方案：只记下用户问过什么"""
+    questions = [clip_text(message["content"], 60) for message in messages if message["role"] == "user"]
+    text = (previous_summary + "\n" if previous_summary else "") + "用户之前问过：" + "；".join(questions)
+    return clip_text(text, SUMMARY_MAX_TOKENS)
+
+
+class ConversationMemory:
+    """
+    summarize: 可选的异步回调 summarize(previous_summary, messages) -> 摘要文本，
+               为None时使用 fallback_summary
+    background: True时压缩在后台任务中进行，当前请求不等待摘要完成
+    """
+
+    def __init__(self, summarize=None, token_budget=HISTORY_TOKEN_BUDGET, max_message_tokens=MAX_MESSAGE_TOKENS,
+                 target_ratio=COMPACT_TARGET_RATIO, background=True):
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.max_message_tokens = max_message_tokens
+        self.target_ratio = target_ratio
+        self.background = background
+
+        self.summary = ""
+        self._history = []  # [(消息, 原始token数)]
+        self._summary_task = None
+        self.compactions = 0
+
+    def add(self, role, content):
+        message = {"role": role, "content": content or ""}
+        self._history.append((message, message_tokens(message)))
+
+    def discard_last(self, role):
+        """撤回最后一条消息（请求被取消时，问题没有得到回答，不留在历史里）"""
+        if self._history and self._history[-1][0]["role"] == role:
+            self._history.pop()
+
+    def _view(self):
+        """按预算生成发给模型的历史：摘要 + 近期消息（旧消息截断，仍超出时从最早的开始省略）"""
+        view = []
+        for index, (message, tokens) in enumerate(self._history):
+            if index < len(self._history) - 1 and tokens > self.max_message_tokens:
+                message = {"role": message["role"], "content": clip_text(message["content"], self.max_message_tokens)}
+                tokens = message_tokens(message)
+            view.append((message, tokens))
+
+        budget = self.token_budget
+        if self.summary:
+            budget -= count_tokens(self.summary) + MESSAGE_OVERHEAD_TOKENS
+        total = sum(tokens for _, tokens in view)
+        while len(view) > 1 and total > budget:
+            total -= view.pop(0)[1]
+        # 不以孤立的assistant消息开头
+        while len(view) > 1 and view[0][0]["role"] != "user":
+            total -= view.pop(0)[1]
+        return view, total
+
+    def messages(self):
+        """返回发给模型的消息列表（新列表，可以随意修改）"""
+        view, _ = self._view()
+        messages = [dict(message) for message, _ in view]
+        if self.summary:
+            messages.insert(0, {"role": "user", "content": SUMMARY_PREFIX + self.summary})
+        return messages
+
+    def total_tokens(self):
+        _, total = self._view()
+        return total + (count_tokens(self.summary) + MESSAGE_OVERHEAD_TOKENS if self.summary else 0)
+
+    def _raw_tokens(self):
+        return sum(min(tokens, self.max_message_tokens) for _, tokens in self._history)
+
+    async def after_turn(self):
+        """一轮对话结束后调用：超出预算时压缩较早的对话"""
+        if self._raw_tokens() <= self.token_budget:
+            return
+        if self._summary_task and not self._summary_task.done():
+            # 上一次压缩还没完成，本轮先由 messages() 按预算省略最早的消息
+            return
+        if self.background:
+            self._summary_task = asyncio.create_task(self.compact())
+        else:
+            await self.compact()
+
+    async def compact(self):
+        """把最早的若干轮移出历史，与已有摘要合并为新的摘要"""
+        target = int(self.token_budget * self.target_ratio)
+        total = self._raw_tokens()
+        cut = 0
+        while cut < len(self._history) - 1 and total > target:
+            total -= min(self._history[cut][1], self.max_message_tokens)
+            cut += 1
+        # 按整轮切分：保留的部分从user消息开始
+        while cut < len(self._history) - 1 and self._history[cut][0]["role"] != "user":
+            cut += 1
+        if cut == 0:
+            return
+        old = [message for message, _ in self._history[:cut]]
+        # 先移出历史，摘要生成期间新加入的消息不受影响
+        del self._history[:cut]
+
+        previous = self.summary
+        summary = None
+        if self.summarize is not None:
+            try:
+                summary = await self.summarize(previous, old)
+            except Exception as e:
+                print(f"[记忆] 生成摘要失败，使用简化摘要: {e}")
+        self.summary = clip_text(summary, SUMMARY_MAX_TOKENS) if summary else fallback_summary(previous, old)
+        self.compactions += 1
+        print(f"[记忆] 已将{len(old)}条较早的消息压缩为摘要（{count_tokens(self.summary)} token）")
+
+    async def wait_idle(self):
+        """等待正在后台进行的压缩完成"""
+        if self._summary_task:
+            await self._summary_task
+
+
+if __name__ == '__main__':
+    import random
+
+    random.seed(0)
+    search_result = json.dumps([{"title": f"结果{i}", "url": f"https://example.com/{i}",
+                                 "snippet": "搜索结果摘要内容" * 20} for i in range(30)], ensure_ascii=False)
+    turns = []
+    for i in range(20):
+        question = f"第{i}个问题：" + ("帮我搜索一下相关资料" if i % 5 == 2 else "你好")
+        answer = search_result if i % 5 == 2 else f"第{i}个回答。" * random.randint(1, 10)
+        turns.append((question, answer))
+
+    async def fake_summarize(previous, messages):
+        await asyncio.sleep(0.05)
+        return fallback_summary(previous, messages)
+
+    async def main():
+        legacy = []
+        memory = ConversationMemory(fake_summarize, token_budget=3000)
+        legacy_sizes, sizes = [], []
+        for question, answer in turns:
+            # 修改前：保留最近10条消息，不论大小
+            legacy.append({"role": "user", "content": question})
+            legacy = legacy[-10:]
+            legacy_sizes.append(sum(message_tokens(m) for m in legacy))
+            legacy.append({"role": "assistant", "content": answer})
+
+            memory.add("user", question)
+            await asyncio.sleep(0.1)  # 模拟模型调用，期间后台摘要可以进行
+            sizes.append(sum(message_tokens(m) for m in memory.messages()))
+            memory.add("assistant", answer)
+            await memory.after_turn()
+        await memory.wait_idle()
+        print(f"[按条数裁剪(修改前)] 每轮历史token 最大={max(legacy_sizes)} 平均={sum(legacy_sizes) // len(legacy_sizes)}")
+        print(f"[按token预算3000] 每轮历史token 最大={max(sizes)} 平均={sum(sizes) // len(sizes)} "
+              f"压缩次数={memory.compactions}")
+        print(f"最终摘要: {memory.summary[:80]}...")
+
+    asyncio.run(main())
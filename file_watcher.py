@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+可等待的文件变化监听器
+1. Linux 下使用 inotify 监听文件所在目录，文件被写完或被替换时立即唤醒
+2. 其他平台使用 stat 轮询，间隔可配置，空闲时按倍数退避，检测到变化后恢复
+3. python file_watcher.py 可测量空闲CPU占用和唤醒延迟（与旧的忙等循环对比）
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+
+# inotify 事件掩码，见 <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None and sys.platform.startswith("linux"):
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        except OSError:
+            _libc = False
+    return _libc or None
+
+
+def inotify_available():
+    """当前平台是否可以使用inotify"""
+    libc = _load_libc()
+    return libc is not None and hasattr(libc, "inotify_init1")
+
+
+def file_signature(path):
+    """文件的变化签名，比单纯比较mtime更可靠（不受mtime精度影响）"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class FileWatcher:
+    """
+    监听单个文件的变化，await wait() 会挂起直到文件内容发生变化
+    mode: auto（有inotify则用inotify，否则轮询）/ inotify / poll
+    """
+
+    def __init__(self, path, mode="auto", poll_interval=0.05, max_poll_interval=1.0, backoff=1.5):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+        self.last_signature = file_signature(path)
+
+        if mode == "auto":
+            mode = "inotify" if inotify_available() else "poll"
+        self.mode = mode
+
+        self._fd = None
+        self._event = None
+        if self.mode == "inotify":
+            self._setup_inotify()
+
+    def _setup_inotify(self):
+        libc = _load_libc()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        # 监听目录而不是文件本身，这样文件被替换（rename）后依然有效；
+        # 只关心"写完关闭"和"移入"，避免在写入中途被唤醒
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO
+        if libc.inotify_add_watch(fd, directory.encode(), mask) < 0:
+            os.close(fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch 失败: {directory}")
+        self._fd = fd
+        self._name = os.path.basename(self.path).encode()
+        self._event = asyncio.Event()
+        asyncio.get_running_loop().add_reader(fd, self._on_inotify_readable)
+
+    def _on_inotify_readable(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + _INOTIFY_EVENT.size <= len(data):
+            _, _, _, name_len = _INOTIFY_EVENT.unpack_from(data, offset)
+            offset += _INOTIFY_EVENT.size
+            name = data[offset:offset + name_len].rstrip(b"\0")
+            offset += name_len
+            if name == self._name:
+                self._event.set()
+
+    def _changed(self):
+        signature = file_signature(self.path)
+        if signature is not None and signature != self.last_signature:
+            self.last_signature = signature
+            return True
+        return False
+
+    async def wait(self):
+        """挂起直到文件发生变化"""
+        if self._changed():
+            return
+        if self.mode == "inotify":
+            while True:
+                await self._event.wait()
+                self._event.clear()
+                if self._changed():
+                    return
+        interval = self.poll_interval
+        while True:
+            await asyncio.sleep(interval)
+            if self._changed():
+                return
+            interval = min(interval * self.backoff, self.max_poll_interval)
+
+    def close(self):
+        if self._fd is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self._fd)
+            except RuntimeError:
+                pass
+            os.close(self._fd)
+            self._fd = None
+
+
+def _measure(label, make_waiter, path, rounds=20, idle_seconds=2.0):
+    """测量空闲CPU占用和唤醒延迟"""
+    import threading
+    import time
+    import random
+    import statistics
+
+    async def run():
+        waiter = make_waiter()
+        # 空闲阶段：没有任何写入，统计CPU时间
+        cpu_start = time.process_time()
+        try:
+            await asyncio.wait_for(waiter(), timeout=idle_seconds)
+        except asyncio.TimeoutError:
+            pass
+        idle_cpu = (time.process_time() - cpu_start) / idle_seconds * 100
+
+        latencies = []
+        for i in range(rounds):
+            written = {}
+
+            def writer():
+                time.sleep(random.uniform(0.05, 0.3))
+                written["t"] = time.perf_counter()
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(str(i))
+
+            threading.Thread(target=writer, daemon=True).start()
+            await waiter()
+            latencies.append((time.perf_counter() - written.get("t", time.perf_counter())) * 1000)
+        print(f"[{label}] 空闲CPU占用={idle_cpu:.1f}%, 唤醒延迟 p50={statistics.median(latencies):.2f}ms, "
+              f"max={max(latencies):.2f}ms")
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    test_path = os.path.join(tempfile.mkdtemp(), "input_message.json")
+    open(test_path, 'w').close()
+
+    # 旧版 loop() 的空闲分支：没有sleep/await的 while True，只能测量固定时长
+    import time
+    cpu_start, wall_start = time.process_time(), time.time()
+    while time.time() - wall_start < 2.0:
+        os.path.exists(test_path) and os.path.getmtime(test_path)
+    print(f"[busy-spin(修改前)] 空闲CPU占用={(time.process_time() - cpu_start) / 2.0 * 100:.1f}%")
+
+    _measure("poll", lambda: FileWatcher(test_path, mode="poll").wait, test_path)
+    if inotify_available():
+        _measure("inotify", lambda: FileWatcher(test_path, mode="inotify").wait, test_path)
@@ -2,9 +2,8 @@ import sys
 import os
 import subprocess
 import math
-import json
 import time
-import threading
+import collections
 
 # 使用环境变量抑制PyQt5的警告
 os.environ['QT_LOGGING_RULES'] = '*.warning=false;*.critical=false'
@@ -38,49 +37,62 @@ try:
 except ImportError:
     print("未找到markdown库，将使用纯文本显示。请安装markdown库以支持markdown格式。")
 
-# 用于进程间通信的文件路径
-INPUT_FILE = "data/input_message.json"
-OUTPUT_FILE = "data/output_message.json"
-# 用于控制悬浮球输入框禁用状态的标志文件路径
-INPUT_DISABLE_FLAG = "data/input_disabled.flag"
+# 用于进程间通信的文件路径（socket不可用时的备用通道）
+from ipc_channel import UIChannelClient, REQUEST_QUEUE_FILE, RESPONSE_LOG_FILE
+from tracing import tracer
 
 class BackendServiceListener(QObject):
-    """消息通信器，负责与test_float.py进行通信"""
+    """消息通信器，负责与mcp_agent_and_server_start.py进行通信"""
     response_received = pyqtSignal(str)
+    # 流式输出：携带到目前为止的完整气泡文本
+    delta_received = pyqtSignal(str)
     
     def __init__(self):
         super().__init__()
-        self.running = False
-        self.listener_thread = None
-        self.last_output_time = 0
+        self.channel = UIChannelClient(self.on_channel_message)
         self.current_request_id = None
+        # 已发送但尚未收到响应的请求（request_id -> 用户消息），允许连续输入多条
+        self.pending_requests = {}
+        # 流式输出中已收到的文本（request_id -> 文本）
+        self.streaming_text = {}
+        # 已收到、等待界面线程渲染的响应 (request_id, 收到时间)，信号按发出顺序送达
+        self.pending_renders = collections.deque()
     
     def start(self):
         """启动通信器"""
-        self.running = True
-        self.listener_thread = threading.Thread(target=self.listen_for_responses)
-        self.listener_thread.daemon = True
-        self.listener_thread.start()
+        self.channel.start()
     
     def stop(self):
         """停止通信器"""
-        self.running = False
-        if self.listener_thread:
-            self.listener_thread.join(timeout=1.0)
+        self.cancel_pending("closed")
+        self.channel.stop()
+
+    def cancel_pending(self, reason):
+        """取消所有尚未完成的请求：Agent会中断正在进行的模型和工具调用，排队中的直接跳过"""
+        for request_id in list(self.pending_requests):
+            self.channel.send({
+                'type': 'cancel',
+                'request_id': request_id,
+                'reason': reason,
+                'timestamp': time.time()
+            })
+            print(f"已取消请求: {request_id}（{reason}）")
+        self.pending_requests.clear()
+        self.streaming_text.clear()
     
     def send_message(self, message, screenshot_filename=None):
-        """发送消息到test_float.py"""
+        """发送消息到mcp_agent_and_server_start.py"""
         try:
-            # 确保数据目录存在
-            if not os.path.exists("data"):
-                os.makedirs("data")
-            
             # 创建请求ID
             request_id = str(time.time())
+            # 新消息取代尚未回答完的旧问题，不再等它们生成完
+            self.cancel_pending("new_message")
             self.current_request_id = request_id
+            self.pending_requests[request_id] = message
             
             # 构建消息数据
             data = {
+                'type': 'request',
                 'request_id': request_id,
                 'content': message,
                 'timestamp': time.time()
@@ -91,43 +103,50 @@ class BackendServiceListener(QObject):
                 data['screenshot_filename'] = screenshot_filename
                 print(f"缩略图文件名已添加: {screenshot_filename}")
             
-            # 写入输入文件
-            with open(INPUT_FILE, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False)
+            if not self.channel.send(data):
+                self.pending_requests.pop(request_id, None)
+                return False
             
-            print(f"消息已发送: {message}")
+            print(f"消息已发送({self.channel.transport}): {message}")
             return True
         except Exception as e:
             print(f"发送消息失败: {e}")
             return False
     
-    def listen_for_responses(self):
-        """监听test_float.py的响应，任何时候OUTPUT_FILE内容被修改都会显示"""
-        while self.running:
-            try:
-                # 检查输出文件是否存在且有更新
-                if os.path.exists(OUTPUT_FILE):
-                    file_time = os.path.getmtime(OUTPUT_FILE)
-                    if file_time > self.last_output_time:
-                        # 读取响应消息
-                        with open(OUTPUT_FILE, 'r', encoding='utf-8') as f:
-                            data = json.load(f)
-                        
-                        # 直接获取content，不检查request_id，确保任何修改都能显示
-                        response = data.get('content', '')
-                        if response:  # 确保内容不为空
-                            print(f"检测到OUTPUT_FILE更新，显示内容: {response}")
-                            # 通过信号发送响应
-                            self.response_received.emit(response)
-                        
-                        # 记录最后读取时间
-                        self.last_output_time = file_time
-            
-            except Exception as e:
-                print(f"监听响应时出错: {e}")
-            
-            # 短暂休眠，减少CPU占用
-            time.sleep(0.1)
+    def has_pending(self):
+        """是否还有等待响应的请求"""
+        return bool(self.pending_requests)
+
+    def on_channel_message(self, data):
+        """通道收到消息时回调（在通道线程中执行）"""
+        # 只显示本窗口发出的请求对应的响应，忽略过期或不相关的响应
+        request_id = data.get('request_id', '')
+        # 界面线程可能同时在 cancel_pending() 中清空请求，只取一次
+        message = self.pending_requests.get(request_id)
+        if message is None:
+            print(f"[调试] 忽略不匹配的响应: {request_id}")
+            return
+
+        if data.get('type') == 'delta':
+            text = self.streaming_text.get(request_id, '') + data.get('delta', '')
+            self.streaming_text[request_id] = text
+            self.delta_received.emit("user: " + message + "\n\n" + "AI:\n\n" + text)
+            return
+
+        self.pending_requests.pop(request_id, None)
+        self.streaming_text.pop(request_id, None)
+        response = data.get('content', '')
+        if response:  # 确保内容不为空
+            print(f"收到响应，显示内容: {response}")
+            # 通过信号发送响应
+            self.pending_renders.append((request_id, time.time()))
+            self.response_received.emit(response)
+
+    def trace_render(self):
+        """界面线程渲染完一条响应后调用：记录从通道收到响应到显示完成的耗时"""
+        if self.pending_renders:
+            request_id, received_at = self.pending_renders.popleft()
+            tracer.record("ui_render", received_at, (time.time() - received_at) * 1000, request_id=request_id)
 
 # 创建全局消息通信器实例
 comm_manager = BackendServiceListener()
@@ -387,21 +406,7 @@ class ChatInputBox(QWidget):
         self.move(x, y)
 
     def handle_return_pressed(self):
-        # 检查输入是否被禁用
-        if os.path.exists(INPUT_DISABLE_FLAG):
-            # 显示禁用提示
-            if self.parent() and hasattr(self.parent(), 'display_widget') and self.parent().display_widget:
-                self.parent().display_widget.waiting_input_label.setText("语音模式下禁用输入")
-                self.parent().display_widget.show_waiting_message()
-            return
-            
-        # 检查父窗口是否处于等待状态
-        if self.parent() and hasattr(self.parent(), 'is_waiting') and self.parent().is_waiting:
-            # 显示等待提示
-            if self.parent() and hasattr(self.parent(), 'display_widget') and self.parent().display_widget:
-                self.parent().display_widget.show_waiting_message()
-            return
-
+        # 等待响应期间也允许继续输入，新消息会取消尚未回答完的旧问题
         text = self.input_line.text()
         if text:
             if self.parent() and hasattr(self.parent(), 'display_widget') and self.parent().display_widget:
@@ -489,9 +494,12 @@ class ChatDisplayBox(QWidget):
         self.is_resizing = False
         self.resize_start_y = 0
         self.min_height = 100  # 最小高度限制
+        # 流式输出时待渲染的文本，合并50ms内的多次增量只渲染一次
+        self.pending_stream_text = None
         self.init_ui()
         # 连接通信器的响应信号
         comm_manager.response_received.connect(self.on_response_received)
+        comm_manager.delta_received.connect(self.on_delta_received)
 
 
     def init_ui(self):
@@ -635,19 +643,7 @@ class ChatDisplayBox(QWidget):
     def set_display_content(self, text):
         """设置显示内容，支持markdown格式和聊天气泡"""
         self.display_text = text
-        
-        # 创建禁用输入标志文件，确保显示内容后2秒内无法输入
-        try:
-            with open(INPUT_DISABLE_FLAG, 'w') as f:
-                f.write('')
-            print(f"已创建输入禁用标志，2秒内无法输入")
-            
-            # 设置2秒后自动删除标志文件，恢复输入功能
-            QTimer.singleShot(2000, self.remove_disable_flag)
-            
-        except Exception as e:
-            print(f"设置输入禁用标志失败: {e}")
-            
+
         # --- NEW CHAT BUBBLE LOGIC ---
         user_text = ""
         ai_text = ""
@@ -749,15 +745,32 @@ class ChatDisplayBox(QWidget):
         self.display_text_edit.setHtml(styled_html)
         # --- END OF NEW LOGIC ---
     
+    def on_delta_received(self, stream_text):
+        # 流式增量到达时，合并后增量刷新气泡
+        if self.pending_stream_text is None:
+            QTimer.singleShot(50, self.render_stream_text)
+        self.pending_stream_text = stream_text
+
+    def render_stream_text(self):
+        if self.pending_stream_text is None:
+            return
+        stream_text = self.pending_stream_text
+        self.pending_stream_text = None
+        self.waiting_label.hide()
+        self.set_display_content(stream_text)
+        self.display_text_edit.show()
+
     def on_response_received(self, response_text):
-        # 收到响应时显示
+        # 收到完整响应时显示，丢弃尚未渲染的流式增量
+        self.pending_stream_text = None
         self.display_text = response_text
         self.waiting_label.hide()
         self.set_display_content(response_text)
         self.display_text_edit.show()
-        # 通知父窗口等待状态结束
+        comm_manager.trace_render()
+        # 所有请求都已响应时，通知父窗口等待状态结束
         if self.parent() and hasattr(self.parent(), 'set_waiting_state'):
-            self.parent().set_waiting_state(False)
+            self.parent().set_waiting_state(comm_manager.has_pending())
             # 将内容保存到父窗口
             self.parent().saved_display_content = response_text
 
@@ -767,18 +780,6 @@ class ChatDisplayBox(QWidget):
 
     def hide_waiting_message(self):
         self.waiting_input_label.hide()
-    
-    def remove_disable_flag(self):
-        """删除输入禁用标志文件，恢复输入功能"""
-        try:
-            if os.path.exists(INPUT_DISABLE_FLAG):
-                os.remove(INPUT_DISABLE_FLAG)
-                print("已删除输入禁用标志，恢复输入功能")
-                # 隐藏等待消息标签
-                if hasattr(self, 'waiting_input_label'):
-                    self.waiting_input_label.hide()
-        except Exception as e:
-            print(f"删除输入禁用标志失败: {e}")
 
     def mousePressEvent(self, event):
         # 检查是否点击了窗口顶部边缘用于调整高度
@@ -819,6 +820,9 @@ class ChatDisplayBox(QWidget):
         super().mouseReleaseEvent(event)
     
     def hide_display(self):
+        # 关闭气泡（悬浮球右键菜单“关闭气泡”）即不再需要正在生成的回答；
+        # 鼠标移开或拖动时只是暂时隐藏，回答继续生成，悬停时再显示
+        comm_manager.cancel_pending("closed")
         self.hide()
         if self.parent():
             self.parent().is_display_visible = False
@@ -1254,6 +1258,17 @@ class AssistantAvatar(QWidget):
         """设置等待状态"""
         self.is_waiting = state
 
+    def stop_answer(self):
+        """取消正在生成的回答"""
+        comm_manager.cancel_pending("stopped")
+        self.set_waiting_state(False)
+
+    def close_display(self):
+        """关闭显示框，并取消正在生成的回答"""
+        if self.display_widget:
+            self.display_widget.hide_display()
+        self.set_waiting_state(False)
+
     def on_thumbnail_deleted(self):
         """处理缩略图被删除的情况"""
         self.screenshot_path = None
@@ -1310,14 +1325,20 @@ class AssistantAvatar(QWidget):
         self.context_menu = QMenu(self)
         
         # 创建菜单项
+        self.stop_answer_action = QAction("停止回答", self)
+        self.close_display_action = QAction("关闭气泡", self)
         self.enter_setting_action = QAction("进入设置页", self)
         self.exit_action = QAction("退出软件", self)
         
         # 连接信号与槽
+        self.stop_answer_action.triggered.connect(self.stop_answer)
+        self.close_display_action.triggered.connect(self.close_display)
         self.enter_setting_action.triggered.connect(self.enter_setting_page)
         self.exit_action.triggered.connect(self.exit_application)
         
         # 添加菜单项到菜单
+        self.context_menu.addAction(self.stop_answer_action)
+        self.context_menu.addAction(self.close_display_action)
         self.context_menu.addAction(self.enter_setting_action)
         self.context_menu.addAction(self.exit_action)
         
@@ -1346,6 +1367,8 @@ class AssistantAvatar(QWidget):
     
     def show_context_menu(self, position):
         """显示右键菜单"""
+        self.stop_answer_action.setEnabled(comm_manager.has_pending())
+        self.close_display_action.setEnabled(self.is_display_visible)
         self.context_menu.exec_(self.mapToGlobal(position))
     
     def enter_setting_page(self):
@@ -1570,20 +1593,18 @@ def launch_assistant_avatar():
     app = QApplication(sys.argv)
     # 高DPI设置已在导入后创建QApplication前设置，这里不再需要
     
-    # 清空JSON文件
+    # 清理上次运行遗留的请求队列和响应日志（旧记录本身也不会被重复处理）；
+    # 已在运行的Agent进程中的 SealedLog 会发现文件被重建，从新文件的开头读取
     try:
         # 确保数据目录存在
         if not os.path.exists("data"):
             os.makedirs("data")
-        # 清空输入文件
-        with open(INPUT_FILE, 'w', encoding='utf-8') as f:
-            json.dump({}, f, ensure_ascii=False)
-        # 清空输出文件
-        with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-            json.dump({}, f, ensure_ascii=False)
-        print("JSON文件已清空")
+        for path in (REQUEST_QUEUE_FILE, RESPONSE_LOG_FILE):
+            if os.path.exists(path):
+                os.remove(path)
+        print("消息队列文件已清空")
     except Exception as e:
-        print(f"清空JSON文件时出错: {e}")
+        print(f"清空消息队列文件时出错: {e}")
 
     font = app.font()
     font.setPointSize(9)
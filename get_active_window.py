@@ -382,7 +382,6 @@ def get_activate_path():
     # 获取当前活动窗口句柄
     window_title, pid = get_active_window_title()
     info = get_active_window_info()
-    print("info", info)
 
     # 初始化结果字典
     result_file_content = {
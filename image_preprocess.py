@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+发给视觉模型之前的图片预处理
+1. 截图是物理分辨率的PNG（高DPI屏幕上一张全屏截图就有数MB），原来直接base64上传并错误地标成 image/jpeg
+2. 这里先把长边缩小到 VISION_MAX_EDGE，去掉透明通道（铺白色背景），在内存中重新编码为JPEG或WebP
+3. 视觉模型按固定大小的图块计算图片token，缩小分辨率同时减少上传体积和模型的处理时间
+4. 重新编码后反而更大时（色块简单的小图PNG更省）保留原文件，并标注真实的格式
+5. python image_preprocess.py 会在 imgs/ 下的图片和模拟的全屏截图上对比各种格式的体积和编码耗时
+"""
+import base64
+import io
+import os
+import time
+
+from PIL import Image
+
+# 长边的最大像素数，0 表示不缩放
+VISION_MAX_EDGE = int(os.getenv("OPEN_ASSISTANT_VISION_MAX_EDGE", "1280"))
+# 重新编码的格式：JPEG 或 WEBP
+VISION_IMAGE_FORMAT = os.getenv("OPEN_ASSISTANT_VISION_FORMAT", "JPEG").upper()
+VISION_IMAGE_QUALITY = {"JPEG": 85, "WEBP": 80}
+# 视觉模型的图块边长（像素），用于估算图片token数
+VISION_PATCH_SIZE = 28
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+class PreparedImage:
+    """预处理后的图片：编码后的字节、格式与尺寸，以及处理前的信息用于统计"""
+
+    def __init__(self, data, image_format, size, original_bytes, original_size, elapsed_ms):
+        self.data = data
+        self.format = image_format
+        self.size = size
+        self.original_bytes = original_bytes
+        self.original_size = original_size
+        self.elapsed_ms = elapsed_ms
+
+    @property
+    def mime_type(self):
+        return MIME_TYPES.get(self.format, "application/octet-stream")
+
+    def data_url(self):
+        return f"data:{self.mime_type};base64,{base64.b64encode(self.data).decode('utf-8')}"
+
+    def summary(self):
+        return (f"{self.original_size[0]}x{self.original_size[1]} {self.original_bytes / 1024:.0f}KB -> "
+                f"{self.size[0]}x{self.size[1]} {self.format} {len(self.data) / 1024:.0f}KB "
+                f"（{self.elapsed_ms:.0f}ms）")
+
+
+def estimate_image_tokens(size, patch=VISION_PATCH_SIZE):
+    width, height = size
+    return max(1, round(width / patch)) * max(1, round(height / patch))
+
+
+def _flatten(image):
+    """去掉透明通道：透明区域铺白色背景，其余模式统一转为RGB"""
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        if image.getchannel("A").getextrema() == (255, 255):
+            # 截图的透明通道通常全部不透明，直接丢弃即可
+            return image.convert("RGB")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB") if image.mode != "RGB" else image
+
+
+def prepare_image(path, max_edge=VISION_MAX_EDGE, image_format=VISION_IMAGE_FORMAT, quality=None):
+    """读取并预处理图片，返回 PreparedImage"""
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        original = f.read()
+    with Image.open(io.BytesIO(original)) as image:
+        original_format = image.format
+        original_size = image.size
+        # 先去掉透明通道：缩放单通道更少的RGB图更快
+        image = _flatten(image)
+        if max_edge and max(image.size) > max_edge:
+            # reducing_gap 先用快速的整数倍缩小，再做双三次重采样，大图的耗时少很多
+            image.thumbnail((max_edge, max_edge), Image.Resampling.BICUBIC, reducing_gap=2.0)
+        resized = image.size != original_size
+
+        buffer = io.BytesIO()
+        quality = quality or VISION_IMAGE_QUALITY.get(image_format, 85)
+        if image_format == "WEBP":
+            image.save(buffer, "WEBP", quality=quality, method=4)
+        else:
+            image_format = "JPEG"
+            image.save(buffer, "JPEG", quality=quality, optimize=True)
+        data = buffer.getvalue()
+        size = image.size
+
+    if not resized and len(data) >= len(original) and original_format in MIME_TYPES:
+        data, image_format = original, original_format
+    return PreparedImage(data, image_format, size, len(original), original_size,
+                         (time.perf_counter() - start) * 1000)
+
+
+def encode_image_for_vision(path, **kwargs):
+    """返回可直接放进 image_url 的 data URL，失败时返回None"""
+    try:
+        prepared = prepare_image(path, **kwargs)
+    except Exception as e:
+        print(f"图片预处理出错: {str(e)}")
+        return None
+    print(f"[图片预处理] {prepared.summary()}")
+    return prepared.data_url()
+
+
+def _make_screenshot(path, size=(2560, 1440)):
+    """生成一张模拟的全屏截图（窗口、文字行、一张照片区域），带透明通道，与截图工具保存的格式一致"""
+    import random
+    from PIL import ImageDraw, ImageFilter
+
+    random.seed(0)
+    image = Image.new("RGBA", size, (243, 243, 243, 255))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([0, 0, size[0], 48], fill=(32, 32, 32, 255))
+    draw.rectangle([120, 120, 1500, 1300], fill=(255, 255, 255, 255), outline=(200, 200, 200, 255))
+    for row in range(150, 1260, 34):
+        x = 160
+        while x < 1440:
+            width = random.randint(20, 90)
+            draw.rectangle([x, row, x + width, row + 14], fill=(40, 40, 40, 255))
+            x += width + random.randint(8, 16)
+    photo = Image.effect_noise((900, 700), 60).convert("RGB").filter(ImageFilter.GaussianBlur(3))
+    image.paste(photo.resize((900, 700)), (1580, 200))
+    image.save(path)
+    return path
+
+
+if __name__ == '__main__':
+    import glob
+    import tempfile
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    samples = sorted(glob.glob(os.path.join(base_dir, "imgs", "*.png")) + glob.glob(os.path.join(base_dir, "imgs", "*.jpg")))
+    samples.append(_make_screenshot(os.path.join(tempfile.mkdtemp(), "screenshot_2560x1440.png")))
+
+    variants = [("原图base64(修改前)", None, None, None), ("JPEG q85", VISION_MAX_EDGE, "JPEG", 85),
+                ("JPEG q70", VISION_MAX_EDGE, "JPEG", 70), ("WebP q80", VISION_MAX_EDGE, "WEBP", 80)]
+    for path in samples:
+        with Image.open(path) as image:
+            print(f"\n{os.path.basename(path)} {image.size[0]}x{image.size[1]} {image.mode} "
+                  f"{os.path.getsize(path) / 1024:.1f}KB")
+        for label, max_edge, image_format, quality in variants:
+            rounds = 5
+            start = time.perf_counter()
+            for _ in range(rounds):
+                if image_format is None:
+                    with open(path, "rb") as f:
+                        payload = base64.b64encode(f.read())
+                    with Image.open(path) as image:
+                        size = image.size
+                else:
+                    prepared = prepare_image(path, max_edge, image_format, quality)
+                    payload, size = base64.b64encode(prepared.data), prepared.size
+            elapsed_ms = (time.perf_counter() - start) / rounds * 1000
+            print(f"  [{label}] 上传{len(payload) / 1024:.1f}KB 尺寸{size[0]}x{size[1]} "
+                  f"约{estimate_image_tokens(size)}图片token 处理耗时{elapsed_ms:.1f}ms")
@@ -0,0 +1,393 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+悬浮球(UI)与Agent主循环之间的本地消息通道
+1. 主通道：回环地址TCP socket，4字节长度前缀 + JSON 帧，请求与响应通过 request_id 关联
+2. 备用通道：data 目录下追加写入的请求队列和响应日志（JSONL，带序号和校验和），socket 不可用时自动回退
+3. UI 可发送 {"type": "cancel", "request_id": ...} 取消排队中或正在处理的请求，不经过请求队列、立即生效
+4. python ipc_channel.py 可测量两种通道的 UI->Agent 往返延迟
+"""
+import asyncio
+import contextlib
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+from file_watcher import FileWatcher, file_signature
+from sealed_file import SealedLog
+from tracing import tracer
+
+IPC_HOST = "127.0.0.1"
+IPC_PORT = int(os.getenv("OPEN_ASSISTANT_IPC_PORT", "9001"))
+# socket: 优先socket，失败回退文件；file: 只使用文件通道
+IPC_TRANSPORT = os.getenv("OPEN_ASSISTANT_IPC_TRANSPORT", "socket")
+# 文件通道的监听方式：auto / inotify / poll
+FILE_WATCH_MODE = os.getenv("OPEN_ASSISTANT_FILE_WATCH_MODE", "auto")
+
+# 文件备用通道的路径：请求队列与响应日志，均按request_id关联
+REQUEST_QUEUE_FILE = "data/request_queue.jsonl"
+RESPONSE_LOG_FILE = "data/response_log.jsonl"
+
+FRAME_HEADER = struct.Struct(">I")
+_NO_SPAN = contextlib.nullcontext()
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def encode_frame(message):
+    """将消息编码为 长度前缀 + UTF-8 JSON 的帧"""
+    body = json.dumps(message, ensure_ascii=False).encode("utf-8")
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+def _recv_exact(sock, size):
+    """从阻塞socket中读取固定长度的数据，连接关闭时返回None"""
+    buffer = b""
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            return None
+        buffer += chunk
+    return buffer
+
+
+def read_frame(sock):
+    """同步读取一帧，连接关闭时返回None"""
+    header = _recv_exact(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    (size,) = FRAME_HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise ValueError(f"消息帧过大: {size} 字节")
+    body = _recv_exact(sock, size)
+    if body is None:
+        return None
+    return json.loads(body.decode("utf-8"))
+
+
+async def read_frame_async(reader):
+    """异步读取一帧，连接关闭时返回None"""
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+        (size,) = FRAME_HEADER.unpack(header)
+        if size > MAX_FRAME_SIZE:
+            raise ValueError(f"消息帧过大: {size} 字节")
+        body = await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        return None
+    return json.loads(body.decode("utf-8"))
+
+
+def _ensure_parent_dir(path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+
+class AgentChannel:
+    """
+    Agent端的消息通道
+    同时监听socket和请求队列文件，所有请求进入同一个asyncio.Queue，
+    响应按request_id原路返回（socket连接或响应日志文件）
+    """
+
+    def __init__(self, transport=IPC_TRANSPORT, host=IPC_HOST, port=IPC_PORT,
+                 request_file=REQUEST_QUEUE_FILE, response_file=RESPONSE_LOG_FILE, watch_mode=FILE_WATCH_MODE,
+                 poll_interval=0.05, max_poll_interval=1.0):
+        self.transport = transport
+        self.host = host
+        self.port = port
+        self.request_file = request_file
+        self.response_file = response_file
+        self.watch_mode = watch_mode
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+
+        self.requests = asyncio.Queue()
+        self._routes = {}  # request_id -> StreamWriter，文件来源的请求不在此表中
+        self._request_log = SealedLog(request_file)
+        self._response_log = SealedLog(response_file)
+        self._server = None
+        self._file_task = None
+        self._outstanding = set()  # 已入队、还没有发出最终响应的 request_id
+        self._cancelled = set()  # 已取消、还未出队或还未处理完的 request_id（是 _outstanding 的子集）
+        self.on_cancel = None  # on_cancel(request_id, reason)：取消正在处理的请求
+
+    async def start(self):
+        """启动socket服务和文件监听"""
+        if self.transport == "socket":
+            try:
+                self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+                print(f"IPC通道已启动: {self.host}:{self.port}")
+            except OSError as e:
+                print(f"IPC socket启动失败，回退到文件通道: {e}")
+                self._server = None
+        self._file_task = asyncio.create_task(self._watch_request_file())
+
+    async def close(self):
+        if self._file_task:
+            self._file_task.cancel()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def receive(self):
+        """等待下一条请求"""
+        return await self.requests.get()
+
+    async def send(self, message):
+        """按request_id将消息发回请求来源"""
+        request_id = message.get("request_id", "")
+        message.setdefault("type", "response")
+        writer = self._routes.get(request_id)
+        if message["type"] in ("response", "cancelled"):
+            self._routes.pop(request_id, None)
+            self._outstanding.discard(request_id)
+            self._cancelled.discard(request_id)
+
+        # 流式增量太多，只追踪最终响应的写出
+        traced = message["type"] == "response"
+        if writer is not None and not writer.is_closing():
+            try:
+                with tracer.span("ipc_send") if traced else _NO_SPAN:
+                    writer.write(encode_frame(message))
+                    await writer.drain()
+                return
+            except (ConnectionError, OSError) as e:
+                print(f"IPC socket发送失败，改写响应日志文件: {e}")
+
+        with tracer.span("file_write") if traced else _NO_SPAN:
+            self._response_log.append(message)
+
+    def is_cancelled(self, request_id):
+        return request_id in self._cancelled
+
+    def _dispatch(self, message):
+        """取消消息立即处理，其余的请求按顺序入队"""
+        if message.get("type", "request") == "cancel":
+            request_id = message.get("request_id", "")
+            if request_id not in self._outstanding:
+                # 响应已经发出（取消与响应在路上交错），不记录，避免 _cancelled 只增不减
+                print(f"[IPC] 忽略已完成请求的取消: {request_id}")
+                return
+            self._cancelled.add(request_id)
+            print(f"[IPC] 收到取消请求: {request_id}（{message.get('reason', '')}）")
+            if self.on_cancel is not None:
+                self.on_cancel(request_id, message.get("reason", ""))
+            return
+        message["received_at"] = time.time()
+        self._outstanding.add(message.get("request_id", ""))
+        self.requests.put_nowait(message)
+
+    async def _handle_connection(self, reader, writer):
+        print("悬浮球已通过IPC socket连接")
+        try:
+            while True:
+                message = await read_frame_async(reader)
+                if message is None:
+                    break
+                if message.get("type", "request") == "request":
+                    self._routes[message.get("request_id", "")] = writer
+                self._dispatch(message)
+        except (ConnectionError, ValueError) as e:
+            print(f"IPC连接出错: {e}")
+        finally:
+            for request_id in [rid for rid, w in self._routes.items() if w is writer]:
+                self._routes.pop(request_id, None)
+            writer.close()
+
+    async def _watch_request_file(self):
+        """文件备用通道：挂起等待请求队列文件变化（inotify或带退避的stat轮询）"""
+        _ensure_parent_dir(self.request_file)
+        watcher = FileWatcher(self.request_file, mode=self.watch_mode,
+                              poll_interval=self.poll_interval, max_poll_interval=self.max_poll_interval)
+        print(f"文件通道监听方式: {watcher.mode}")
+        try:
+            while True:
+                await watcher.wait()
+                # 只会读到完整的新记录，同时排队的多条请求按顺序入队
+                for input_data in self._request_log.read_new():
+                    print(f"[调试] 从{self.request_file}读取消息: {input_data.get('content', '')}")
+                    self._dispatch(input_data)
+        finally:
+            watcher.close()
+
+
+class UIChannelClient:
+    """
+    UI端的消息通道，运行在后台线程中
+    优先连接Agent的socket，连接失败时回退到读写请求队列和响应日志文件
+    """
+
+    def __init__(self, on_message, transport=IPC_TRANSPORT, host=IPC_HOST, port=IPC_PORT,
+                 request_file=REQUEST_QUEUE_FILE, response_file=RESPONSE_LOG_FILE, connect_timeout=3.0, poll_interval=0.1):
+        self.on_message = on_message
+        self.host = host
+        self.port = port
+        self.request_file = request_file
+        self.response_file = response_file
+        self.connect_timeout = connect_timeout
+        self.poll_interval = poll_interval
+
+        self.transport = transport
+        self.running = False
+        self._sock = None
+        self._send_lock = threading.Lock()
+        self._thread = None
+        self._connected = threading.Event()
+        self._request_log = SealedLog(request_file)
+        self._response_log = SealedLog(response_file)
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        if self._sock:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        if self._thread:
+            self._thread.join(timeout=1.0)
+
+    def wait_ready(self, timeout=None):
+        """等待通道确定使用的传输方式"""
+        return self._connected.wait(timeout)
+
+    def send(self, message):
+        """发送消息，socket不可用时追加到请求队列文件"""
+        message.setdefault("type", "request")
+        if self._sock is not None:
+            try:
+                with self._send_lock:
+                    self._sock.sendall(encode_frame(message))
+                return True
+            except OSError as e:
+                print(f"IPC socket发送失败，改写请求队列文件: {e}")
+                self._sock = None
+                self.transport = "file"
+        try:
+            self._request_log.append(message)
+            return True
+        except Exception as e:
+            print(f"写入请求队列文件失败: {e}")
+            return False
+
+    def _connect(self):
+        deadline = time.time() + self.connect_timeout
+        while self.running and time.time() < deadline:
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=1.0)
+                sock.settimeout(None)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                return sock
+            except OSError:
+                time.sleep(0.1)
+        return None
+
+    def _run(self):
+        if self.transport == "socket":
+            self._sock = self._connect()
+        if self._sock is None:
+            print("IPC socket不可用，使用文件通道")
+            self.transport = "file"
+            self._connected.set()
+            self._poll_response_file()
+            return
+
+        print(f"已连接IPC通道: {self.host}:{self.port}")
+        self._connected.set()
+        try:
+            while self.running:
+                message = read_frame(self._sock)
+                if message is None:
+                    break
+                try:
+                    self.on_message(message)
+                except Exception as e:
+                    # 回调出错只影响这一条消息，不能让读取线程退出
+                    print(f"处理IPC消息时出错: {e}")
+        except (OSError, ValueError) as e:
+            if self.running:
+                print(f"IPC连接中断: {e}")
+        self._sock = None
+        if self.running:
+            print("IPC连接已断开，回退到文件通道")
+            self.transport = "file"
+            self._poll_response_file()
+
+    def _poll_response_file(self):
+        last_signature = file_signature(self.response_file)
+        while self.running:
+            try:
+                signature = file_signature(self.response_file)
+                if signature is not None and signature != last_signature:
+                    last_signature = signature
+                    for data in self._response_log.read_new():
+                        self.on_message(data)
+            except Exception as e:
+                print(f"监听响应时出错: {e}")
+            # 短暂休眠，减少CPU占用
+            time.sleep(self.poll_interval)
+
+
+def _benchmark_round_trip(transport, rounds=50):
+    """启动一个回显Agent，测量UI->Agent->UI的往返延迟（毫秒）"""
+    import tempfile
+    import statistics
+
+    temp_dir = tempfile.mkdtemp()
+    request_file = os.path.join(temp_dir, "request_queue.jsonl")
+    response_file = os.path.join(temp_dir, "response_log.jsonl")
+    port = IPC_PORT + 100
+    loop = asyncio.new_event_loop()
+    channel = AgentChannel(transport, port=port, request_file=request_file, response_file=response_file)
+
+    async def echo_agent():
+        await channel.start()
+        while True:
+            request = await channel.receive()
+            await channel.send({"request_id": request["request_id"], "content": request["content"],
+                                "timestamp": time.time()})
+
+    threading.Thread(target=loop.run_until_complete, args=(echo_agent(),), daemon=True).start()
+
+    received = {}
+    arrived = threading.Event()
+
+    def on_message(message):
+        received[message.get("request_id")] = time.perf_counter()
+        arrived.set()
+
+    client = UIChannelClient(on_message, transport, port=port, request_file=request_file, response_file=response_file)
+    time.sleep(0.2)
+    client.start()
+    client.wait_ready(5)
+
+    latencies = []
+    for i in range(rounds):
+        request_id = f"bench-{i}"
+        arrived.clear()
+        start = time.perf_counter()
+        client.send({"request_id": request_id, "content": "ping", "timestamp": time.time()})
+        while request_id not in received and arrived.wait(5):
+            arrived.clear()
+        if request_id in received:
+            latencies.append((received[request_id] - start) * 1000)
+    client.stop()
+
+    latencies.sort()
+    print(f"[{client.transport}] 往返 {len(latencies)}/{rounds} 次, "
+          f"p50={statistics.median(latencies):.2f}ms, p95={latencies[int(len(latencies) * 0.95) - 1]:.2f}ms")
+
+
+if __name__ == '__main__':
+    _benchmark_round_trip("socket")
+    _benchmark_round_trip("file")
@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+进程内共享的模型客户端
+1. 原来 summarize_write_ai、agent_vision 每次调用都新建一个 OpenAI 客户端，连接池随之丢弃，每次都要重新建立TCP连接和TLS握手
+2. 这里按需创建一个同步客户端和（每个事件循环）一个异步客户端，所有模块共用，连接池大小和超时可配置
+3. 通过 httpcore 的 trace 扩展统计新建连接数、TLS握手次数与耗时，得到连接复用率
+4. 客户端 max_retries=0：重试、截止时间和对冲由 resilient_llm 统一处理
+5. python llm_clients.py 会对本地HTTPS桩服务器对比 每次新建客户端 与 共享客户端 的单次调用延迟
+"""
+import asyncio
+import os
+import threading
+import time
+import weakref
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+# 模型服务地址，可通过环境变量指向本地桩服务器（见 mock_llm_server.py）
+LLM_BASE_URL = os.getenv("OPEN_ASSISTANT_LLM_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
+# 连接池的大小与超时
+LLM_MAX_CONNECTIONS = int(os.getenv("OPEN_ASSISTANT_LLM_MAX_CONNECTIONS", "20"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPEN_ASSISTANT_LLM_MAX_KEEPALIVE", "10"))
+LLM_KEEPALIVE_EXPIRY = 60.0
+LLM_TIMEOUT = httpx.Timeout(float(os.getenv("OPEN_ASSISTANT_LLM_TIMEOUT", "120")), connect=10.0)
+
+
+class ConnectionStats:
+    """请求数、新建连接数和TLS握手次数；复用率 = 1 - 新建连接数 / 请求数"""
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.tls_handshakes = 0
+        self.connect_ms = 0.0  # 建立TCP连接与TLS握手的累计耗时
+        self._lock = threading.Lock()
+
+    def on_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def on_event(self, name, elapsed_ms):
+        with self._lock:
+            if name == "connection.connect_tcp.complete":
+                self.connections += 1
+            elif name == "connection.start_tls.complete":
+                self.tls_handshakes += 1
+            self.connect_ms += elapsed_ms
+
+    @property
+    def reuse_rate(self):
+        return 1 - self.connections / self.requests if self.requests else 0.0
+
+    def summary(self):
+        return (f"请求{self.requests}次 新建连接{self.connections}次 TLS握手{self.tls_handshakes}次 "
+                f"连接复用率{self.reuse_rate:.0%} 建连累计耗时{self.connect_ms:.0f}ms")
+
+
+def _tracer(stats):
+    """每个请求一个 trace 回调，记录建连和握手阶段的耗时"""
+    started = {}
+
+    def trace(name, info):
+        if name.startswith(("connection.connect_tcp.", "connection.start_tls.")):
+            stage = name.rsplit(".", 1)[0]
+            if name.endswith(".started"):
+                started[stage] = time.perf_counter()
+            elif name.endswith(".complete"):
+                stats.on_event(name, (time.perf_counter() - started.pop(stage, time.perf_counter())) * 1000)
+
+    return trace
+
+
+class ClientRegistry:
+    """
+    sync_client() 返回共享的 OpenAI 客户端（线程安全，可在工具函数的线程中使用）
+    async_client() 返回当前事件循环共享的 AsyncOpenAI 客户端（连接绑定在事件循环上，不能跨循环共用）
+    """
+
+    def __init__(self, base_url=LLM_BASE_URL, api_key=None, max_connections=LLM_MAX_CONNECTIONS,
+                 max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS, timeout=LLM_TIMEOUT, verify=True,
+                 stats=None):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive_connections,
+                                   keepalive_expiry=LLM_KEEPALIVE_EXPIRY)
+        self.timeout = timeout
+        self.verify = verify
+        self.stats = stats or ConnectionStats()
+        self._sync_client = None
+        self._async_clients = weakref.WeakKeyDictionary()  # 事件循环 -> AsyncOpenAI
+        self._lock = threading.Lock()
+
+    def _api_key(self):
+        # 创建时才读取，setup_api_keys()/load_dotenv() 之后导入的模块也能拿到密钥
+        # 若没有配置环境变量，请用阿里云百炼API Key将下行替换为：api_key="sk-xxx"
+        return self.api_key or os.getenv("ALIBABA_CLOUD_ACCESS_KEY_ID")
+
+    def sync_client(self):
+        with self._lock:
+            if self._sync_client is None:
+                stats = self.stats
+
+                def on_request(request):
+                    stats.on_request()
+                    request.extensions["trace"] = _tracer(stats)
+
+                http_client = httpx.Client(limits=self.limits, timeout=self.timeout, verify=self.verify,
+                                           event_hooks={"request": [on_request]})
+                self._sync_client = OpenAI(api_key=self._api_key(), base_url=self.base_url,
+                                           http_client=http_client, max_retries=0)
+            return self._sync_client
+
+    def async_client(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 不在事件循环中创建时不缓存：连接会绑定到之后第一次使用它的事件循环
+            return self._new_async_client()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = self._new_async_client()
+                self._async_clients[loop] = client
+            return client
+
+    def _new_async_client(self):
+        stats = self.stats
+
+        async def on_request(request):
+            stats.on_request()
+            trace = _tracer(stats)
+
+            async def async_trace(name, info):
+                trace(name, info)
+
+            request.extensions["trace"] = async_trace
+
+        http_client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout, verify=self.verify,
+                                        event_hooks={"request": [on_request]})
+        return AsyncOpenAI(api_key=self._api_key(), base_url=self.base_url, http_client=http_client, max_retries=0)
+
+    def close(self):
+        with self._lock:
+            if self._sync_client is not None:
+                self._sync_client.close()
+                self._sync_client = None
+
+    async def aclose(self):
+        client = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
+
+
+registry = ClientRegistry()
+
+
+def get_client():
+    """共享的同步客户端"""
+    return registry.sync_client()
+
+
+def get_async_client():
+    """当前事件循环共享的异步客户端"""
+    return registry.async_client()
+
+
+def _make_certificate(directory):
+    """为桩服务器生成 127.0.0.1 的自签名证书，返回 (证书, 私钥) 路径"""
+    import datetime
+    import ipaddress
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(minutes=1))
+                   .not_valid_after(now + datetime.timedelta(days=1))
+                   .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]),
+                                  critical=False)
+                   .sign(key, hashes.SHA256()))
+    cert_path = os.path.join(directory, "stub.crt")
+    key_path = os.path.join(directory, "stub.key")
+    with open(cert_path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+def _benchmark(rounds=100):
+    """对本地HTTPS桩服务器测量单次调用延迟：每次新建客户端（修改前） vs 共享客户端"""
+    import ssl
+    import statistics
+    import tempfile
+    from mock_llm_server import MockLLMServer
+
+    cert_path, key_path = _make_certificate(tempfile.mkdtemp())
+    server = MockLLMServer(reply="好的。", certfile=cert_path, keyfile=key_path).start()
+    verify = ssl.create_default_context(cafile=cert_path)
+    messages = [{"role": "user", "content": "你好"}]
+
+    def measure(label, call, stats):
+        latencies = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            call()
+            latencies.append((time.perf_counter() - start) * 1000)
+        latencies.sort()
+        print(f"[{label}] p50={statistics.median(latencies):.2f}ms "
+              f"p95={latencies[int(len(latencies) * 0.95) - 1]:.2f}ms 平均={statistics.mean(latencies):.2f}ms  "
+              f"{stats.summary()}")
+
+    # 修改前：每次调用都新建客户端（新的连接池），调用完即丢弃
+    fresh_stats = ConnectionStats()
+
+    def call_with_new_client():
+        fresh = ClientRegistry(base_url=server.base_url, api_key="mock", verify=verify, stats=fresh_stats)
+        fresh.sync_client().chat.completions.create(model="mock", messages=messages)
+        fresh.close()
+
+    measure("每次新建客户端(修改前)", call_with_new_client, fresh_stats)
+
+    shared = ClientRegistry(base_url=server.base_url, api_key="mock", verify=verify)
+    measure("共享客户端", lambda: shared.sync_client().chat.completions.create(model="mock", messages=messages),
+            shared.stats)
+    shared.close()
+    server.stop()
+
+
+if __name__ == '__main__':
+    _benchmark()
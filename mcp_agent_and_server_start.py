@@ -3,49 +3,73 @@
 
 import json
 import asyncio
+import contextlib
 import os
 import time
 from typing import List, Dict
-from datetime import datetime
+from types import SimpleNamespace
 import threading
-import base64
 
-from openai import OpenAI
-from fastmcp import Client
-
-import json
-import re
+from mcp_session import PersistentMCPSession
+from agent_engine import AgentEngine, CancelToken, RequestCancelled
+from prompt_template import SystemPrompt, format_context, with_context
+from response_cache import ResponseCache, RESPONSE_CACHE_ENABLED
+from image_preprocess import encode_image_for_vision
+from vision_cache import VisionCache, VISION_CACHE_ENABLED
+from image_router import ImageRouter, OCR_FAST_PATH_ENABLED
+from tool_selector import ToolIndex, StickyToolSelection
+from conversation_memory import ConversationMemory, build_summary_request, SUMMARY_MAX_TOKENS, count_tokens
+from model_router import ModelRouter, MODEL_ROUTER_ENABLED
+from tracing import tracer
+from resilient_llm import llm_caller, DeadlineExceeded, LLM_STREAM_IDLE_TIMEOUT
+from llm_clients import get_async_client
 from dotenv import load_dotenv
-import random
-from get_active_window import get_activate_path2, get_activate_path
-
-import time
-import json
-import os
-import threading
-import queue
-import os
-
-# 用于控制悬浮球输入框禁用状态的标志文件路径
-INPUT_DISABLE_FLAG = "data/input_disabled.flag"
+from context_provider import ContextProvider
+
+# Agent连接MCP服务器的方式：inprocess 直接连接同进程内的 server.mcp 对象（内存传输，省去HTTP）；
+# http 通过 http://localhost:9000/mcp 连接。两种方式下HTTP服务都会启动，供外部客户端使用
+MCP_TRANSPORT = os.getenv("OPEN_ASSISTANT_MCP_TRANSPORT", "inprocess")
+MCP_HTTP_URL = "http://localhost:9000/mcp"
+
+# 未指定模型且关闭模型路由时使用的模型
+DEFAULT_MODEL = "qwen-plus"
+# 压缩较早对话时生成摘要所用的模型
+MEMORY_SUMMARY_MODEL = os.getenv("OPEN_ASSISTANT_MEMORY_SUMMARY_MODEL", "qwen-flash")
+
+# 单次请求的预算：模型调用步数上限、墙钟截止时间（需小于loop()中的120秒超时）、累计token上限
+AGENT_MAX_STEPS = int(os.getenv("OPEN_ASSISTANT_AGENT_MAX_STEPS", "6"))
+AGENT_DEADLINE_SECONDS = float(os.getenv("OPEN_ASSISTANT_AGENT_DEADLINE", "110"))
+AGENT_TOKEN_BUDGET = int(os.getenv("OPEN_ASSISTANT_AGENT_TOKEN_BUDGET", "30000"))
+
+# 同一轮的多个工具调用并发执行；需要操作键盘、鼠标、剪贴板或前台窗口的工具，同一时刻只允许运行一个。
+# 其他工具不单独限流：max_tool_calls 使每个工具在一个请求中最多调用一次，请求又是逐条处理的
+GUI_TOOLS = {
+    "read_and_summary_webpage",
+    "identify_current_screen_save_img_and_get_response",
+    "explain_code",
+    "get_text_content",
+    "control_iflow_agent",
+    "change_word_file",
+    "change_excel_file",
+    "read_ppt",
+    "read_pdf",
+    "control_web",
+    "open_app",
+    "open_netease_music_server",
+    "control_netease",
+    "gesture_control",
+    "stop_gesture_control",
+    "get_clipboard_content",
+    "execute_system_shortcut",
+    "create_folders_in_active_directory",
+    "open_other_apps",
+}
 
 
-# REQUEST_ID = "0"
-LAST_TIME = 0
-
-# 新增函数：将图片编码为base64
-def encode_image(image_path):
-    """将图片编码为base64格式"""
-    try:
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
-    except Exception as e:
-        print(f"图片编码出错: {str(e)}")
-        return None
-
 # 新增导入
-from server import mcp
-from float_ball_line import launch_assistant_avatar
+# server（各工具依赖的桌面自动化库）和 float_ball_line（PyQt界面）在启动服务时才导入，
+# 离线回放（replay.py）只导入 AgentServiceHost，不需要Windows桌面环境
+from ipc_channel import AgentChannel
 
 # global keybord_content
 #
@@ -99,26 +123,64 @@ def setup_api_keys():
     if args.update_keys or not ali_key or not metaso_key:
         prompt_for_keys()
 
-# Setup API keys before loading them
-setup_api_keys()
 load_dotenv()  # Load the .env file for the rest of the application
 
 class AgentServiceHost:
-    def __init__(self, script: str, model="qwen-plus", max_tool_calls=1):
+    def __init__(self, script, model=None, max_tool_calls=1, channel=None, context_provider=None):
         self.script = script
-        self.model = model
+        self.channel = channel  # 与悬浮球通信的消息通道（AgentChannel）
+        # 指定 model 时始终使用该模型；不指定时由 model_router 按请求选择，路由关闭时使用 DEFAULT_MODEL
+        self.model = model or DEFAULT_MODEL
         self.max_tool_calls = max_tool_calls  # 每个工具的最大调用次数
 
-        self.client = OpenAI(
-            # 若没有配置环境变量，请用阿里云百炼API Key将下行替换为：api_key="sk-xxx",
-            api_key=os.getenv("ALIBABA_CLOUD_ACCESS_KEY_ID"),
-            base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-        )
+        # 异步客户端：与 summarize_write_ai、agent_vision 共用 llm_clients 中的连接池配置，超时后请求会被真正取消
+        self.client = get_async_client()
 
-        self.session = Client(script)
+        # 常驻的MCP会话：只握手一次，自动保活和重连
+        self.session = PersistentMCPSession(script)
         self.tools = []
+        self.tool_index = None
+        self.tool_selection = None
+        self.tool_selection_epoch = 0
+        # 本地回复缓存，默认关闭（OPEN_ASSISTANT_RESPONSE_CACHE=1 开启）
+        self.response_cache = ResponseCache() if RESPONSE_CACHE_ENABLED else None
+        # 视觉分析结果的缓存（按图片感知哈希 + 问题类别）
+        self.vision_cache = VisionCache() if VISION_CACHE_ENABLED else None
+        # 纯文字截图走本地OCR的快速路径（OPEN_ASSISTANT_OCR_FAST_PATH=0 关闭）
+        self.image_router = ImageRouter() if OCR_FAST_PATH_ENABLED else None
+        self.prompt_cache_stats = {"prompt_tokens": 0, "cached_tokens": 0}  # 服务端前缀缓存的累计命中情况
         self.tool_call_count = {}  # 记录每个工具的调用次数
-        self.chat_history = []  # 新增：用于存储对话历史
+        self.gui_semaphore = asyncio.Semaphore(1)  # GUI_TOOLS 共用的名额
+        self.memory = ConversationMemory(self.summarize_history)  # 对话历史，按token预算管理
+        self.system_prompt = SystemPrompt()  # 缓存的系统提示词
+        # 按请求复杂度在 flash/plus 之间选择模型（OPEN_ASSISTANT_MODEL_ROUTER=0 或指定了 model 时不路由）
+        self.model_router = ModelRouter() if MODEL_ROUTER_ENABLED and model is None else None
+        # 活跃窗口/文件路径的后台采样（非Windows环境使用桩）
+        self.context_provider = context_provider or ContextProvider()
+        # 正在处理的请求：request_id -> CancelToken，收到悬浮球的取消消息时据此中断
+        self.active_requests = {}
+        if channel is not None:
+            channel.on_cancel = self.cancel_request
+
+    def cancel_request(self, request_id, reason=""):
+        """取消正在处理的请求：中断模型流式输出和工具调用（尚未出队的请求在出队时跳过）"""
+        token = self.active_requests.get(request_id)
+        if token is not None:
+            print(f"[取消] 中断请求 {request_id}（{reason or '未说明原因'}）")
+            token.cancel(reason)
+
+    async def summarize_history(self, previous_summary, messages):
+        """用轻量模型把较早的对话压缩为摘要（供 ConversationMemory 在后台调用）"""
+        request = build_summary_request(previous_summary, messages)
+        response = await llm_caller.call_async(
+            lambda timeout: self.client.chat.completions.create(
+                model=MEMORY_SUMMARY_MODEL,
+                messages=request,
+                max_tokens=SUMMARY_MAX_TOKENS,
+                timeout=timeout,
+            ),
+            key=MEMORY_SUMMARY_MODEL)
+        return response.choices[0].message.content
 
     def read_ai_setting_file(file_path="ai_setting.txt"):
         """
@@ -147,25 +209,135 @@ class AgentServiceHost:
             }
             for tool in tools
         ]
-
-    async def chat(self, messages: List[Dict], tool_call_path=None, image_path=None):
-        if tool_call_path is None:
-            tool_call_path = []  # 记录调用路径，防止重复调用
-
-        if not self.tools:
+        # 按工具名和描述建立检索索引；默认发送全部工具（提示词开头的工具定义逐字节不变），
+        # 设置 OPEN_ASSISTANT_TOOL_TOP_K 后只发送相关的工具，同一段对话中只增不减
+        self.tool_index = ToolIndex(self.tools)
+        self.tool_selection = StickyToolSelection(self.tool_index)
+        if self.model_router is not None:
+            self.model_router.tool_index = self.tool_index
+
+    async def _stream_completion(self, on_delta=None, **kwargs):
+        """
+        以流式方式调用模型，每收到一段文本就 await on_delta(text)
+        返回拼装好的完整结果：message（含content和tool_calls）、finish_reason、usage
+        截止时间、重试和对冲只作用于收到首个分片之前：可重试的错误按退避重试，开启对冲时先收到首个分片的请求胜出，
+        另一个被取消；之后只检查分片之间的空闲时间（LLM_STREAM_IDLE_TIMEOUT），长回答不会因总耗时被中途截断
+        """
+        async def attempt(timeout):
+            started = time.perf_counter()
+            stream = await self.client.chat.completions.create(
+                stream=True,
+                stream_options={"include_usage": True},
+                timeout=timeout,
+                **kwargs
+            )
+            try:
+                first_chunk = await stream.__anext__()
+            except StopAsyncIteration:
+                first_chunk = None
+            except BaseException:
+                # 失败或被取消（超时、对冲落败）时关闭流，释放底层连接
+                await stream.close()
+                raise
+            # 首个分片的耗时（文本或工具调用），与回答长短无关，供模型路由判断模型是否变慢
+            return stream, first_chunk, (time.perf_counter() - started) * 1000
+
+        async def discard(opened):
+            await opened[0].close()
+
+        stream, first_chunk, first_chunk_ms = await llm_caller.call_async(
+            attempt, key=kwargs.get("model", ""), discard=discard)
+        result = await self._consume_stream(stream, on_delta, first_chunk)
+        result.first_chunk_ms = first_chunk_ms
+        return result
+
+    @staticmethod
+    async def _chunks(stream, first_chunk, idle_timeout):
+        """依次产出首个分片和之后的分片；超过 idle_timeout 秒没有新分片时抛出 DeadlineExceeded"""
+        if first_chunk is None:
+            return
+        yield first_chunk
+        while True:
+            try:
+                chunk = await asyncio.wait_for(stream.__anext__(), timeout=idle_timeout)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded(f"流式响应超过{idle_timeout:g}秒没有新的分片") from None
+            yield chunk
+
+    async def _consume_stream(self, stream, on_delta, first_chunk, idle_timeout=LLM_STREAM_IDLE_TIMEOUT):
+        """读取流式响应（从已经收到的首个分片开始）并拼装结果"""
+        content_parts = []
+        tool_calls = {}  # index -> 逐段拼接的工具调用
+        finish_reason = None
+        usage = None
+        # 被取消（超时）时关闭流，释放底层连接
+        async with stream:
+            async for chunk in self._chunks(stream, first_chunk, idle_timeout):
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                delta = choice.delta
+                if delta.content:
+                    content_parts.append(delta.content)
+                    if on_delta:
+                        await on_delta(delta.content)
+                for tool_call in delta.tool_calls or []:
+                    entry = tool_calls.setdefault(tool_call.index, {"id": "", "name": "", "arguments": ""})
+                    if tool_call.id:
+                        entry["id"] = tool_call.id
+                    if tool_call.function and tool_call.function.name:
+                        entry["name"] += tool_call.function.name
+                    if tool_call.function and tool_call.function.arguments:
+                        entry["arguments"] += tool_call.function.arguments
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+
+        message = SimpleNamespace(
+            role="assistant",
+            content="".join(content_parts) or None,
+            tool_calls=[
+                SimpleNamespace(
+                    id=entry["id"],
+                    type="function",
+                    function=SimpleNamespace(name=entry["name"], arguments=entry["arguments"] or "{}")
+                )
+                for _, entry in sorted(tool_calls.items())
+            ] or None
+        )
+        self._log_prompt_cache(usage)
+        return SimpleNamespace(message=message, finish_reason=finish_reason, usage=usage)
+
+    def _log_prompt_cache(self, usage):
+        """记录服务端前缀缓存命中的提示词token（usage.prompt_tokens_details.cached_tokens）"""
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+        prompt = usage.prompt_tokens or 0
+        self.prompt_cache_stats["prompt_tokens"] += prompt
+        self.prompt_cache_stats["cached_tokens"] += cached
+        total_prompt = self.prompt_cache_stats["prompt_tokens"]
+        total_cached = self.prompt_cache_stats["cached_tokens"]
+        print(f"[缓存] 提示词{prompt}token，命中{cached}token，未命中{prompt - cached}token；"
+              f"累计命中率{total_cached / total_prompt:.0%}" if total_prompt else "[缓存] 无提示词token统计")
+
+    async def chat(self, messages: List[Dict], image_path=None, on_delta=None, tool_query=None, cancel_token=None):
+        # 工具列表只在首次使用或服务端通知变化后重新拉取
+        if not self.tools or self.session.tools_changed:
             await self.prepare_tools()
 
-        content2 = None
-        with open("ai_setting.txt", 'r', encoding='utf-8') as file:
-            # 读取文件内容
-            content2 = file.read()
+        # 按用户问题挑选相关的工具（默认以最后一条用户消息检索）
+        if tool_query is None:
+            tool_query = next((m.get("content") for m in reversed(messages) if m.get("role") == "user"), "")
+        tools = self.tool_selection.select(tool_query if isinstance(tool_query, str) else "")
+        print(f"[工具] 本次发送{len(tools)}/{len(self.tools)}个工具: {[t['function']['name'] for t in tools]}")
 
-        # 添加系统消息
-        system_message = {
-            "role": "system",
-            "content": "你是 Open Assistant，一个桌面AI助手。你的首要任务是使用工具来准确地完成用户请求。当用户的指令涉及文件操作、系统控制或网络请求时，必须调用相应的工具。绝不允许自行编造操作结果。在工具调用完成后，你必须根据工具返回的真实结果进行回复。回答要简短有力。"+content2
-        }
-        #print(system_message)
+        # 预先构建好的系统消息（ai_setting.txt 变化时自动重新加载）
+        system_message = self.system_prompt.message()
 
         # 确保系统消息在消息列表的开头
         if messages and messages[0].get("role") != "system":
@@ -178,46 +350,84 @@ class AgentServiceHost:
             # 第一步：使用多模态模型分析图片
             vision_model = "qwen3-vl-flash"
             
-            # 编码图片
-            base64_image = encode_image(image_path)
-            if base64_image:
+            # 同一张图（按感知哈希判断）、同一类问题的追问直接复用之前的分析结果，跳过视觉模型
+            vision_key = None
+            image_analysis = None
+            if self.vision_cache is not None:
+                try:
+                    with tracer.span("vision_cache") as cache_span:
+                        vision_key = await asyncio.to_thread(self.vision_cache.make_key, image_path,
+                                                               tool_query if isinstance(tool_query, str) else "")
+                        image_analysis = self.vision_cache.get(vision_key)
+                        cache_span.set(hit=image_analysis is not None)
+                except Exception as e:
+                    print(f"[视觉缓存] 计算图片指纹出错: {e}")
+
+            # 纯文字的截图直接用本地OCR的结果，跳过视觉模型；图表、照片仍交给视觉模型
+            if image_analysis is None and self.image_router is not None:
+                with tracer.span("image_route") as route_span:
+                    route, ocr_text = await asyncio.to_thread(self.image_router.route, image_path)
+                    route_span.set(route=route)
+                if route == "ocr":
+                    image_analysis = "图片中的文字（本地OCR识别）：\n" + ocr_text
+
+            # 缩小、去掉透明通道并重新编码为JPEG/WebP后再上传（在线程中处理，不阻塞事件循环）
+            image_url = None
+            if image_analysis is None:
+                with tracer.span("image_encode"):
+                    image_url = await asyncio.to_thread(encode_image_for_vision, image_path)
+            if image_analysis is not None or image_url:
                 # 保存原始消息内容
                 original_messages = messages.copy()
-                
-                # 修改用户消息以包含图片
-                for msg in messages:
-                    if msg.get("role") == "user":
-                        # 创建包含文本和图片的内容
-                        msg["content"] = [
-                            {
-                                "type": "text",
-                                "text": msg.get("content", "") + "\n你现在只需要详细描述图片内容，以标准化格式化的方式描述图片内容，比如有表格就用Markdown表格格式描述，以便文本模型进行后续可能的工具调用。"
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
+
+                if image_analysis is None:
+                    # 修改用户消息以包含图片
+                    # 只修改最后一条用户消息（本次提问），之前的历史保持不变
+                    for msg in reversed(messages):
+                        if msg.get("role") == "user":
+                            # 创建包含文本和图片的内容
+                            msg["content"] = [
+                                {
+                                    "type": "text",
+                                    "text": msg.get("content", "") + "\n你现在只需要详细描述图片内容，以标准化格式化的方式描述图片内容，比如有表格就用Markdown表格格式描述，以便文本模型进行后续可能的工具调用。"
+                                },
+                                {
+                                    "type": "image_url",
+                                    "image_url": {
+                                        "url": image_url
+                                    }
                                 }
-                            }
-                        ]
-                        break
+                            ]
+                            break
                 
-                # 使用视觉模型分析图片
-                vision_response = self.client.chat.completions.create(
-                    model=vision_model,
-                    messages=messages,
-                    max_tokens=1024,
-                )
+                    # 使用视觉模型分析图片
+                    vision_start = time.perf_counter()
+                    with tracer.span("vision", model=vision_model):
+                        vision_call = llm_caller.call_async(
+                            lambda timeout: self.client.chat.completions.create(
+                                model=vision_model,
+                                messages=messages,
+                                max_tokens=1024,
+                                timeout=timeout,
+                            ),
+                            key=vision_model)
+                        # 取消时连同进行中的HTTP请求一起中断
+                        vision_response = await (cancel_token.run(vision_call) if cancel_token else vision_call)
                 
-                # 如果需要工具调用，切换到文本模型
-                # 我们需要将视觉模型的分析结果传递给文本模型
-                image_analysis = vision_response.choices[0].message.content
-                print(f"多模态模型图片分析结果: {image_analysis}")
+                    # 如果需要工具调用，切换到文本模型
+                    # 我们需要将视觉模型的分析结果传递给文本模型
+                    image_analysis = vision_response.choices[0].message.content
+                    print(f"多模态模型图片分析结果: {image_analysis}")
+                    vision_ms = (time.perf_counter() - vision_start) * 1000
+                    if vision_key is not None:
+                        self.vision_cache.put(vision_key, image_analysis, vision_ms)
+                    if self.image_router is not None:
+                        self.image_router.record_vision(vision_ms)
                 
                 # 准备文本模型的消息，包含图片分析结果
                 text_messages = original_messages.copy()
                 # 更新用户消息，添加图片分析结果
-                for msg in text_messages:
+                for msg in reversed(text_messages):
                     if msg.get("role") == "user":
                         # 确保content是字符串格式
                         original_content = msg.get("content", "")
@@ -247,189 +457,154 @@ class AgentServiceHost:
             # 没有图片，直接使用默认模型
             model_to_use = self.model
 
-        # 创建响应（使用文本模型，支持工具调用）
-        response = self.client.chat.completions.create(
-            model=model_to_use,
-            messages=messages,
-            tools=self.tools,
-            max_tokens=1024,
-        )
+        # 按请求复杂度选择模型：闲聊和单个工具的指令用快速模型，长文本、多步骤或需要推理的请求用更大的模型
+        if self.model_router is not None:
+            prompt_tokens = count_tokens(json.dumps(messages, ensure_ascii=False)) + \
+                count_tokens(json.dumps(tools, ensure_ascii=False))
+            decision = self.model_router.route(tool_query if isinstance(tool_query, str) else "",
+                                               prompt_tokens=prompt_tokens, has_image=bool(image_path))
+            model_to_use = decision.model
+            print(f"[模型路由] {decision}")
+
+        # 显式的 模型 -> 工具 -> 模型 循环，代替原来的递归调用；步数、截止时间和token都有上限
+        tool_call_path = []  # 记录调用路径，防止重复调用
+
+        async def complete(step_messages, step_on_delta, use_tools):
+            # 以流式方式将文本增量推送给悬浮球；最后一步不提供工具，强制模型作答
+            kwargs = {"tools": tools} if use_tools else {}
+            with tracer.span("llm", model=model_to_use, tools=use_tools):
+                result = await self._stream_completion(
+                    step_on_delta,
+                    model=model_to_use,
+                    messages=step_messages,
+                    max_tokens=1024,
+                    **kwargs
+                )
+            if self.model_router is not None and result.first_chunk_ms is not None:
+                # 只记录首个分片的耗时：整步耗时随回答长度变化，长而正常的回答不应让快速模型被降级
+                self.model_router.record(model_to_use, result.first_chunk_ms)
+            return result
+
+        async def run_tools(tool_calls):
+            # 同一轮的多个工具调用并发执行，全部完成后只需一次后续模型调用
+            return await asyncio.gather(*(self._run_tool_call(tool_call, tool_call_path) for tool_call in tool_calls))
+
+        engine = AgentEngine(complete, run_tools, max_steps=AGENT_MAX_STEPS,
+                             deadline_seconds=AGENT_DEADLINE_SECONDS, token_budget=AGENT_TOKEN_BUDGET)
+        result = await engine.run(messages, on_delta, cancel_token=cancel_token)
+        print(f"[指标] {result.summary()}")
+        return result
+
+    def _tool_semaphore(self, tool_name):
+        """操作键盘鼠标的工具共用一个名额，避免互相干扰；其他工具直接执行"""
+        return self.gui_semaphore if tool_name in GUI_TOOLS else contextlib.nullcontext()
+
+    async def _run_tool_call(self, tool_call, tool_call_path):
+        """执行单个工具调用，返回写入tool消息的文本（出错时返回错误说明）"""
+        tool_name = tool_call.function.name
+
+        # 检查该工具是否已超过最大调用次数
+        if tool_name in self.tool_call_count and self.tool_call_count[tool_name] >= self.max_tool_calls:
+            return f"工具 {tool_name} 已达到最大调用次数限制 ({self.max_tool_calls}次)，无法继续调用。"
+
+        # 增加工具调用计数
+        if tool_name in self.tool_call_count:
+            self.tool_call_count[tool_name] += 1
+        else:
+            self.tool_call_count[tool_name] = 1
+
+        # 检查是否在调用路径中已经存在，防止循环调用
+        tool_call_key = f"{tool_name}_{tool_call.function.arguments}"
+        if tool_call_key in tool_call_path:
+            return f"检测到循环调用 {tool_name}，已阻止重复调用。"
 
-        if response.choices[0].finish_reason != 'tool_calls':
-            return response.choices[0].message
+        # 添加到调用路径
+        tool_call_path.append(tool_call_key)
 
         # 调用工具
-        for tool_call in response.choices[0].message.tool_calls:
-            tool_name = tool_call.function.name
-
-            # 检查该工具是否已超过最大调用次数
-            if tool_name in self.tool_call_count and self.tool_call_count[tool_name] >= self.max_tool_calls:
-                # 如果超过限制，返回错误信息给模型
-                error_message = f"工具 {tool_name} 已达到最大调用次数限制 ({self.max_tool_calls}次)，无法继续调用。"
-                messages.append({
-                    'role': 'assistant',
-                    'content': error_message
-                })
-                # 让模型基于错误信息生成回复
-                return await self.chat(messages, tool_call_path)
-
-            # 增加工具调用计数
-            if tool_name in self.tool_call_count:
-                self.tool_call_count[tool_name] += 1
-            else:
-                self.tool_call_count[tool_name] = 1
-
-            # 检查是否在调用路径中已经存在，防止循环调用
-            tool_call_id = f"{tool_name}_{tool_call.function.arguments}"
-            if tool_call_id in tool_call_path:
-                error_message = f"检测到循环调用 {tool_name}，已阻止重复调用。"
-                messages.append({
-                    'role': 'assistant',
-                    'content': error_message
-                })
-                return await self.chat(messages, tool_call_path)
-
-            # 添加到调用路径
-            tool_call_path.append(tool_call_id)
-
-            # 调用工具
-            try:
-                result = await self.session.call_tool(tool_name, json.loads(tool_call.function.arguments))
-                messages.append({
-                    'role': 'assistant',
-                    'content': result.content[0].text if result.content else "工具调用完成"
-                })
-            except Exception as e:
-                error_message = f"工具 {tool_name} 调用出错: {str(e)}"
-                messages.append({
-                    'role': 'assistant',
-                    'content': error_message
-                })
-
-            return await self.chat(messages, tool_call_path)
-
-        return response
+        try:
+            arguments = json.loads(tool_call.function.arguments or "{}")
+            # span 包含排队等待并发名额的时间
+            with tracer.span("mcp_tool", tool=tool_name):
+                async with self._tool_semaphore(tool_name):
+                    result = await self.session.call_tool(tool_name, arguments)
+            return result.content[0].text if result.content else "工具调用完成"
+        except Exception as e:
+            return f"工具 {tool_name} 调用出错: {str(e)}"
 
     async def loop(self):
-        global LAST_TIME
-        num_i = 1
-
-
-
-
-        # 用于进程间通信的文件路径
-        INPUT_FILE = "data/input_message.json"
-        OUTPUT_FILE = "data/output_message.json"
-
-        # 确保数据目录存在
-        def ensure_data_directory():
-            if not os.path.exists("data"):
-                os.makedirs("data")
-        last_input_time = 0
-
+        # 启动时开始后台采样环境信息、建立MCP会话，之后所有消息复用同一个会话
+        self.context_provider.start()
+        await self.session.start()
         while True:
-
-
-            message = None
-            screenshot_filename = None
-            input_data = None  # 重命名为input_data以避免变量名冲突
-        
-            # 检查输入文件是否存在且有更新
-            if os.path.exists(INPUT_FILE):
-                file_time = os.path.getmtime(INPUT_FILE)
-                #print(f"上次时间：{LAST_TIME} 当前时间：{time.time()}")
-                if file_time > last_input_time:
-                    # 如果if time.time()-LAST_TIME>2:就读取文件，否则就直接不读取操作
-                    if time.time()-LAST_TIME>2:
-                        # 读取输入消息
-                        try:
-                            with open(INPUT_FILE, 'r', encoding='utf-8') as f:
-                                content = f.read().strip()
-                                # 添加调试信息
-                                print(f"[调试] 从{INPUT_FILE}读取内容: {repr(content)}")
-                                if content:
-                                    try:
-                                        input_data = json.loads(content)
-                                        print(f"[调试] 成功解析JSON: {input_data.get('content', '无内容')}")
-                                    except json.JSONDecodeError as e:
-                                        print(f"[调试] JSON解析错误: {e}")
-                                        # JSON格式错误时，使用默认错误提示
-                                        default_json = '{"request_id": "1761143318.5938723", "content": "￥当前出错了，请重新输入。￥", "timestamp": 1761143318.5938723}'
-                                        input_data = json.loads(default_json)
-                                else:
-                                    print(f"[调试] {INPUT_FILE} 文件内容为空")
-                                    # 当文件为空时，检查是否有其他进程可能在频繁写入并清空
-                                    # 尝试等待一小段时间后再次读取
-                                    time.sleep(0.05)
-                                    with open(INPUT_FILE, 'r', encoding='utf-8') as f2:
-                                        retry_content = f2.read().strip()
-                                        if retry_content:
-                                            print(f"[调试] 重试读取到内容: {repr(retry_content)}")
-                                            input_data = json.loads(retry_content)
-                                        else:
-                                            # 文件确实为空时，使用默认的错误提示JSON
-                                            default_json = '{"request_id": "1761143318.5938723", "content": "￥当前出错了，请重新输入。￥", "timestamp": 1761143318.5938723}'
-                                            input_data = json.loads(default_json)
-                        except Exception as e:
-                            print(f"[调试] 读取文件时发生错误: {e}")
-                            # 发生其他错误时，使用默认错误提示
-                            current_time1 = time.time()
-                            default_json = f'{{"request_id": "{current_time1}", "content": "￥当前出错了，请重新输入。￥", "timestamp": {current_time1}}}'
-                            input_data = json.loads(default_json)
-                        
-                        # 打印接收到的消息和缩略图文件名（如果有）
-                        if input_data:  # 检查input_data是否为None
-                            message = input_data.get('content', '')
-                            screenshot_filename = input_data.get('screenshot_filename', None)
-                        else:
-                            message = ''
-                            screenshot_filename = None
-                        #print(f"消息2222: {message}")
-                        if screenshot_filename:
-                            print(f"接收到缩略图文件名: {screenshot_filename}")
-                        
-                        # 记录最后读取时间
-                        last_input_time = file_time
-                        #time.sleep(0.1)
-                    else:
-                        last_input_time = file_time
-        
-            #print("测试信息222: ", message)
-            if message and message.strip():
-                print("message: ",message)
-                print("screenshot_filename: ",screenshot_filename)
-                img_content = ""
+            # 挂起等待下一条请求（来自IPC socket或备用文件通道），连续输入的多条请求按顺序排队处理
+            input_data = await self.channel.receive()
+            message = input_data.get('content', '')
+            screenshot_filename = input_data.get('screenshot_filename', None)
+            if screenshot_filename:
+                print(f"接收到缩略图文件名: {screenshot_filename}")
+
+            # 每个请求一棵span树：根span覆盖从出队到响应发出，其中的模型调用、工具调用等自动挂在下面
+            request_id = input_data.get('request_id', '')
+            # 排队期间已被取消（用户发出了新消息或关闭了气泡）：不再处理，直接轮到下一条
+            if self.channel.is_cancelled(request_id):
+                print(f"[取消] 跳过已取消的排队请求 {request_id}")
+                await self.channel.send({'type': 'cancelled', 'request_id': request_id, 'timestamp': time.time()})
+                continue
+            with tracer.request(request_id) as request_span:
+                if message and message.strip():
+                    # 取消令牌：贯穿视觉分析、每步模型调用和MCP工具调用
+                    cancel_token = CancelToken()
+                    self.active_requests[request_id] = cancel_token
+                    print("message: ",message)
+                    print("screenshot_filename: ",screenshot_filename)
+                    img_content = ""
                                                         
-                # 只有当接收到有效信息时才执行延时和返回操作
+                    # 只有当接收到有效信息时才执行延时和返回操作
                 
-                # 重置工具调用计数器（每次用户提问时重置）
-                self.tool_call_count = {}
+                    # 重置工具调用计数器（每次用户提问时重置）
+                    self.tool_call_count = {}
+
+                    # 从输入数据中提取消息内容
+                    message_content = input_data.get('content', '')
+                    print(f"原始消息: {message_content}")
+
+                    # IPC接收：从悬浮球发出到这里出队（包含通道传输和排在前面的请求的等待时间）
+                    sent_at = input_data.get('timestamp')
+                    if isinstance(sent_at, (int, float)):
+                        dequeued_at = time.time()
+                        received_at = input_data.get('received_at', dequeued_at)
+                        tracer.record("ipc_receive", sent_at, max(dequeued_at - sent_at, 0.0) * 1000,
+                                      queued_ms=round(max(dequeued_at - received_at, 0.0) * 1000, 1))
+
+                    # 流式增量：模型每输出一段文本就推送给悬浮球，并记录首token耗时
+                    request_start = time.perf_counter()
+                    first_token_time = []
+
+                    async def on_delta(text):
+                        if not first_token_time:
+                            first_token_time.append(time.perf_counter())
+                        await self.channel.send({'type': 'delta', 'request_id': request_id, 'delta': text})
 
-                # 从输入数据中提取消息内容
-                message_content = input_data.get('content', '')
-                print(f"原始消息: {message_content}")
-
-                # 使用async with self.session上下文管理器来确保客户端连接
-                async with self.session:
                     try:
-                        # 先延时0.5秒
-                        await asyncio.sleep(0.5)
-                        current_activate_window = "当前活跃的软件为："+get_activate_path2()+"\n"
-                        if get_activate_path() == "":
-                            current_file_path = ""
-                        else:
-                            current_file_path = "当前文件路径为："+get_activate_path()+""
-                        current_time = "当前时间为："+datetime.today().strftime('%Y.%m.%d %H时%M分%S秒')+"\n"
-                        question = current_time+current_activate_window+current_file_path+ "用户问题：" + message_content
-                        
-                        # 将新问题添加到历史记录
-                        self.chat_history.append({"role": "user", "content": question})
-
-                        # 控制历史记录长度
-                        MAX_HISTORY_LEN = 10
-                        if len(self.chat_history) > MAX_HISTORY_LEN:
-                            self.chat_history = self.chat_history[-MAX_HISTORY_LEN:]
-                            
+                        # 活跃窗口和文件路径由后台线程采样，这里直接取缓存的快照，不再等待和同步调用COM/PowerShell
+                        # 时间、活跃窗口等环境信息每次都不同，只附加在本次问题的末尾、不写入历史，
+                        # 使 系统提示词+工具定义+历史消息 保持逐字节不变，服务端的前缀缓存可以命中
+                        with tracer.span("context") as context_span:
+                            snapshot = self.context_provider.snapshot()
+                            context_span.set(snapshot_age_ms=round(snapshot.age() * 1000, 1))
+                            active_window = snapshot.active_window
+                            active_file_path = snapshot.file_path
+                            context = format_context(active_window, active_file_path)
+
+                            # 将新问题添加到历史记录（按token预算管理，超出时较早的对话会被压缩为摘要）
+                            self.memory.add("user", message_content)
+                            if self.memory.compactions != self.tool_selection_epoch:
+                                # 历史被压缩后前缀本来就会变化，借机让工具集重新开始
+                                self.tool_selection_epoch = self.memory.compactions
+                                if self.tool_selection:
+                                    self.tool_selection.reset()
+
                         # 确定图片路径
                         image_path = None
                         if screenshot_filename and os.path.exists(screenshot_filename):
@@ -441,49 +616,80 @@ class AgentServiceHost:
                             if os.path.exists(test_image_path):
                                 image_path = test_image_path
                                 print(f"使用默认测试图片: {image_path}")
-                        
-                        # 调用chat方法，传入包含历史记录的完整消息列表
-                        response = await asyncio.wait_for(
-                            self.chat(self.chat_history.copy(), image_path=image_path),
-                            timeout=120.0  # 120秒超时
-                        )
+                    
+                        # 可选的回复缓存：同样的问题在同样的窗口/文件/截图和同样的前文下直接返回之前的回复
+                        cache_key = None
+                        response = None
+                        if self.response_cache is not None:
+                            # 最后一条是刚加入的本次问题，之前的消息才是前文
+                            cache_key = self.response_cache.make_key(message_content, active_window, active_file_path,
+                                                                     image_path, history=self.memory.messages()[:-1])
+                            response = self.response_cache.get(cache_key)
+                            if response is not None:
+                                print(f"[回复缓存] 命中，跳过模型调用 {self.response_cache.summary()}")
+
+                        if response is None:
+                            # 调用chat方法，传入包含历史记录的完整消息列表
+                            response = await asyncio.wait_for(
+                                self.chat(with_context(self.memory.messages(), context), image_path=image_path,
+                                          on_delta=on_delta, tool_query=message_content,
+                                          cancel_token=cancel_token),
+                                timeout=120.0  # 120秒超时
+                            )
+                            # 只缓存正常完成、且用到的工具都可缓存的回复
+                            if cache_key is not None and getattr(response, "stop_reason", None) == "completed":
+                                tools_used = [name for step in response.steps for name in step.get("tools", [])]
+                                self.response_cache.put(cache_key, response.content, tools_used)
+                    except RequestCancelled:
+                        response = None
                     except asyncio.TimeoutError:
                         print("请求超时，重新进入循环")
                         response = type('obj', (object,), {'content': '请求超时。'})  # 创建一个具有content属性的对象
                     except Exception as e:
                         print(f"发生错误: {str(e)}")
                         response = type('obj', (object,), {'content': f'处理请求时发生错误: {str(e)}'})  # 创建一个具有content属性的对象
-                    
+                
+                    self.active_requests.pop(request_id, None)
+                    if cancel_token.cancelled or getattr(response, "stop_reason", None) == "cancelled":
+                        # 已取消：撤回本次问题，不写入回答和缓存，通知悬浮球后立即处理下一条请求
+                        self.memory.discard_last("user")
+                        request_span.set(cancelled=cancel_token.reason or True)
+                        await self.channel.send({'type': 'cancelled', 'request_id': request_id,
+                                                 'timestamp': time.time()})
+                        print(f"[取消] 请求 {request_id} 已取消，"
+                              f"耗时{(time.perf_counter() - request_start) * 1000:.0f}ms")
+                        continue
+
                     # 检查response是否有内容
                     if not hasattr(response, 'content') or response.content is None:
                         response.content = "无响应内容。"
                     else:
                         # 将AI的回复添加到历史记录
-                        self.chat_history.append({"role": "assistant", "content": response.content})
+                        self.memory.add("assistant", response.content)
+                        # 超出预算时在后台压缩较早的对话，不阻塞下一次提问
+                        await self.memory.after_turn()
 
                     # 创建响应数据
                     response_data = {
-                        'request_id': input_data.get('request_id', ''),
+                        'type': 'response',
+                        'request_id': request_id,
                         'content': "user: "+message_content + "\n\n" + "AI:\n\n" + response.content,
                         'timestamp': time.time()
                     }
-                
-                    # 写入输出文件
-                    with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-                        json.dump(response_data, f, ensure_ascii=False)
-                    
-                    print(f"已返回响应: {response_data['content']}")
-                    LAST_TIME = time.time()
-                    
-                # except Exception as e:
-                #     print(f"发送响应时出错: {e}")
-            
-            else:
-                pass
 
+                    # 通过通道返回响应
+                    await self.channel.send(response_data)
 
+                    print(f"已返回响应: {response_data['content']}")
+                    total_ms = (time.perf_counter() - request_start) * 1000
+                    if first_token_time:
+                        ttft_ms = (first_token_time[0] - request_start) * 1000
+                        print(f"[指标] request_id={request_id} 首token耗时={ttft_ms:.0f}ms 总耗时={total_ms:.0f}ms")
+                    else:
+                        print(f"[指标] request_id={request_id} 无流式输出 总耗时={total_ms:.0f}ms")
 
-            #Sprint("循环结束。")
+                # except Exception as e:
+                #     print(f"发送响应时出错: {e}")
 
     
     def get_tool_call_stats(self):
@@ -500,10 +706,12 @@ class AgentServiceHost:
 
 # 新增函数：运行MCP服务器
 def run_server():
+    from server import mcp
     mcp.run(transport="http", port=9000)
 
 # 运行悬浮球线程
 def run_float_ball():
+    from float_ball_line import launch_assistant_avatar
     launch_assistant_avatar()
 
 async def start_agent_service():
@@ -515,14 +723,24 @@ async def start_agent_service():
     # 等待服务器启动
     time.sleep(1)
 
+    # 先启动IPC通道，确保悬浮球启动时可以直接连接
+    channel = AgentChannel()
+    await channel.start()
+
     # 创建并启动悬浮球线程
     float_ball_thread = threading.Thread(target=run_float_ball)
     float_ball_thread.daemon = True  # 设置为守护线程，主程序退出时自动结束
     float_ball_thread.start()
 
     # 启动客户端
-    mcp_client = AgentServiceHost("http://localhost:9000/mcp", max_tool_calls=1)
+    from server import mcp
+    mcp_target = mcp if MCP_TRANSPORT == "inprocess" else MCP_HTTP_URL
+    print(f"MCP传输方式: {MCP_TRANSPORT}")
+    mcp_client = AgentServiceHost(mcp_target, max_tool_calls=1, channel=channel)
     await mcp_client.loop()
 
 if __name__ == '__main__':
+    # Setup API keys before loading them
+    setup_api_keys()
+    load_dotenv()
     asyncio.run(start_agent_service())
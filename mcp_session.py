@@ -0,0 +1,359 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+常驻的 MCP 客户端会话
+1. 整个进程只建立一次连接和握手，不再每条消息 async with 一次
+2. 后台定时 ping 保活，发现连接断开后按退避自动重连
+3. 工具列表只拉取一次并缓存，服务端发出 tools/list_changed 通知后才重新拉取
+4. 可直接连接同进程内的 FastMCP 对象（内存传输），省去 HTTP 序列化和回环 socket；
+   server.py 的工具都是同步函数，会阻塞所在的事件循环，因此进程内会话运行在独立的事件循环线程中
+5. python mcp_session.py 会对比复用会话与每轮重连的单轮开销，以及HTTP与进程内两种传输的延迟和吞吐
+"""
+import asyncio
+import os
+import threading
+import time
+
+import anyio
+import httpx
+from fastmcp import Client, FastMCP
+from fastmcp.client.messages import MessageHandler
+
+# 保活ping的间隔与超时（秒）
+MCP_KEEPALIVE_INTERVAL = float(os.getenv("OPEN_ASSISTANT_MCP_KEEPALIVE", "30"))
+MCP_PING_TIMEOUT = 5.0
+# 重连的最大尝试次数和初始等待时间（每次翻倍）
+MCP_RECONNECT_ATTEMPTS = 5
+MCP_RECONNECT_DELAY = 0.5
+
+# 这些异常说明连接本身出了问题（而不是工具执行出错），需要重连
+CONNECTION_ERRORS = (RuntimeError, OSError, httpx.HTTPError, anyio.ClosedResourceError,
+                     anyio.BrokenResourceError, anyio.EndOfStream)
+
+
+class _ToolListWatcher(MessageHandler):
+    """收到服务端的工具列表变化通知时，标记缓存失效"""
+
+    def __init__(self, session):
+        super().__init__()
+        self.session = session
+
+    async def on_tool_list_changed(self, message):
+        print("[MCP] 服务端工具列表已变化，下次使用前重新拉取")
+        self.session.tools_changed = True
+
+
+class _LoopThread:
+    """在后台线程中运行的事件循环，协程提交过去执行，调用方 await 结果（取消会传递过去）"""
+
+    def __init__(self, name="mcp-client"):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self._thread.start()
+
+    async def run(self, coro):
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class PersistentMCPSession:
+    """
+    对 fastmcp.Client 的包装，接口与 Client 的 list_tools / call_tool 一致
+    transport 可以是 URL（如 http://localhost:9000/mcp）、FastMCP 对象（进程内传输），或任何 Client 支持的传输
+    isolate_loop: 是否让客户端运行在独立的事件循环线程中，默认对 FastMCP 对象开启
+    """
+
+    def __init__(self, transport, keepalive_interval=MCP_KEEPALIVE_INTERVAL,
+                 reconnect_attempts=MCP_RECONNECT_ATTEMPTS, reconnect_delay=MCP_RECONNECT_DELAY, isolate_loop=None):
+        self.transport = transport
+        self.keepalive_interval = keepalive_interval
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_delay = reconnect_delay
+        if isolate_loop is None:
+            isolate_loop = isinstance(transport, FastMCP)
+        self._loop_thread = _LoopThread() if isolate_loop else None
+
+        self.client = Client(transport, message_handler=_ToolListWatcher(self))
+        self.tools = None  # 缓存的工具列表
+        self.tools_changed = True
+        self.connect_count = 0  # 建立连接（握手）的次数，用于观察重连情况
+        self._entered = False
+        self._lock = asyncio.Lock()
+        self._keepalive_task = None
+
+    async def _run(self, coro):
+        """客户端的所有操作都必须在建立会话的那个事件循环中执行"""
+        if self._loop_thread is None:
+            return await coro
+        return await self._loop_thread.run(coro)
+
+    def is_connected(self):
+        return self._entered and self.client.is_connected()
+
+    async def start(self):
+        """建立连接并启动保活任务；连接失败时不抛出，等下次使用时再重连"""
+        try:
+            await self.ensure_connected()
+        except CONNECTION_ERRORS as e:
+            print(f"[MCP] 初次连接失败，将在使用时重试: {e}")
+        if self._keepalive_task is None and self.keepalive_interval > 0:
+            self._keepalive_task = asyncio.create_task(self._keepalive())
+
+    async def ensure_connected(self):
+        """确保会话可用，断开时按退避重连"""
+        if self.is_connected():
+            return
+        async with self._lock:
+            if self.is_connected():
+                return
+            await self._disconnect()
+            delay = self.reconnect_delay
+            for attempt in range(1, self.reconnect_attempts + 1):
+                try:
+                    await self._run(self.client.__aenter__())
+                    self._entered = True
+                    self.connect_count += 1
+                    # 新会话不会补发断开期间的通知，保守起见重新拉取工具列表
+                    self.tools_changed = True
+                    print(f"[MCP] 会话已建立（第{self.connect_count}次连接）")
+                    return
+                except CONNECTION_ERRORS as e:
+                    if attempt == self.reconnect_attempts:
+                        raise
+                    print(f"[MCP] 连接失败（第{attempt}次），{delay:.1f}秒后重试: {e}")
+                    await asyncio.sleep(delay)
+                    delay *= 2
+
+    async def _disconnect(self):
+        if not self._entered:
+            return
+        self._entered = False
+        try:
+            await self._run(self.client.__aexit__(None, None, None))
+        except Exception as e:
+            print(f"[MCP] 关闭旧会话时出错（忽略）: {e}")
+
+    async def reconnect(self):
+        async with self._lock:
+            await self._disconnect()
+        await self.ensure_connected()
+
+    async def list_tools(self):
+        """返回缓存的工具列表，只在首次使用或收到变化通知后重新拉取"""
+        await self.ensure_connected()
+        if self.tools is None or self.tools_changed:
+            self.tools_changed = False
+            try:
+                self.tools = await self._run(self.client.list_tools())
+            except CONNECTION_ERRORS:
+                self.tools_changed = True
+                await self.reconnect()
+                self.tools_changed = False
+                self.tools = await self._run(self.client.list_tools())
+        return self.tools
+
+    async def call_tool(self, name, arguments=None):
+        """
+        调用工具；调用前会确认连接可用
+        调用途中连接断开时只重连、不自动重放（工具大多有副作用，例如打开软件、写文件）
+        """
+        await self.ensure_connected()
+        try:
+            return await self._run(self._call_tool_cancellable(name, arguments or {}))
+        except CONNECTION_ERRORS:
+            if self.client.is_connected():
+                raise
+            print(f"[MCP] 调用 {name} 时连接断开，正在重连")
+            await self.reconnect()
+            raise
+
+    async def _call_tool_cancellable(self, name, arguments):
+        """调用被取消时（用户取消了请求）通知服务端放弃这次调用，而不是只在本地停止等待"""
+        # mcp 没有公开请求ID：按递增整数分配，发出请求之前没有挂起点，此时的值就是这次调用的ID。
+        # 依赖 requirements.txt 中固定的 mcp 版本，升级后须运行 python mcp_session.py 确认取消的仍是这次调用
+        request_id = getattr(self.client.session, "_request_id", None)
+        try:
+            return await self.client.call_tool(name, arguments)
+        except asyncio.CancelledError:
+            if request_id is None:
+                raise
+            try:
+                await asyncio.wait_for(self.client.cancel(request_id, reason="request cancelled"), timeout=1.0)
+                print(f"[MCP] 已通知服务端取消工具调用 {name}（请求{request_id}）")
+            except Exception as e:
+                print(f"[MCP] 发送取消通知失败: {e!r}")
+            raise
+
+    async def _keepalive(self):
+        """定时ping，连接失效时提前重连，避免用户提问时才发现"""
+        while True:
+            await asyncio.sleep(self.keepalive_interval)
+            try:
+                if self.is_connected():
+                    await asyncio.wait_for(self._run(self.client.ping()), timeout=MCP_PING_TIMEOUT)
+                    continue
+            except (asyncio.TimeoutError, *CONNECTION_ERRORS) as e:
+                print(f"[MCP] 保活ping失败: {e!r}")
+            try:
+                await self.reconnect()
+            except CONNECTION_ERRORS as e:
+                print(f"[MCP] 重连失败，{self.keepalive_interval:.0f}秒后再试: {e}")
+
+    async def close(self):
+        if self._keepalive_task:
+            self._keepalive_task.cancel()
+            self._keepalive_task = None
+        async with self._lock:
+            await self._disconnect()
+        if self._loop_thread is not None:
+            self._loop_thread.stop()
+
+
+def _make_noop_server():
+    """只含空操作工具的FastMCP服务器"""
+    mcp = FastMCP()
+
+    @mcp.tool()
+    def noop() -> str:
+        """空操作"""
+        return "ok"
+
+    return mcp
+
+
+async def _verify_cancel_request_id():
+    """调用途中取消时，服务端收到的取消通知必须指向正在执行的这次调用，否则会取消别的请求或什么都不取消"""
+    from fastmcp import Context
+
+    mcp = FastMCP()
+    started = threading.Event()
+    cancelled = threading.Event()
+
+    @mcp.tool()
+    def noop() -> str:
+        """空操作"""
+        return "ok"
+
+    @mcp.tool()
+    async def slow(ctx: Context) -> str:
+        """耗时的工具"""
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        return ctx.request_id
+
+    session = PersistentMCPSession(mcp, keepalive_interval=0)
+    await session.start()
+    # 先用掉几个请求ID，确认取消的不是碰巧从0开始的那一个
+    for _ in range(3):
+        await session.call_tool("noop")
+    task = asyncio.create_task(session.call_tool("slow"))
+    await asyncio.to_thread(started.wait, 5)
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    ok = await asyncio.to_thread(cancelled.wait, 2)
+    await session.close()
+    if not ok:
+        raise SystemExit("取消通知没有送达正在执行的工具调用：mcp 的请求ID分配方式可能已经变化")
+    print("[取消] 服务端已按请求ID中断正在执行的工具调用")
+
+
+def _start_http_server(mcp, port):
+    """在后台线程中以HTTP方式运行服务器，返回其URL"""
+    import socket
+
+    server_kwargs = {"transport": "http", "port": port, "show_banner": False, "log_level": "warning"}
+    threading.Thread(target=mcp.run, kwargs=server_kwargs, daemon=True).start()
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return f"http://127.0.0.1:{port}/mcp"
+
+
+def _report(label, samples):
+    import statistics
+
+    samples = sorted(samples)
+    print(f"[{label}] {len(samples)}次 p50={statistics.median(samples):.2f}ms "
+          f"p95={samples[int(len(samples) * 0.95) - 1]:.2f}ms 平均={statistics.mean(samples):.2f}ms")
+
+
+async def _benchmark_session_reuse(url, turns=30):
+    """对比每轮重连与复用会话的单轮开销（毫秒）"""
+    # 修改前：每条消息 async with 一次（连接+握手），工具列表只在第一次拉取
+    client = Client(url)
+    samples = []
+    for _ in range(turns):
+        start = time.perf_counter()
+        async with client:
+            await client.call_tool("noop", {})
+        samples.append((time.perf_counter() - start) * 1000)
+    _report("每轮重连(修改前)", samples)
+
+    session = PersistentMCPSession(url, keepalive_interval=0)
+    await session.start()
+    await session.list_tools()
+    samples = []
+    for _ in range(turns):
+        start = time.perf_counter()
+        await session.list_tools()
+        await session.call_tool("noop", {})
+        samples.append((time.perf_counter() - start) * 1000)
+    _report("复用会话", samples)
+    print(f"复用会话期间共建立连接 {session.connect_count} 次")
+    await session.close()
+
+
+async def _benchmark_transports(mcp, url, calls=300, concurrency=20):
+    """对比HTTP与进程内传输的单次工具调用延迟和并发吞吐"""
+    modes = [
+        ("HTTP", PersistentMCPSession(url, keepalive_interval=0)),
+        ("进程内(独立线程)", PersistentMCPSession(mcp, keepalive_interval=0)),
+        ("进程内(同一事件循环)", PersistentMCPSession(mcp, keepalive_interval=0, isolate_loop=False)),
+    ]
+    for label, session in modes:
+        await session.start()
+        await session.call_tool("noop", {})  # 预热
+        samples = []
+        for _ in range(calls):
+            start = time.perf_counter()
+            await session.call_tool("noop", {})
+            samples.append((time.perf_counter() - start) * 1000)
+        _report(f"{label} 延迟", samples)
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited_call():
+            async with semaphore:
+                await session.call_tool("noop", {})
+
+        start = time.perf_counter()
+        await asyncio.gather(*(limited_call() for _ in range(calls)))
+        elapsed = time.perf_counter() - start
+        print(f"[{label} 吞吐] 并发{concurrency} 共{calls}次 {calls / elapsed:.0f}次/秒")
+        await session.close()
+
+
+if __name__ == '__main__':
+    noop_server = _make_noop_server()
+    noop_url = _start_http_server(noop_server, 9100)
+
+    async def main():
+        await _verify_cancel_request_id()
+        await _benchmark_session_reuse(noop_url)
+        await _benchmark_transports(noop_server, noop_url)
+
+    asyncio.run(main())
@@ -0,0 +1,314 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+本地的 OpenAI 兼容桩服务器（只依赖标准库），用于离线验证模型调用相关的改动
+1. 支持 /chat/completions 的普通与流式(SSE)响应
+2. 可配置首包延迟和每个分片的延迟，模拟慢速的模型服务
+3. 模拟服务端的前缀缓存：按 工具定义 + 逐条消息 分块，与之前请求相同的最长前缀计入 usage 的 cached_tokens
+4. 可按比例注入错误响应（默认503）和长尾延迟，用于验证重试与对冲请求（见 resilient_llm.py）；
+   提供证书时以HTTPS提供服务（见 llm_clients.py）
+5. 回复可以带 tool_calls（流式时按分片输出函数名和参数）；传入对话脚本时按 本轮用户问题 + 第几步 返回录制的回复，
+   用于离线回放（见 replay.py）
+6. python mock_llm_server.py 会验证 AsyncOpenAI 调用不阻塞事件循环、超时能真正取消请求
+"""
+import hashlib
+import json
+import random
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockLLMServer:
+    """在后台线程中运行的桩服务器"""
+
+    def __init__(self, host="127.0.0.1", port=0, reply="你好，我是桩模型。", delay=0.0, chunk_delay=0.0,
+                 error_rate=0.0, error_status=503, tail_rate=0.0, tail_delay=0.0, seed=None,
+                 certfile=None, keyfile=None, script=None):
+        self.reply = reply
+        self.script = script  # 对话脚本 [{"user": 问题, "steps": [回复, ...]}]，见 match_script()
+        self.delay = delay  # 返回响应头前的等待时间（秒）
+        self.chunk_delay = chunk_delay  # 流式响应每个分片之间的等待时间（秒）
+        self.error_rate = error_rate  # 返回错误响应的请求比例
+        self.error_status = error_status
+        self.tail_rate = tail_rate  # 额外等待 tail_delay 秒的请求比例（长尾延迟）
+        self.tail_delay = tail_delay
+        self.error_count = 0
+        self.tail_count = 0
+        self._rng = random.Random(seed)
+        self.request_count = 0
+        self._seen_prefixes = set()  # 已缓存的提示词前缀（块哈希链）
+        self.cancelled_count = 0  # 客户端在响应完成前断开的次数
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self.scheme = "http"
+        if certfile:
+            # 提供证书时以HTTPS提供服务，用于测量TLS握手和连接复用的影响
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self._httpd.socket = context.wrap_socket(self._httpd.socket, server_side=True)
+            self.scheme = "https"
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"{self.scheme}://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def prompt_usage(self, request_body):
+        """估算提示词token数，并按之前请求过的最长相同前缀计算命中缓存的token数"""
+        blocks = [json.dumps(request_body.get("tools") or [], ensure_ascii=False, sort_keys=True)]
+        blocks += [json.dumps(message, ensure_ascii=False, sort_keys=True) for message in request_body.get("messages", [])]
+        prompt_tokens = cached_tokens = 0
+        prefix = hashlib.sha256()
+        hit = True
+        with self._lock:
+            for block in blocks:
+                tokens = len(block) // 2
+                prefix.update(block.encode("utf-8"))
+                digest = prefix.hexdigest()
+                if hit and digest in self._seen_prefixes:
+                    cached_tokens += tokens
+                else:
+                    hit = False
+                    self._seen_prefixes.add(digest)
+                prompt_tokens += tokens
+        return prompt_tokens, cached_tokens
+
+    def build_reply(self, request_body):
+        """
+        根据请求生成回复，子类或调用方可替换
+        回复是文本，或 {"content": 文本, "tool_calls": [{"name": 工具名, "arguments": 参数dict或JSON}]}
+        """
+        if self.script:
+            reply = match_script(self.script, request_body.get("messages", []))
+            if reply is not None:
+                return reply
+        return self.reply
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # 响应头和响应体分开写出，不关闭Nagle算法时会叠加约40ms的延迟确认
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                with server._lock:
+                    server.request_count += 1
+                    fail = server._rng.random() < server.error_rate
+                    slow = not fail and server._rng.random() < server.tail_rate
+                    server.error_count += fail
+                    server.tail_count += slow
+                if server.delay:
+                    time.sleep(server.delay)
+                if fail:
+                    self._send_error(server.error_status)
+                    return
+                if slow:
+                    time.sleep(server.tail_delay)
+                reply, tool_calls = normalize_reply(server.build_reply(body))
+                prompt_tokens, cached_tokens = server.prompt_usage(body)
+                completion_tokens = len(reply) + sum(len(call["function"]["arguments"]) for call in tool_calls)
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                         "total_tokens": prompt_tokens + completion_tokens,
+                         "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+                try:
+                    if body.get("stream"):
+                        self._send_stream(body, reply, tool_calls, usage)
+                    else:
+                        self._send_json(body, reply, tool_calls, usage)
+                except (BrokenPipeError, ConnectionResetError):
+                    with server._lock:
+                        server.cancelled_count += 1
+
+            def _send_json(self, body, reply, tool_calls, usage):
+                message = {"role": "assistant", "content": reply or None}
+                if tool_calls:
+                    message["tool_calls"] = tool_calls
+                payload = json.dumps({
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", "mock"),
+                    "choices": [{"index": 0, "finish_reason": "tool_calls" if tool_calls else "stop",
+                                 "message": message}],
+                    "usage": usage,
+                }, ensure_ascii=False).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _send_error(self, status):
+                payload = json.dumps({"error": {"message": "injected error", "type": "server_error",
+                                                "code": str(status)}}).encode("utf-8")
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def _send_stream(self, body, reply, tool_calls, usage):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                # 与真实服务一致：文本逐段输出；工具调用先输出id和函数名，参数再分成多段
+                deltas = [{"content": char} for char in reply]
+                for index, call in enumerate(tool_calls):
+                    deltas.append({"tool_calls": [{"index": index, "id": call["id"], "type": "function",
+                                                   "function": {"name": call["function"]["name"], "arguments": ""}}]})
+                    arguments = call["function"]["arguments"]
+                    deltas += [{"tool_calls": [{"index": index, "function": {"arguments": arguments[i:i + 8]}}]}
+                               for i in range(0, len(arguments), 8)]
+                for delta in deltas:
+                    self._write_event(self._chunk(body, delta, None))
+                    if server.chunk_delay:
+                        time.sleep(server.chunk_delay)
+                self._write_event(self._chunk(body, {}, "tool_calls" if tool_calls else "stop"))
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    self._write_event({"id": "chatcmpl-mock", "object": "chat.completion.chunk",
+                                       "created": int(time.time()), "model": body.get("model", "mock"),
+                                       "choices": [], "usage": usage})
+                self._write_chunk(b"data: [DONE]\n\n")
+                self._write_chunk(b"")
+
+            def _chunk(self, body, delta, finish_reason):
+                return {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                        "model": body.get("model", "mock"),
+                        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+            def _write_event(self, data):
+                self._write_chunk(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+            def _write_chunk(self, data):
+                self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+def normalize_reply(reply):
+    """把 build_reply() 的返回值整理为 (文本, OpenAI格式的tool_calls列表)"""
+    if isinstance(reply, str):
+        return reply, []
+    tool_calls = []
+    for index, call in enumerate(reply.get("tool_calls") or []):
+        arguments = call.get("arguments", {})
+        if not isinstance(arguments, str):
+            arguments = json.dumps(arguments, ensure_ascii=False)
+        # id 只取决于位置和工具名，同一脚本每次回放得到相同的请求
+        tool_calls.append({"id": call.get("id") or f"call_{index}_{call['name']}", "type": "function",
+                           "function": {"name": call["name"], "arguments": arguments}})
+    return reply.get("content") or "", tool_calls
+
+
+def message_text(message):
+    """消息的文本部分（多模态消息只取文字）"""
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+
+def match_script(script, messages):
+    """
+    按对话脚本取回复：最后一条用户消息包含哪一轮的问题（取最长的匹配）就是哪一轮，
+    其后已有几条assistant消息就返回这一轮的第几步。只看请求内容、不看先后顺序，重试和对冲的请求得到相同的回复
+    没有匹配的轮次或步数超出脚本时返回 None
+    """
+    last_user = next((i for i in range(len(messages) - 1, -1, -1) if messages[i].get("role") == "user"), None)
+    if last_user is None:
+        return None
+    text = message_text(messages[last_user])
+    turns = [turn for turn in script if turn["user"] in text]
+    if not turns:
+        return None
+    turn = max(turns, key=lambda t: len(t["user"]))
+    step = sum(1 for message in messages[last_user + 1:] if message.get("role") == "assistant")
+    return turn["steps"][step] if step < len(turn["steps"]) else None
+
+
+def _verify_async_client():
+    """对比同步/异步客户端：慢请求期间事件循环是否仍在运转，超时能否真正取消请求"""
+    import asyncio
+    import httpx
+    from openai import AsyncOpenAI, OpenAI
+
+    server = MockLLMServer(delay=1.0).start()
+    messages = [{"role": "user", "content": "你好"}]
+
+    async def heartbeat(ticks, stop):
+        while not stop.is_set():
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(0.01)
+
+    async def run(label, call):
+        ticks, stop = [], asyncio.Event()
+        beat = asyncio.create_task(heartbeat(ticks, stop))
+        await asyncio.sleep(0.05)
+        start = time.perf_counter()
+        await call()
+        elapsed = time.perf_counter() - start
+        # 让心跳在调用结束后再跳一次，才能统计到调用期间的停顿
+        await asyncio.sleep(0.02)
+        stop.set()
+        await beat
+        # 心跳之间的最大间隔即事件循环被阻塞的最长时间
+        max_gap = max(b - a for a, b in zip(ticks, ticks[1:])) * 1000
+        print(f"[{label}] 调用耗时={elapsed * 1000:.0f}ms, 事件循环最长停顿={max_gap:.0f}ms")
+
+    async def main():
+        sync_client = OpenAI(api_key="mock", base_url=server.base_url)
+        async_client = AsyncOpenAI(api_key="mock", base_url=server.base_url, max_retries=0,
+                                   http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=10)))
+
+        async def sync_call():
+            sync_client.chat.completions.create(model="mock", messages=messages)
+
+        async def async_call():
+            await async_client.chat.completions.create(model="mock", messages=messages)
+
+        async def async_call_with_timeout():
+            try:
+                await asyncio.wait_for(async_client.chat.completions.create(model="mock", messages=messages),
+                                       timeout=0.3)
+            except asyncio.TimeoutError:
+                print("  -> 0.3秒超时已触发，请求被取消")
+
+        await run("同步OpenAI(修改前)", sync_call)
+        await run("AsyncOpenAI", async_call)
+        await run("AsyncOpenAI+超时", async_call_with_timeout)
+        await async_client.close()
+
+    asyncio.run(main())
+    time.sleep(1.0)
+    print(f"桩服务器共收到 {server.request_count} 个请求，其中 {server.cancelled_count} 个在完成前被客户端断开")
+    server.stop()
+
+
+if __name__ == '__main__':
+    _verify_async_client()
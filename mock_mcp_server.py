@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+server.py 的离线替身：不导入 server.py，也不依赖桌面自动化库、浏览器和各种API密钥
+1. 从 server.py 的源码中解析出所有 @mcp.tool() 函数的名称、参数和文档字符串
+2. 为每个工具生成同名同参数的桩函数注册到新的 FastMCP 上，Agent看到的工具列表和参数定义与真实服务端一致
+3. 桩函数返回预设的结果（工具名 -> 文本，或接收同样参数的函数），可为每个工具设置模拟耗时，并记录每次调用
+4. python mock_mcp_server.py 列出全部桩工具并演示一次调用
+"""
+import ast
+import asyncio
+import json
+import os
+import warnings
+
+from fastmcp import FastMCP
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+
+
+def _is_tool_decorator(node):
+    # @mcp.tool() 或 @mcp.tool
+    target = node.func if isinstance(node, ast.Call) else node
+    return isinstance(target, ast.Attribute) and target.attr == "tool"
+
+
+def load_tool_definitions(path=SERVER_SCRIPT):
+    """server.py 中注册为工具的函数定义（AST节点），按源码顺序"""
+    with open(path, "r", encoding="utf-8") as f:
+        source = f.read()
+    with warnings.catch_warnings():
+        # server.py 里的Windows路径字符串带有无效的转义序列，这里只解析、不执行，不必提示
+        warnings.simplefilter("ignore", DeprecationWarning)
+        tree = ast.parse(source, filename=path)
+    return [node for node in tree.body
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+            and any(_is_tool_decorator(decorator) for decorator in node.decorator_list)]
+
+
+class MockMCPServer:
+    """
+    mcp 属性是可直接交给 PersistentMCPSession 的 FastMCP 对象（进程内传输）
+    results: 工具名 -> 返回文本，或以工具参数调用的函数；没有预设时返回一段说明调用参数的文本
+    delays: 工具名 -> 模拟耗时（秒），未指定的工具使用 default_delay
+    """
+
+    def __init__(self, results=None, delays=None, default_delay=0.0, server_script=SERVER_SCRIPT):
+        self.results = results or {}
+        self.delays = delays or {}
+        self.default_delay = default_delay
+        self.calls = []  # [(工具名, 参数)]，按调用顺序
+        self.mcp = FastMCP("open-assistant-mock")
+        self.tool_names = []
+        for node in load_tool_definitions(server_script):
+            self.mcp.tool(self._make_stub(node, server_script))
+            self.tool_names.append(node.name)
+
+    def _make_stub(self, node, filename):
+        # 保留参数列表、类型注解、默认值和文档字符串，函数体换成 return await _respond(工具名, 参数)
+        fields = {field: getattr(node, field) for field in ast.AsyncFunctionDef._fields if hasattr(node, field)}
+        stub = ast.AsyncFunctionDef(**fields)
+        docstring = ast.get_docstring(node, clean=False)
+        stub.body = ([ast.Expr(ast.Constant(docstring))] if docstring else []) + \
+            ast.parse(f"return await _respond({node.name!r}, dict(locals()))").body
+        stub.decorator_list = []
+        module = ast.fix_missing_locations(ast.Module(body=[stub], type_ignores=[]))
+        namespace = {"_respond": self.respond}
+        exec(compile(module, filename, "exec"), namespace)
+        return namespace[node.name]
+
+    async def respond(self, name, arguments):
+        self.calls.append((name, arguments))
+        delay = self.delays.get(name, self.default_delay)
+        if delay:
+            await asyncio.sleep(delay)
+        result = self.results.get(name)
+        if callable(result):
+            result = result(**arguments)
+        if result is None:
+            result = f"[桩] {name} 已执行，参数: {json.dumps(arguments, ensure_ascii=False)}"
+        return result
+
+
+if __name__ == '__main__':
+    from fastmcp import Client
+
+    server = MockMCPServer(results={"fetch_current_weather_for_city": "北京：晴，12~25℃"}, default_delay=0.05)
+    print(f"桩工具共 {len(server.tool_names)} 个: {server.tool_names}")
+
+    async def main():
+        async with Client(server.mcp) as client:
+            tools = await client.list_tools()
+            weather = next(tool for tool in tools if tool.name == "fetch_current_weather_for_city")
+            print(f"参数定义: {json.dumps(weather.inputSchema, ensure_ascii=False)}")
+            result = await client.call_tool("fetch_current_weather_for_city", {"city": "北京"})
+            print(f"调用结果: {result.content[0].text}")
+            result = await client.call_tool("open_app", {"app_names": ["记事本"]})
+            print(f"调用结果: {result.content[0].text}")
+        print(f"调用记录: {server.calls}")
+
+    asyncio.run(main())
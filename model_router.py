@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+按请求复杂度选择模型（flash / plus / long）
+1. 特征：提示词长度、需要调用工具的可能性（工具 BM25 索引的最高得分）、是否带图片、多步骤/推理类措辞
+2. 策略配置（DEFAULT_MODEL_POLICY，可用 OPEN_ASSISTANT_MODEL_POLICY 指向的JSON文件覆盖）按成本从低到高列出各档模型，
+   每档给出能处理的最大复杂度、最大提示词长度、是否支持工具和延迟目标；选择满足条件的最便宜的一档
+3. 记录每个模型实测耗时的滑动平均（EWMA），某档持续超出延迟目标时，请求改用满足条件且更快的一档；
+   被绕开的档位没有新的实测数据，其EWMA每次被绕开时向估计值回落一点，之后会被重新尝试
+4. 闲聊和单个工具的指令交给快速模型，长文本或多步骤、需要推理的请求才用更大的模型
+5. python model_router.py [录制的请求] 会在标注好的示例请求上评估路由准确率和预计耗时，
+   并统计录制的请求（默认 replays/conversations.json 中的用户问题，也可传入文件通道的请求队列）的路由分布
+"""
+import json
+import math
+import os
+import re
+
+from conversation_memory import count_tokens
+from sealed_file import SealedLog
+
+MODEL_ROUTER_ENABLED = os.getenv("OPEN_ASSISTANT_MODEL_ROUTER", "1") == "1"
+
+# 按成本从低到高排列；延迟指流式响应的首个分片耗时（与回答长短无关），
+# expected_latency_ms 是还没有实测数据时的估计值
+DEFAULT_MODEL_POLICY = {
+    "tiers": [
+        {"name": "flash", "model": "qwen-flash", "max_complexity": 1, "max_prompt_tokens": 12000,
+         "supports_tools": True, "latency_slo_ms": 2000, "expected_latency_ms": 600},
+        {"name": "plus", "model": "qwen-plus", "max_complexity": 3, "max_prompt_tokens": 120000,
+         "supports_tools": True, "latency_slo_ms": 4000, "expected_latency_ms": 1200},
+        {"name": "long", "model": "qwen-long", "max_complexity": 3, "max_prompt_tokens": 10000000,
+         "supports_tools": False, "latency_slo_ms": 10000, "expected_latency_ms": 3000},
+    ],
+    # 复杂度的各项权重：需要工具、带图片（视觉分析结果 + 问题）、多步骤、需要推理、问题很长
+    "complexity_weights": {"tool": 1, "has_image": 2, "multi_step": 1, "reasoning": 2, "long_query": 1},
+    # 工具最高得分换算成"需要工具的可能性"时的尺度：得分为该值时可能性约为63%
+    "tool_score_scale": 3.0,
+    # 文件总结：超过这个token数改用长文本模型（原来按6000字判断）
+    "summary_long_threshold_tokens": 6000,
+}
+
+EWMA_ALPHA = 0.3
+# 档位因超时被绕开时，其EWMA向估计值回落的比例
+RECOVERY_RATE = 0.1
+
+# 多步骤（需要连续调用多个工具）和需要推理的措辞
+MULTI_STEP_PATTERN = re.compile(r"然后|并且|之后|接着|同时|再把|再帮|并把|以及|分别")
+REASONING_PATTERN = re.compile(r"分析|对比|比较|为什么|推理|规划|计划|方案|评估|优缺点|详细|论证|证明")
+LONG_QUERY_CHARS = 80
+
+
+def load_policy(path=None):
+    """读取策略配置：JSON 文件中的同名档位覆盖默认值，其余键直接覆盖"""
+    policy = json.loads(json.dumps(DEFAULT_MODEL_POLICY))
+    path = path or os.getenv("OPEN_ASSISTANT_MODEL_POLICY")
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            override = json.load(f)
+        tiers = {tier["name"]: tier for tier in policy["tiers"]}
+        for tier in override.pop("tiers", []):
+            tiers.setdefault(tier["name"], {}).update(tier)
+        policy["tiers"] = list(tiers.values())
+        policy.update(override)
+    return policy
+
+
+class RouteDecision:
+    """一次路由的结果"""
+
+    def __init__(self, tier, model, complexity, features, reason):
+        self.tier = tier
+        self.model = model
+        self.complexity = complexity
+        self.features = features
+        self.reason = reason
+
+    def __repr__(self):
+        return f"RouteDecision({self.tier}/{self.model}, 复杂度={self.complexity}, {self.reason})"
+
+
+class ModelRouter:
+    """
+    tool_index: 可选的 tool_selector.ToolIndex，用于估计需要调用工具的可能性
+    """
+
+    def __init__(self, policy=None, tool_index=None):
+        self.policy = policy or load_policy()
+        self.tool_index = tool_index
+        self.latency_ms = {tier["model"]: float(tier["expected_latency_ms"]) for tier in self.policy["tiers"]}
+        self.stats = {tier["name"]: 0 for tier in self.policy["tiers"]}
+
+    def tier(self, name):
+        return next(tier for tier in self.policy["tiers"] if tier["name"] == name)
+
+    def features(self, query, prompt_tokens=None, has_image=False):
+        query = query or ""
+        tool_score = max(self.tool_index.scores(query), default=0.0) if self.tool_index else 0.0
+        return {
+            "prompt_tokens": prompt_tokens if prompt_tokens is not None else count_tokens(query),
+            "tool_likelihood": 1 - math.exp(-tool_score / self.policy["tool_score_scale"]),
+            "has_image": bool(has_image),
+            "multi_step": bool(MULTI_STEP_PATTERN.search(query)),
+            "reasoning": bool(REASONING_PATTERN.search(query)),
+            "long_query": len(query) > LONG_QUERY_CHARS,
+        }
+
+    def complexity(self, features):
+        """0：闲聊；1：单个工具的指令；2及以上：带图片、多步骤、需要推理或很长的请求"""
+        weights = self.policy["complexity_weights"]
+        score = weights["tool"] if features["tool_likelihood"] >= 0.5 else 0
+        score += sum(weights[name] for name in ("has_image", "multi_step", "reasoning", "long_query") if features[name])
+        return min(score, 3)
+
+    def route(self, query, prompt_tokens=None, has_image=False, needs_tools=True, tiers=None):
+        """选择模型；tiers 可以限定候选档位（例如文件总结只在 flash 和 long 之间选择）"""
+        features = self.features(query, prompt_tokens, has_image)
+        complexity = self.complexity(features)
+        candidates = [tier for tier in self.policy["tiers"]
+                      if (tiers is None or tier["name"] in tiers)
+                      and (tier["supports_tools"] or not needs_tools)
+                      and features["prompt_tokens"] <= tier["max_prompt_tokens"]
+                      and complexity <= tier["max_complexity"]]
+        if not candidates:
+            # 没有完全满足的档位时，用支持工具（如需要）且上下文最长的一档
+            pool = [tier for tier in self.policy["tiers"] if (tiers is None or tier["name"] in tiers)
+                    and (tier["supports_tools"] or not needs_tools)]
+            chosen = max(pool, key=lambda tier: tier["max_prompt_tokens"])
+            reason = "没有完全满足条件的档位"
+        else:
+            chosen = candidates[0]
+            reason = "满足条件的最便宜档位"
+            if self.latency_ms[chosen["model"]] > chosen["latency_slo_ms"]:
+                faster = min(candidates, key=lambda tier: self.latency_ms[tier["model"]])
+                if faster is not chosen:
+                    slow = chosen["model"]
+                    reason = f"{chosen['name']}近期耗时{self.latency_ms[slow]:.0f}ms超出目标，改用更快的档位"
+                    self.latency_ms[slow] += RECOVERY_RATE * (chosen["expected_latency_ms"] - self.latency_ms[slow])
+                    chosen = faster
+        self.stats[chosen["name"]] += 1
+        return RouteDecision(chosen["name"], chosen["model"], complexity, features, reason)
+
+    def route_summary(self, text):
+        """文件总结的模型：短文本用快速模型，长文本用长文本模型"""
+        tokens = count_tokens(text)
+        name = "long" if tokens > self.policy["summary_long_threshold_tokens"] else "flash"
+        self.stats[name] += 1
+        return self.tier(name)["model"]
+
+    def record(self, model, elapsed_ms):
+        """记录一次模型调用的首个分片耗时"""
+        previous = self.latency_ms.get(model, elapsed_ms)
+        self.latency_ms[model] = EWMA_ALPHA * elapsed_ms + (1 - EWMA_ALPHA) * previous
+
+    def summary(self):
+        latency = " ".join(f"{model}={ms:.0f}ms" for model, ms in self.latency_ms.items())
+        return f"路由次数={self.stats} 耗时EWMA: {latency}"
+
+
+# 标注好的示例请求：(用户消息, 是否带图片, 期望的档位)
+ROUTING_EXAMPLES = [
+    ("你好", False, "flash"),
+    ("你是谁", False, "flash"),
+    ("讲个笑话", False, "flash"),
+    ("谢谢你", False, "flash"),
+    ("今天心情不好，陪我聊聊", False, "flash"),
+    ("今天北京天气怎么样", False, "flash"),
+    ("帮我搜索一下最新的人工智能新闻", False, "flash"),
+    ("打开 https://www.python.org", False, "flash"),
+    ("打开微信", False, "flash"),
+    ("打开网易云音乐", False, "flash"),
+    ("网易云音乐下一首", False, "flash"),
+    ("暂停音乐播放", False, "flash"),
+    ("启动手势识别", False, "flash"),
+    ("看看剪切板里有什么", False, "flash"),
+    ("打开D盘的下载文件夹", False, "flash"),
+    ("把当前Word文档的标题加粗", False, "flash"),
+    ("在当前目录下新建三个文件夹", False, "flash"),
+    ("写一篇关于环保的文章", False, "flash"),
+    ("这张图里写了什么", True, "plus"),
+    ("把图中的表格转成Excel", True, "plus"),
+    ("搜索天气预报然后写成报告", False, "plus"),
+    ("读取这个PPT并且总结每一页的要点，然后保存成Word", False, "plus"),
+    ("帮我分析一下这两种方案的优缺点", False, "plus"),
+    ("为什么我的代码会报空指针错误", False, "plus"),
+    ("比较一下Python和Java在并发编程上的区别", False, "plus"),
+    ("帮我规划一个三天的北京旅游行程，包括每天的景点、交通和餐饮安排，尽量避开人多的时段并控制预算", False, "plus"),
+    ("搜索最新的AI新闻，再帮我整理成表格", False, "plus"),
+]
+
+
+def evaluate(router, examples=ROUTING_EXAMPLES):
+    """在标注的示例上评估：准确率、混淆情况，以及与固定使用 qwen-plus 相比的预计平均耗时"""
+    correct = 0
+    confusion = {}
+    routed_ms = fixed_ms = 0.0
+    mistakes = []
+    plus_ms = router.tier("plus")["expected_latency_ms"]
+    for query, has_image, expected in examples:
+        decision = router.route(query, has_image=has_image)
+        confusion[(expected, decision.tier)] = confusion.get((expected, decision.tier), 0) + 1
+        correct += decision.tier == expected
+        if decision.tier != expected:
+            mistakes.append(f"{query} -> {decision.tier}（期望{expected}，复杂度{decision.complexity}）")
+        routed_ms += router.tier(decision.tier)["expected_latency_ms"]
+        fixed_ms += plus_ms
+    print(f"[评估] {len(examples)}条 准确率={correct / len(examples):.0%} "
+          f"预计平均首包耗时 {routed_ms / len(examples):.0f}ms（固定qwen-plus为{fixed_ms / len(examples):.0f}ms）")
+    print("  混淆(期望->实际): " + ", ".join(f"{e}->{a}:{n}" for (e, a), n in sorted(confusion.items())))
+    for mistake in mistakes:
+        print(f"  路由不符: {mistake}")
+
+
+def load_recorded_requests(path):
+    """
+    读取录制的请求，返回 [(用户消息, 是否带图片)]：
+    .json 为 replay.py 的对话文件（每段对话的每一轮取用户问题）；
+    其他文件按文件通道的请求队列读取（SealedLog 格式，校验不通过的记录跳过），每条消息含 content 和可选的 screenshot_filename
+    """
+    if path.endswith(".json"):
+        with open(path, 'r', encoding='utf-8') as f:
+            conversations = json.load(f)
+        if isinstance(conversations, dict):
+            conversations = [conversations]
+        return [(turn["user"], False) for conversation in conversations for turn in conversation["turns"]
+                if turn.get("user", "").strip()]
+
+    records = []
+    for data in SealedLog(path, from_start=True).read_new():
+        if not isinstance(data, dict) or data.get("type", "request") != "request":
+            continue
+        query = data.get("content") or ""
+        if query.strip():
+            records.append((query, bool(data.get("screenshot_filename"))))
+    return records
+
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+    from tool_selector import ToolIndex, load_tools_from_source
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    tools = load_tools_from_source(os.path.join(base_dir, "server.py"))
+    router = ModelRouter(tool_index=ToolIndex(tools))
+    evaluate(router)
+
+    # 延迟自适应：flash 持续变慢后，原本给 flash 的请求改用更快的档位
+    for _ in range(10):
+        router.record("qwen-flash", 9000)
+    print(f"[flash变慢后] 打开微信 -> {router.route('打开微信')}")
+    skipped = 1
+    while router.route("打开微信").tier != "flash":
+        skipped += 1
+    print(f"[恢复] flash 被绕开{skipped}次后重新尝试")
+
+    # 录制的请求按文件通道写入的格式读取：损坏的记录跳过，取消消息不计入
+    with tempfile.TemporaryDirectory() as directory:
+        queue_file = os.path.join(directory, "request_queue.jsonl")
+        log = SealedLog(queue_file)
+        log.append({"type": "request", "request_id": "1", "content": "打开记事本"})
+        log.append({"type": "request", "request_id": "2", "content": "这张图里是什么", "screenshot_filename": "a.png"})
+        log.append({"type": "cancel", "request_id": "2", "reason": "stopped"})
+        with open(queue_file, "a", encoding="utf-8") as f:
+            f.write('{"seq": 1, "checksum": "0", "payload": {"content": "损坏的记录"}}\n')
+        loaded = load_recorded_requests(queue_file)
+    if loaded != [("打开记事本", False), ("这张图里是什么", True)]:
+        raise SystemExit(f"读取录制的请求失败: {loaded}")
+    print(f"[读取录制的请求] 自检通过: {loaded}")
+
+    # 请求队列只在文件通道下写入，且悬浮球每次启动都会清空，默认改用仓库中录制的回放对话
+    recorded = sys.argv[1] if len(sys.argv) > 1 else os.path.join(base_dir, "replays", "conversations.json")
+    if os.path.exists(recorded):
+        replay = ModelRouter(tool_index=ToolIndex(tools))
+        records = load_recorded_requests(recorded)
+        for query, has_image in records:
+            replay.route(query, has_image=has_image)
+        print(f"[录制的请求] {recorded} 共{len(records)}条 路由分布={replay.stats}")
+    else:
+        print(f"没有找到录制的请求 {recorded}，跳过")
@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+系统提示词模板
+1. 内置的助手人设 + ai_setting.txt 中用户自定义的设定，只在启动和文件变化时读取、拼接一次
+2. 通过文件签名（mtime/大小/inode）检测变化，修改 ai_setting.txt 后无需重启即可生效
+3. 对外提供预先构建好的、不可修改的系统消息对象，每次请求直接复用
+4. 当前时间、活跃窗口等每次都不同的环境信息只附加在最后一条用户消息的末尾，不写入历史，
+   系统提示词 + 工具定义 + 历史消息构成逐字节稳定的前缀，服务端的前缀缓存才能命中
+5. python prompt_template.py 会对比每次读文件拼接与缓存两种方式的耗时，演示热加载，并模拟前缀缓存的命中率
+"""
+import os
+import threading
+import time
+from datetime import datetime
+
+from file_watcher import file_signature
+
+AI_SETTING_FILE = "ai_setting.txt"
+# 两次检查文件是否变化的最短间隔（秒），避免每次请求都stat
+SETTING_CHECK_INTERVAL = 1.0
+
+BASE_PERSONA = "你是 Open Assistant，一个桌面AI助手。你的首要任务是使用工具来准确地完成用户请求。当用户的指令涉及文件操作、系统控制或网络请求时，必须调用相应的工具。绝不允许自行编造操作结果。在工具调用完成后，你必须根据工具返回的真实结果进行回复。回答要简短有力。"
+
+
+class FrozenMessage(dict):
+    """不可修改的消息字典，可以直接作为消息传给模型接口（序列化时与普通dict相同）"""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("系统消息是共享的只读对象，请复制后再修改")
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return dict(self)
+
+
+class SystemPrompt:
+    """缓存的系统提示词，message() 返回预先构建的系统消息"""
+
+    def __init__(self, setting_file=AI_SETTING_FILE, persona=BASE_PERSONA, check_interval=SETTING_CHECK_INTERVAL):
+        self.setting_file = setting_file
+        self.persona = persona
+        self.check_interval = check_interval
+        self.reload_count = 0
+        self._lock = threading.Lock()
+        self._signature = None
+        self._next_check = 0.0
+        self._message = None
+        self._reload()
+
+    def _reload(self):
+        signature = file_signature(self.setting_file)
+        try:
+            with open(self.setting_file, 'r', encoding='utf-8') as file:
+                setting = file.read()
+        except FileNotFoundError:
+            print(f"未找到 {self.setting_file}，仅使用内置人设")
+            setting = ""
+        self._message = FrozenMessage(role="system", content=self.persona + setting)
+        self._signature = signature
+        self.reload_count += 1
+        if self.reload_count > 1:
+            print(f"[提示词] {self.setting_file} 已变化，系统提示词已重新加载")
+
+    def message(self):
+        """返回当前的系统消息；距上次检查超过 check_interval 时顺带检查文件是否变化"""
+        now = time.monotonic()
+        if now >= self._next_check:
+            with self._lock:
+                if now >= self._next_check:
+                    self._next_check = now + self.check_interval
+                    if file_signature(self.setting_file) != self._signature:
+                        self._reload()
+        return self._message
+
+
+def format_context(active_window="", file_path="", now=None):
+    """本次请求的环境信息（易变部分）"""
+    now = now or datetime.today()
+    lines = ["[当前环境]", "当前时间为：" + now.strftime('%Y.%m.%d %H时%M分%S秒')]
+    if active_window:
+        lines.append("当前活跃的软件为：" + active_window)
+    if file_path:
+        lines.append("当前文件路径为：" + file_path)
+    return "\n".join(lines)
+
+
+def with_context(messages, context):
+    """返回新的消息列表，环境信息附加在最后一条用户消息之后；之前的消息原样保留"""
+    messages = list(messages)
+    for index in range(len(messages) - 1, -1, -1):
+        if messages[index].get("role") == "user":
+            message = dict(messages[index])
+            message["content"] = f"{message.get('content', '')}\n\n{context}"
+            messages[index] = message
+            break
+    return messages
+
+
+def _simulate_prefix_cache(turns=30):
+    """用桩服务器模拟服务端前缀缓存，对比修改前后多轮对话的缓存命中率"""
+    from openai import OpenAI
+    from mock_llm_server import MockLLMServer
+    from conversation_memory import ConversationMemory
+    from tool_selector import ToolIndex, StickyToolSelection, load_tools_from_source, LABELED_REQUESTS
+
+    tools = load_tools_from_source(os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"))
+    system_message = SystemPrompt(os.devnull).message()
+    queries = [query for query, _ in LABELED_REQUESTS][:turns]
+    windows = ["WINWORD.EXE", "chrome.exe", "Code.exe"]
+
+    def run(label, build):
+        server = MockLLMServer(reply="好的，已经完成。").start()
+        client = OpenAI(api_key="mock", base_url=server.base_url)
+        prompt_total = cached_total = 0
+        for turn, query in enumerate(queries):
+            now = datetime(2025, 1, 1, 9, 0, turn)
+            messages, request_tools = build(turn, query, now)
+            usage = client.chat.completions.create(model="mock", messages=messages, tools=request_tools).usage
+            prompt_total += usage.prompt_tokens
+            cached_total += usage.prompt_tokens_details.cached_tokens
+        server.stop()
+        print(f"[{label}] {len(queries)}轮 提示词共{prompt_total}token，命中缓存{cached_total}token "
+              f"({cached_total / prompt_total:.0%})，未命中{prompt_total - cached_total}token")
+
+    # 修改前：时间和窗口写在用户问题前面并存入历史，历史按最近10条滑动，每次发送全部工具
+    legacy_history = []
+
+    def legacy(turn, query, now):
+        nonlocal legacy_history
+        question = ("当前时间为：" + now.strftime('%Y.%m.%d %H时%M分%S秒') + "\n当前活跃的软件为：" +
+                    windows[turn % 3] + "\n用户问题：" + query)
+        legacy_history.append({"role": "user", "content": question})
+        legacy_history = legacy_history[-10:]
+        messages = [dict(system_message)] + legacy_history
+        legacy_history.append({"role": "assistant", "content": "好的，已经完成。"})
+        return messages, tools
+
+    def stable(select):
+        memory = ConversationMemory(token_budget=6000)
+
+        def build(turn, query, now):
+            memory.add("user", query)
+            messages = [system_message] + with_context(memory.messages(), format_context(windows[turn % 3], "", now))
+            memory.add("assistant", "好的，已经完成。")
+            return messages, select(query)
+
+        return build
+
+    run("修改前", legacy)
+    run("稳定前缀+全部工具(默认)", stable(StickyToolSelection(ToolIndex(tools)).select))
+    run("稳定前缀+只增不减的工具子集(TOOL_TOP_K=6)", stable(StickyToolSelection(ToolIndex(tools, top_k=6)).select))
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    setting_path = os.path.join(tempfile.mkdtemp(), "ai_setting.txt")
+    with open(setting_path, 'w', encoding='utf-8') as f:
+        f.write("你温柔善良。")
+    rounds = 20000
+
+    # 修改前：每次调用 chat() 都打开文件读取并拼接字符串
+    start = time.perf_counter()
+    for _ in range(rounds):
+        with open(setting_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        legacy = {"role": "system", "content": BASE_PERSONA + content}
+    legacy_us = (time.perf_counter() - start) / rounds * 1e6
+
+    prompt = SystemPrompt(setting_path)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        cached = prompt.message()
+    cached_us = (time.perf_counter() - start) / rounds * 1e6
+    assert cached == legacy
+    print(f"[每次读文件(修改前)] {legacy_us:.2f}us/次   [缓存] {cached_us:.3f}us/次")
+
+    # 热加载：修改文件后，最多 check_interval 秒内生效
+    prompt = SystemPrompt(setting_path, check_interval=0.1)
+    with open(setting_path, 'w', encoding='utf-8') as f:
+        f.write("你说话风趣幽默。")
+    time.sleep(0.15)
+    print(f"[热加载] 新设定已生效: {prompt.message()['content'].endswith('你说话风趣幽默。')}, "
+          f"加载次数={prompt.reload_count}")
+    try:
+        prompt.message()["content"] = "篡改"
+    except TypeError as e:
+        print(f"[只读] {e}")
+
+    _simulate_prefix_cache()
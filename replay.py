@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+离线回放：不需要 DashScope / 秘塔的API密钥，也不需要网络和Windows桌面
+1. mock_llm_server 按录制的对话脚本返回模型回复，包括流式输出的 tool_calls
+2. mock_mcp_server 提供与 server.py 同名同参数的全部工具，返回录制的工具结果
+3. 录制的对话逐条作为请求交给 AgentServiceHost 的主循环（与悬浮球发来的请求走同一条路径），
+   检查每一轮调用的工具、参数和最终回复是否与录制一致，并统计首token耗时和总耗时
+4. 可设置模型首包、流式分片和工具的模拟耗时；同样的输入每次得到同样的结果，性能改动可以在无网络的机器上对比
+5. python replay.py [对话文件...] [--rounds N] [--json 结果文件]；有任何一轮与录制不一致时退出码为1
+
+对话文件是JSON列表，每段对话 {"name": 名称, "turns": [轮次...]}，每一轮：
+    {"user": 用户问题,
+     "steps": [模型每一步的回复：{"content": 文本} 或 {"tool_calls": [{"name": 工具名, "arguments": {参数}}]}],
+     "tool_results": {工具名: 工具返回的文本}}
+最后一步是不带工具调用的回复，即这一轮的最终回答
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import sys
+import time
+
+from context_provider import ContextProvider, StubContextSource
+from llm_clients import ClientRegistry
+from mock_llm_server import MockLLMServer
+from mock_mcp_server import MockMCPServer
+from tracing import percentile, tracer
+
+REPLAY_FILES = ["replays/conversations.json"]
+# 单轮的等待上限（秒），与主循环中单个请求的超时一致
+TURN_TIMEOUT = 120.0
+
+
+def load_conversations(paths):
+    conversations = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        conversations += data if isinstance(data, list) else [data]
+    return conversations
+
+
+def expected_tool_calls(turn):
+    """这一轮录制的全部工具调用 [(工具名, 参数)]"""
+    calls = []
+    for step in turn["steps"]:
+        for call in step.get("tool_calls") or []:
+            arguments = call.get("arguments", {})
+            if isinstance(arguments, str):
+                arguments = json.loads(arguments or "{}")
+            calls.append((call["name"], arguments))
+    return calls
+
+
+def tool_calls_match(expected, actual):
+    """
+    录制的工具调用与桩工具实际收到的调用一一对应，与顺序无关（同一步的工具是并发执行的）；
+    桩函数收到的参数还包括没有传入的默认值，只比较录制中给出的参数
+    """
+    remaining = list(actual)
+    for name, arguments in expected:
+        match = next((call for call in remaining
+                      if call[0] == name and all(call[1].get(key) == value for key, value in arguments.items())),
+                     None)
+        if match is None:
+            return False
+        remaining.remove(match)
+    return not remaining
+
+
+class ReplayChannel:
+    """代替 AgentChannel：请求直接放入主循环的队列，响应交给等待这一轮结果的回放协程"""
+
+    def __init__(self):
+        self.requests = asyncio.Queue()
+        self.on_cancel = None
+        self._pending = {}  # request_id -> (响应future, 首个增量的时间)
+
+    async def receive(self):
+        return await self.requests.get()
+
+    def is_cancelled(self, request_id):
+        return False
+
+    async def send(self, message):
+        future, first_delta = self._pending.get(message.get("request_id"), (None, None))
+        if future is None:
+            return
+        if message.get("type") == "delta":
+            if not first_delta:
+                first_delta.append(time.perf_counter())
+        elif not future.done():
+            future.set_result(message)
+
+    async def request(self, request_id, content):
+        """发出一条请求，等待最终响应；返回 (响应消息, 首个增量的时间或None)"""
+        future = asyncio.get_running_loop().create_future()
+        first_delta = []
+        self._pending[request_id] = (future, first_delta)
+        now = time.time()
+        self.requests.put_nowait({"type": "request", "request_id": request_id, "content": content,
+                                  "timestamp": now, "received_at": now})
+        try:
+            response = await asyncio.wait_for(future, TURN_TIMEOUT)
+        finally:
+            self._pending.pop(request_id, None)
+        return response, first_delta[0] if first_delta else None
+
+
+async def replay_conversation(conversation, llm_server, mcp_server, registry, round_index):
+    """用一个新的 AgentServiceHost（空的对话历史）回放一段对话，返回每一轮的结果"""
+    from mcp_agent_and_server_start import AgentServiceHost
+
+    llm_server.script = conversation["turns"]
+    channel = ReplayChannel()
+    host = AgentServiceHost(mcp_server.mcp, channel=channel,
+                            context_provider=ContextProvider(StubContextSource("replay.exe", window_title="回放")))
+    host.client = registry.async_client()
+    # 与实际运行时一样，MCP会话在第一条请求之前就已建立，不计入第一轮的耗时
+    await host.session.start()
+    loop_task = asyncio.create_task(host.loop())
+    results = []
+    try:
+        for turn_index, turn in enumerate(conversation["turns"]):
+            mcp_server.results = turn.get("tool_results", {})
+            calls_before = len(mcp_server.calls)
+            request_id = f"replay-{round_index}-{conversation['name']}-{turn_index}"
+            start = time.perf_counter()
+            response, first_delta = await channel.request(request_id, turn["user"])
+            total_ms = (time.perf_counter() - start) * 1000
+
+            problems = []
+            actual_calls = mcp_server.calls[calls_before:]
+            if not tool_calls_match(expected_tool_calls(turn), actual_calls):
+                problems.append(f"工具调用不一致: 录制{expected_tool_calls(turn)} 实际{actual_calls}")
+            expected_reply = turn["steps"][-1].get("content", "")
+            content = response.get("content", "")
+            if response.get("type") != "response" or not content.endswith("AI:\n\n" + expected_reply):
+                problems.append(f"最终回复不一致: 录制{expected_reply!r} 实际{content!r}")
+            results.append({
+                "conversation": conversation["name"],
+                "turn": turn_index,
+                "round": round_index,
+                "ok": not problems,
+                "problems": problems,
+                "ttft_ms": round((first_delta - start) * 1000, 1) if first_delta else None,
+                "total_ms": round(total_ms, 1),
+                "tools": sorted(name for name, _ in actual_calls),
+            })
+    finally:
+        loop_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await loop_task
+        await host.session.close()
+        host.context_provider.stop()
+    return results
+
+
+def summarize(results, llm_server, mcp_server):
+    passed = sum(result["ok"] for result in results)
+    ttft = sorted(result["ttft_ms"] for result in results if result["ttft_ms"] is not None)
+    total = sorted(result["total_ms"] for result in results)
+    return {
+        "turns": len(results),
+        "passed": passed,
+        "ttft_p50_ms": percentile(ttft, 50),
+        "ttft_p95_ms": percentile(ttft, 95),
+        "total_p50_ms": percentile(total, 50),
+        "total_p95_ms": percentile(total, 95),
+        "llm_requests": llm_server.request_count,
+        "tool_calls": len(mcp_server.calls),
+    }
+
+
+async def replay(conversations, rounds=1, llm_delay=0.0, chunk_delay=0.0, tool_delay=0.0, verbose=False):
+    llm_server = MockLLMServer(reply="（回放脚本中没有这一步）", delay=llm_delay, chunk_delay=chunk_delay).start()
+    mcp_server = MockMCPServer(default_delay=tool_delay)
+    registry = ClientRegistry(base_url=llm_server.base_url, api_key="replay")
+    results = []
+    try:
+        for round_index in range(rounds):
+            for conversation in conversations:
+                # 主循环的日志很多，默认不输出，只保留回放的结果
+                with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO()):
+                    results += await replay_conversation(conversation, llm_server, mcp_server, registry,
+                                                         round_index)
+    finally:
+        await registry.aclose()
+        llm_server.stop()
+    return results, summarize(results, llm_server, mcp_server)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="离线回放录制的对话，检查结果并统计耗时")
+    parser.add_argument("files", nargs="*", help=f"对话文件，默认 {REPLAY_FILES}")
+    parser.add_argument("--rounds", type=int, default=1, help="全部对话回放的次数")
+    parser.add_argument("--llm-delay", type=float, default=0.0, help="模型首包的模拟耗时（秒）")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="流式响应每个分片的模拟耗时（秒）")
+    parser.add_argument("--tool-delay", type=float, default=0.0, help="每次工具调用的模拟耗时（秒）")
+    parser.add_argument("--json", help="把每一轮的结果和汇总写入该文件，便于对比改动前后")
+    parser.add_argument("--trace", help="记录span到该文件（默认不记录，避免混入 data/trace.jsonl）")
+    parser.add_argument("--verbose", action="store_true", help="输出主循环的日志")
+    args = parser.parse_args()
+
+    if args.trace:
+        tracer.path = args.trace
+        tracer.enabled = True
+    else:
+        tracer.enabled = False
+
+    all_results, summary = asyncio.run(replay(load_conversations(args.files or REPLAY_FILES), args.rounds,
+                                              args.llm_delay, args.chunk_delay, args.tool_delay, args.verbose))
+    for result in all_results:
+        status = "通过" if result["ok"] else "失败"
+        ttft = f"{result['ttft_ms']:.0f}ms" if result["ttft_ms"] is not None else "-"
+        print(f"[{status}] 第{result['round'] + 1}次 {result['conversation']} #{result['turn'] + 1} "
+              f"首token={ttft} 总耗时={result['total_ms']:.0f}ms 工具={result['tools']}")
+        for problem in result["problems"]:
+            print(f"    {problem}")
+    print(f"[回放] {summary['passed']}/{summary['turns']} 轮通过；首token p50={summary['ttft_p50_ms']:.0f}ms "
+          f"p95={summary['ttft_p95_ms']:.0f}ms；总耗时 p50={summary['total_p50_ms']:.0f}ms "
+          f"p95={summary['total_p95_ms']:.0f}ms；模型请求{summary['llm_requests']}次 工具调用{summary['tool_calls']}次")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "turns": all_results}, f, ensure_ascii=False, indent=2)
+    sys.exit(0 if summary["passed"] == summary["turns"] else 1)
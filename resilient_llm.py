@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+模型调用的重试、截止时间与对冲请求
+1. 可重试的错误（连接失败、超时、429、5xx）按带抖动的指数退避重试（full jitter，服务端给出 Retry-After 时优先使用），
+   4xx 参数错误等不可重试的错误直接抛出
+2. 每次调用有总的截止时间，重试和等待都不会超过它；剩余时间作为单次请求的 timeout 传给客户端。
+   流式调用的 attempt 在收到首个分片时即返回，截止时间只约束首包，之后由调用方按分片间的空闲时间判断是否卡住
+3. 可选的对冲请求：第一次请求在该模型近期耗时的 p95 之后仍未完成时再发一个相同的请求，取先成功的结果，
+   另一个被取消（同步调用无法中断线程，落败的请求在自己的 timeout 内结束）
+4. attempt(timeout) 为发起一次请求的函数，同步版返回结果，异步版返回协程；
+   客户端需设置 max_retries=0，避免与SDK自带的重试叠加
+5. python resilient_llm.py 会对注入了错误和长尾延迟的桩服务器（mock_llm_server.py）对比三种策略的成功率和延迟分位数
+"""
+import asyncio
+import concurrent.futures
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import openai
+
+LLM_MAX_ATTEMPTS = int(os.getenv("OPEN_ASSISTANT_LLM_MAX_ATTEMPTS", "3"))
+# 单次调用（含重试）的截止时间（秒）；流式调用只计到收到首个分片为止
+LLM_CALL_DEADLINE = float(os.getenv("OPEN_ASSISTANT_LLM_DEADLINE", "60"))
+# 流式响应收到首个分片之后，两个分片之间允许的最长空闲时间（秒）
+LLM_STREAM_IDLE_TIMEOUT = float(os.getenv("OPEN_ASSISTANT_LLM_STREAM_IDLE", "30"))
+# 退避时间：第n次重试在 [0, min(上限, 基数*2^n)] 中随机
+LLM_BACKOFF_BASE = 0.5
+LLM_BACKOFF_MAX = 8.0
+# 服务端要求的 Retry-After 超过该值时按上限等待
+MAX_RETRY_AFTER = 10.0
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+# 对冲请求默认关闭（OPEN_ASSISTANT_LLM_HEDGE=1 开启），会增加少量重复请求的费用
+LLM_HEDGE_ENABLED = os.getenv("OPEN_ASSISTANT_LLM_HEDGE", "0") == "1"
+HEDGE_QUANTILE = 95
+# 样本数足够之前使用默认的对冲等待时间（秒）
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY = 4.0
+HEDGE_MIN_DELAY = 0.3
+LATENCY_WINDOW = 200
+
+
+class DeadlineExceeded(TimeoutError):
+    """调用在截止时间内没有成功（TimeoutError 的子类，原有的超时处理同样适用）"""
+
+
+class HedgeLost(Exception):
+    """对冲的请求中落败的一方主动放弃（如另一个请求已经开始推送流式文本）"""
+
+
+def is_retryable(error):
+    if isinstance(error, openai.APIConnectionError):  # 含 APITimeoutError
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS
+    return False
+
+
+def retry_after(error):
+    """服务端在响应头中要求的等待秒数，没有时返回None"""
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(max(float(value), 0.0), MAX_RETRY_AFTER) if value is not None else None
+    except ValueError:
+        return None
+
+
+def backoff_delay(retry, base=LLM_BACKOFF_BASE, cap=LLM_BACKOFF_MAX, rng=random):
+    """带抖动的指数退避（full jitter）：多个客户端同时失败时不会在同一时刻一起重试"""
+    return rng.uniform(0, min(cap, base * (2 ** retry)))
+
+
+def _first_error(errors):
+    """所有请求都失败时，优先抛出真正的错误而不是落败方的 HedgeLost"""
+    return next((error for error in errors if not isinstance(error, HedgeLost)), errors[0])
+
+
+class LatencyTracker:
+    """每个模型最近若干次成功调用的耗时，用于计算对冲的等待时间"""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, key, seconds):
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+
+    def quantile(self, key, q):
+        """样本不足时返回None"""
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q / 100))]
+
+
+class ResilientLLM:
+    """
+    call_async(attempt, key=模型名) / call(attempt, key=模型名)
+    can_retry: 失败后是否允许重试（如流式输出已经推送了部分文本时不能重来）
+    discard: 对冲的两个请求同时成功时，用于释放落败一方的结果（如关闭流）
+    """
+
+    def __init__(self, max_attempts=LLM_MAX_ATTEMPTS, deadline=LLM_CALL_DEADLINE, hedge=LLM_HEDGE_ENABLED,
+                 backoff_base=LLM_BACKOFF_BASE, backoff_max=LLM_BACKOFF_MAX, rng=None, verbose=True):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.hedge = hedge
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rng = rng or random.Random()
+        self.verbose = verbose
+        self.latency = LatencyTracker()
+        self.stats = {"calls": 0, "retries": 0, "hedged": 0, "hedge_wins": 0, "failures": 0, "deadline": 0}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def hedge_delay(self, key):
+        p95 = self.latency.quantile(key, HEDGE_QUANTILE)
+        return max(p95 if p95 is not None else HEDGE_DEFAULT_DELAY, HEDGE_MIN_DELAY)
+
+    def _next_delay(self, error, retry, remaining):
+        delay = retry_after(error)
+        if delay is None:
+            delay = backoff_delay(retry, self.backoff_base, self.backoff_max, self.rng)
+        return delay if delay < remaining else None
+
+    def _log_retry(self, key, retry, error, delay):
+        self.stats["retries"] += 1
+        if self.verbose:
+            print(f"[模型重试] {key} 第{retry + 1}次请求失败（{type(error).__name__}: {error}），{delay:.2f}秒后重试")
+
+    def _log_hedge(self, key):
+        self.stats["hedged"] += 1
+        if self.verbose:
+            print(f"[模型重试] {key} 超过{self.hedge_delay(key):.1f}秒未完成，发出对冲请求")
+
+    def _won(self, key, elapsed, hedged_leg):
+        self.latency.record(key, elapsed)
+        if hedged_leg:
+            self.stats["hedge_wins"] += 1
+
+    async def call_async(self, attempt, key="", deadline=None, hedge=None, can_retry=None, discard=None):
+        deadline = self.deadline if deadline is None else deadline
+        hedge = self.hedge if hedge is None else hedge
+        end = time.monotonic() + deadline
+        self.stats["calls"] += 1
+        for retry in range(self.max_attempts):
+            remaining = end - time.monotonic()
+            try:
+                return await asyncio.wait_for(self._race_async(attempt, key, remaining, hedge, discard),
+                                              timeout=remaining)
+            except asyncio.TimeoutError:
+                self.stats["deadline"] += 1
+                raise DeadlineExceeded(f"{key} 在{deadline:.0f}秒内没有完成") from None
+            except Exception as e:
+                delay = None
+                if retry + 1 < self.max_attempts and is_retryable(e) and (can_retry is None or can_retry()):
+                    delay = self._next_delay(e, retry, end - time.monotonic())
+                if delay is None:
+                    self.stats["failures"] += 1
+                    raise
+                self._log_retry(key, retry, e, delay)
+                await asyncio.sleep(delay)
+
+    async def _race_async(self, attempt, key, timeout, hedge, discard):
+        start = time.monotonic()
+        legs = {asyncio.ensure_future(attempt(timeout)): start}
+        hedge_at = start + self.hedge_delay(key) if hedge else None
+        pending = set(legs)
+        errors = []
+        winner = None
+        try:
+            while pending:
+                wait = max(hedge_at - time.monotonic(), 0.0) if hedge_at is not None else None
+                done, pending = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 第一个请求超过了p95仍未完成：再发一个相同的请求，两者取先成功的
+                    hedge_at = None
+                    self._log_hedge(key)
+                    leg = asyncio.ensure_future(attempt(max(timeout - (time.monotonic() - start), 0.001)))
+                    legs[leg] = time.monotonic()
+                    pending.add(leg)
+                    continue
+                for task in done:
+                    if task.cancelled():
+                        errors.append(HedgeLost("请求被取消"))
+                    elif task.exception() is None:
+                        winner = task
+                        self._won(key, time.monotonic() - legs[task], legs[task] != start)
+                        return task.result()
+                    errors.append(task.exception())
+                # 对冲之前第一个请求就失败了：不再等待，交给外层决定是否重试
+                hedge_at = None
+            raise _first_error(errors)
+        finally:
+            for task in legs:
+                if not task.done():
+                    task.cancel()
+                elif task is not winner and discard is not None and not task.cancelled() \
+                        and task.exception() is None:
+                    await discard(task.result())
+
+    def call(self, attempt, key="", deadline=None, hedge=None):
+        """同步版本，供 summarize_write_ai、agent_vision 等同步的工具函数使用"""
+        deadline = self.deadline if deadline is None else deadline
+        hedge = self.hedge if hedge is None else hedge
+        end = time.monotonic() + deadline
+        self.stats["calls"] += 1
+        for retry in range(self.max_attempts):
+            try:
+                return self._race_sync(attempt, key, end, hedge)
+            except DeadlineExceeded:
+                self.stats["deadline"] += 1
+                raise
+            except Exception as e:
+                delay = None
+                if retry + 1 < self.max_attempts and is_retryable(e):
+                    delay = self._next_delay(e, retry, end - time.monotonic())
+                if delay is None:
+                    self.stats["failures"] += 1
+                    raise
+                self._log_retry(key, retry, e, delay)
+                time.sleep(delay)
+
+    def _race_sync(self, attempt, key, end, hedge):
+        start = time.monotonic()
+        if not hedge:
+            # 不对冲时直接在当前线程调用，截止时间由传给客户端的 timeout 保证
+            if end - start <= 0:
+                raise DeadlineExceeded(f"{key} 已超过截止时间")
+            try:
+                result = attempt(end - start)
+            except openai.APITimeoutError:
+                if time.monotonic() >= end:
+                    raise DeadlineExceeded(f"{key} 已超过截止时间") from None
+                raise
+            self._won(key, time.monotonic() - start, False)
+            return result
+
+        executor = self._get_executor()
+        legs = {executor.submit(attempt, end - start): start}
+        hedge_at = start + self.hedge_delay(key)
+        pending = set(legs)
+        errors = []
+        while pending:
+            now = time.monotonic()
+            if now >= end:
+                raise DeadlineExceeded(f"{key} 已超过截止时间")
+            wait = end - now if hedge_at is None else max(min(hedge_at, end) - now, 0.0)
+            done, pending = concurrent.futures.wait(pending, timeout=wait,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                if hedge_at is not None and time.monotonic() < end:
+                    hedge_at = None
+                    self._log_hedge(key)
+                    leg = executor.submit(attempt, max(end - time.monotonic(), 0.001))
+                    legs[leg] = time.monotonic()
+                    pending.add(leg)
+                continue
+            for future in done:
+                if future.exception() is None:
+                    self._won(key, time.monotonic() - legs[future], legs[future] != start)
+                    return future.result()
+                errors.append(future.exception())
+            hedge_at = None
+        raise _first_error(errors)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=8,
+                                                                       thread_name_prefix="llm-hedge")
+        return self._executor
+
+    def summary(self):
+        return (f"调用{self.stats['calls']}次 重试{self.stats['retries']}次 对冲{self.stats['hedged']}次"
+                f"（对冲胜出{self.stats['hedge_wins']}次） 失败{self.stats['failures']}次 "
+                f"超过截止时间{self.stats['deadline']}次")
+
+
+# 进程内共享：同一模型的耗时样本在各模块之间共用
+llm_caller = ResilientLLM()
+
+
+def _compare_policies(rounds=200):
+    """对注入错误和长尾延迟的桩服务器，对比 无重试 / 重试 / 重试+对冲 的成功率与延迟分位数"""
+    import httpx
+    from openai import AsyncOpenAI
+    from mock_llm_server import MockLLMServer
+
+    # 10% 的请求返回503，5% 的请求额外延迟2秒（长尾）
+    server = MockLLMServer(reply="好的。", delay=0.05, error_rate=0.1, tail_rate=0.05, tail_delay=2.0,
+                           seed=7).start()
+    messages = [{"role": "user", "content": "你好"}]
+
+    async def run(label, caller):
+        client = AsyncOpenAI(api_key="mock", base_url=server.base_url, max_retries=0,
+                             http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=20)))
+        latencies, failures = [], 0
+        for _ in range(rounds):
+            start = time.perf_counter()
+            try:
+                if caller is None:
+                    await client.chat.completions.create(model="mock", messages=messages)
+                else:
+                    await caller.call_async(
+                        lambda timeout: client.chat.completions.create(model="mock", messages=messages,
+                                                                       timeout=timeout),
+                        key="mock")
+                latencies.append((time.perf_counter() - start) * 1000)
+            except Exception:
+                failures += 1
+        await client.close()
+        latencies.sort()
+
+        def pick(q):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * q / 100))] if latencies else 0.0
+
+        print(f"[{label}] 成功率={(rounds - failures) / rounds:.1%} p50={pick(50):.0f}ms p95={pick(95):.0f}ms "
+              f"p99={pick(99):.0f}ms" + (f"  {caller.summary()}" if caller else ""))
+
+    async def main():
+        await run("无重试(修改前)", None)
+        await run("重试", ResilientLLM(backoff_base=0.05, rng=random.Random(1), verbose=False))
+        await run("重试+对冲", ResilientLLM(backoff_base=0.05, hedge=True, rng=random.Random(1), verbose=False))
+
+    asyncio.run(main())
+    print(f"桩服务器共收到{server.request_count}个请求，注入错误{server.error_count}次、长尾延迟{server.tail_count}次")
+    server.stop()
+
+
+if __name__ == '__main__':
+    _compare_policies()
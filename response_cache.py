@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+本地的回复缓存（默认关闭，设置环境变量 OPEN_ASSISTANT_RESPONSE_CACHE=1 开启）
+1. 键 = 归一化后的问题 + 上下文（活跃窗口的进程名、当前文件路径、截图的哈希、之前对话的哈希）；
+   "翻译成英文""详细说说"这类追问的回答取决于前文，前文不同就不会命中
+2. 先精确匹配，再在上下文相同的条目中按字符二元组的相似度匹配近似重复的问题
+3. 每个条目有自己的过期时间，条目数超过上限时淘汰最久未使用的（LRU）
+4. 只有回答过程中用到的工具全部标记为可缓存时才写入缓存；打开软件、写文件等有副作用的工具永远不会被缓存
+5. 当前时间只在每次请求的环境信息中：问几点的问题不缓存，问今天、星期几等与日期有关的问题按日期分开缓存
+6. python response_cache.py 会演示命中、近似命中、过期和不可缓存的情况
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from types import SimpleNamespace
+
+RESPONSE_CACHE_ENABLED = os.getenv("OPEN_ASSISTANT_RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_MAX_ENTRIES = 256
+# 近似重复的相似度阈值（字符二元组的Jaccard相似度）；
+# 不宜再低："明天天气怎么样"与"今天天气怎么样"的相似度约为0.71
+NEAR_DUPLICATE_THRESHOLD = 0.8
+# 不调用任何工具的回答的有效期（秒）
+DEFAULT_TTL = 600
+
+# 可缓存的工具及其结果的有效期（秒）；未列出的工具视为有副作用或依赖实时状态，不可缓存
+CACHEABLE_TOOLS = {
+    "fetch_current_weather_for_city": 600,
+    "search_chat": 1800,
+    "search_in_websites": 1800,
+    "explain_file_content": 3600,
+}
+
+# 回答取决于当前时刻的问题，不缓存
+_CLOCK_WORDS = re.compile(r"几点|几分|什么时候了|现在时间|现在的时间|什么时间|时间是|时间多少|北京时间")
+# 回答取决于当天日期的问题，键中带上日期，第二天不会命中前一天的回答
+_DATE_WORDS = re.compile(r"今天|今日|今晚|明天|后天|昨天|前天|星期|周几|礼拜|几号|几月|日期|今年|本周|这周|下周|上周|本月|这个月|节日|放假")
+
+# 归一化时去掉的语气词和客套话
+_FILLER = re.compile(r"请问|请|帮我|帮忙|麻烦|一下|的|吧|呢|呀|啊|哦|嘛")
+_PUNCTUATION = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize_query(text):
+    """全角转半角、转小写、去掉标点空白和语气词"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = _FILLER.sub("", text)
+    return _PUNCTUATION.sub("", text)
+
+
+def _bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+
+def similarity(a, b):
+    """两个归一化问题的字符二元组Jaccard相似度"""
+    a, b = _bigrams(a), _bigrams(b)
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def file_hash(path):
+    """截图等文件内容的哈希，文件不存在时返回空字符串"""
+    if not path or not os.path.exists(path):
+        return ""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def history_hash(history):
+    """之前各轮对话（角色和内容）的哈希，没有历史时返回空字符串"""
+    if not history:
+        return ""
+    digest = hashlib.sha256()
+    for message in history:
+        digest.update(f"{message.get('role', '')}\0{message.get('content', '')}\0".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def time_scope(query, now=None):
+    """问题依赖的时间范围：None 表示取决于当前时刻（不缓存），日期字符串表示按天区分，空字符串表示与时间无关"""
+    if _CLOCK_WORDS.search(query or ""):
+        return None
+    if _DATE_WORDS.search(query or ""):
+        return time.strftime("%Y-%m-%d", time.localtime(now))
+    return ""
+
+
+def entry_ttl(tools_used, tool_policy=CACHEABLE_TOOLS, default_ttl=DEFAULT_TTL):
+    """根据回答用到的工具决定有效期；用到任何不可缓存的工具时返回None"""
+    ttl = default_ttl
+    for name in tools_used:
+        if name not in tool_policy:
+            return None
+        ttl = min(ttl, tool_policy[name])
+    return ttl
+
+
+class ResponseCache:
+    """按 (归一化问题, 上下文) 缓存最终回复"""
+
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES, threshold=NEAR_DUPLICATE_THRESHOLD,
+                 tool_policy=None, default_ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.tool_policy = CACHEABLE_TOOLS if tool_policy is None else tool_policy
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()  # (问题, 上下文) -> (回复, 过期时间)
+        self._lock = threading.Lock()
+        self.stats = {"hit": 0, "near_hit": 0, "miss": 0, "stored": 0, "skipped": 0}
+
+    def make_key(self, query, active_window="", file_path="", screenshot_path=None, now=None, history=None):
+        """history 是本次问题之前的对话消息；时间范围必须放在上下文的最后"""
+        context = ((active_window or "").lower(), file_path or "", file_hash(screenshot_path), history_hash(history),
+                   time_scope(query, now))
+        return normalize_query(query), context
+
+    def get(self, key):
+        """返回缓存的回复（具有content属性），未命中时返回None"""
+        query, context = key
+        now = time.time()
+        if context[-1] is None:
+            self.stats["miss"] += 1
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            matched = key if entry else None
+            if entry is None and query:
+                best = 0.0
+                for (other_query, other_context), candidate in self._entries.items():
+                    if other_context != context or candidate[1] <= now:
+                        continue
+                    score = similarity(query, other_query)
+                    if score >= self.threshold and score > best:
+                        best, matched, entry = score, (other_query, other_context), candidate
+            if entry is None or entry[1] <= now:
+                if matched is not None:
+                    self._entries.pop(matched, None)
+                self.stats["miss"] += 1
+                return None
+            self._entries.move_to_end(matched)
+            self.stats["hit" if matched == key else "near_hit"] += 1
+        return SimpleNamespace(role="assistant", content=entry[0], cached=True)
+
+    def put(self, key, content, tools_used=()):
+        """写入回复；用到不可缓存的工具时不写入，返回是否写入"""
+        ttl = entry_ttl(tools_used, self.tool_policy, self.default_ttl)
+        if ttl is None or not content or not key[0] or key[1][-1] is None:
+            self.stats["skipped"] += 1
+            return False
+        with self._lock:
+            self._entries[key] = (content, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self.stats["stored"] += 1
+        return True
+
+    def summary(self):
+        lookups = self.stats["hit"] + self.stats["near_hit"] + self.stats["miss"]
+        hit_rate = (self.stats["hit"] + self.stats["near_hit"]) / lookups if lookups else 0.0
+        return f"条目={len(self._entries)} 命中率={hit_rate:.0%} {self.stats}"
+
+
+if __name__ == '__main__':
+    cache = ResponseCache(default_ttl=600, tool_policy={**CACHEABLE_TOOLS, "fetch_current_weather_for_city": 0.2})
+    weather_key = cache.make_key("今天天气怎么样？", "chrome.exe")
+    cache.put(weather_key, "北京今天晴，25度。", ["fetch_current_weather_for_city"])
+    print("精确命中:", cache.get(cache.make_key("今天天气怎么样", "chrome.exe")))
+    print("归一化后相同:", cache.get(cache.make_key("请问今天的天气怎么样呀", "chrome.exe")))
+    print("近似命中:", cache.get(cache.make_key("今天天气怎么样了", "chrome.exe")))
+    print("意思不同:", cache.get(cache.make_key("明天天气怎么样", "chrome.exe")))
+    print("窗口不同:", cache.get(cache.make_key("今天天气怎么样", "winword.exe")))
+    time.sleep(0.25)
+    print("已过期:", cache.get(weather_key))
+
+    summary_key = cache.make_key("总结一下这个", "winword.exe", "D:\\a.docx")
+    print("有副作用的工具不缓存:", cache.put(summary_key, "已打开Word。", ["open_app"]))
+    cache.put(summary_key, "这篇文档讲的是……", [])
+    print("文件不同:", cache.get(cache.make_key("总结一下这个", "winword.exe", "D:\\b.docx")))
+    print("文件相同:", cache.get(cache.make_key("帮我总结这个", "winword.exe", "D:\\a.docx")))
+
+    # 当前时间不在键中：问几点的回答不能缓存，问星期几的回答第二天不能命中
+    clock_stored = cache.put(cache.make_key("现在几点了"), "现在是10点05分。", [])
+    print("问几点不缓存:", not clock_stored)
+    today = time.mktime((2024, 10, 18, 23, 59, 0, 0, 0, -1))
+    cache.put(cache.make_key("今天星期几", now=today), "今天是星期五。", [])
+    same_day = cache.get(cache.make_key("今天星期几", now=today + 30))
+    next_day = cache.get(cache.make_key("今天星期几", now=today + 120))
+    print("同一天命中:", same_day is not None, "第二天不命中:", next_day is None)
+    if clock_stored or same_day is None or next_day is not None:
+        raise SystemExit("与时间有关的问题缓存错误")
+
+    # 追问的回答取决于前文：前文不同不能命中，前文相同可以命中
+    first_turn = [{"role": "user", "content": "介绍一下长城"}, {"role": "assistant", "content": "长城是……"}]
+    other_turn = [{"role": "user", "content": "介绍一下故宫"}, {"role": "assistant", "content": "故宫是……"}]
+    cache.put(cache.make_key("翻译成英文", "chrome.exe", history=first_turn), "The Great Wall is ...", [])
+    other_history = cache.get(cache.make_key("翻译成英文", "chrome.exe", history=other_turn))
+    no_history = cache.get(cache.make_key("翻译成英文", "chrome.exe"))
+    same_history = cache.get(cache.make_key("翻译成英文", "chrome.exe", history=list(first_turn)))
+    print("前文不同不命中:", other_history is None, "没有前文不命中:", no_history is None,
+          "前文相同命中:", same_history is not None)
+    if other_history is not None or no_history is not None or same_history is None:
+        raise SystemExit("追问的缓存没有区分前文")
+
+    small = ResponseCache(max_entries=2)
+    for text in ["问题一", "问题二", "问题三"]:
+        small.put(small.make_key(text), "回答")
+    print("LRU淘汰最早的条目:", small.get(small.make_key("问题一")) is None)
+    print(cache.summary())
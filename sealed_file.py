@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+文件通道的消息格式：追加写入的消息日志（请求队列、响应日志）
+1. 每行一条 {"seq": 序号, "checksum": 校验和, "payload": 消息} 记录，整行一次写入；
+   每个文件只由一个 SealedLog 实例写入（悬浮球写请求队列，Agent写响应日志），同一实例的多个线程共用一把锁，序号按文件顺序单调递增
+2. 读方记录已读到的字节偏移，只消费以换行结尾且校验通过的完整行，不会读到写了一半的消息；
+   并检查序号是否递增，不递增的记录（重复写入或多个实例同时写）会被统计并打印，但仍然交给调用方
+3. 允许多条消息同时排队，读方一次取出全部新记录
+4. python sealed_file.py 会用多个线程同时追加、一个线程读取，统计丢失、重复和乱序的消息以及序号不递增的记录
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+# 文件开头用于识别日志文件的字节数：第一条记录的序号和校验和的开头，文件被删除重建后必然不同
+IDENTITY_BYTES = 64
+
+
+def payload_checksum(payload):
+    """消息内容的校验和（键排序后的JSON做sha256）"""
+    body = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(body).hexdigest()
+
+
+class SealedLog:
+    """
+    追加写入的JSONL消息日志，每行一条 {"seq", "checksum", "payload"} 记录
+    读方记录已读到的字节偏移，只消费以换行结尾且校验通过的完整行；
+    同时记下文件开头的字节，日志被删除重建（例如悬浮球启动时清理）后从新文件的开头读起
+    """
+
+    def __init__(self, path, from_start=False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._write_seq = time.time_ns()
+        self._offset = 0
+        self._identity = None
+        self._last_seq = None
+        self.seq_errors = 0  # 读到的序号不递增的记录数
+        # 启动前已存在的记录默认视为已读；from_start=True 时从头读取（例如离线分析录制的请求队列）
+        if not from_start:
+            try:
+                with open(path, 'rb') as f:
+                    self._identity = self._read_identity(f)
+                    self._offset = f.seek(0, os.SEEK_END)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _read_identity(f):
+        f.seek(0)
+        head = f.read(IDENTITY_BYTES)
+        return head if len(head) == IDENTITY_BYTES else None
+
+    def append(self, payload):
+        """追加一条消息，返回其序号"""
+        with self._lock:
+            self._write_seq = max(self._write_seq + 1, time.time_ns())
+            seq = self._write_seq
+            record = {"seq": seq, "checksum": payload_checksum(payload), "payload": payload}
+            line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            # 整行一次写入，追加模式下不会与其他记录交错
+            with open(self.path, 'ab') as f:
+                f.write(line)
+        return seq
+
+    def read_new(self):
+        """读取所有尚未读过的完整记录，返回消息列表"""
+        try:
+            with open(self.path, 'rb') as f:
+                identity = self._read_identity(f)
+                size = f.seek(0, os.SEEK_END)
+                replaced = identity is not None and self._identity is not None and identity != self._identity
+                if size < self._offset or replaced:
+                    # 日志被清理或删除重建过：旧的偏移落在新文件的记录中间，从头开始读
+                    self._offset = 0
+                    self._last_seq = None
+                if identity is not None:
+                    self._identity = identity
+                f.seek(self._offset)
+                data = f.read(size - self._offset)
+        except OSError:
+            return []
+
+        end = data.rfind(b"\n")
+        if end < 0:
+            return []
+        self._offset += end + 1
+
+        payloads = []
+        for line in data[:end].split(b"\n"):
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except ValueError:
+                print(f"[调试] {self.path} 存在无法解析的记录，已跳过")
+                continue
+            if record.get("checksum") != payload_checksum(record.get("payload")):
+                print(f"[调试] {self.path} 记录校验和不匹配，已跳过")
+                continue
+            seq = record.get("seq")
+            if isinstance(seq, int):
+                if self._last_seq is not None and seq <= self._last_seq:
+                    self.seq_errors += 1
+                    print(f"[调试] {self.path} 记录序号没有递增（{self._last_seq} -> {seq}）")
+                self._last_seq = seq if self._last_seq is None else max(seq, self._last_seq)
+            payloads.append(record["payload"])
+        return payloads
+
+
+def _hammer_log(path, messages=2000, writers=4):
+    """
+    多个线程共用一个 SealedLog 同时追加、一个线程持续读取，
+    返回 (丢失条数, 重复条数, 是否有写方的消息乱序, 序号不递增的记录数)
+    """
+    writer_log, reader_log = SealedLog(path), SealedLog(path)
+    received = []
+
+    def writer(writer_id):
+        for index in range(messages // writers):
+            writer_log.append({"writer": writer_id, "index": index, "content": "消息内容" * (index % 50)})
+
+    writer_threads = [threading.Thread(target=writer, args=(writer_id,)) for writer_id in range(writers)]
+    for thread in writer_threads:
+        thread.start()
+    while True:
+        # 先看写方是否都已结束再读取：结束之后读到空批次，才说明全部消息都已读完
+        finished = not any(thread.is_alive() for thread in writer_threads)
+        batch = reader_log.read_new()
+        received.extend((payload["writer"], payload["index"]) for payload in batch)
+        if finished and not batch:
+            break
+    for thread in writer_threads:
+        thread.join()
+    expected = writers * (messages // writers)
+    # 不同写方之间的先后不确定，每个写方自己的消息应按写入顺序读到
+    disordered = any([index for writer_id, index in received if writer_id == w] !=
+                     sorted(index for writer_id, index in received if writer_id == w) for w in range(writers))
+    return (expected - len(set(received)), len(received) - len(set(received)), disordered,
+            reader_log.seq_errors)
+
+
+
+def _replaced_log(path):
+    """读方读过一部分后日志被删除重建、且新文件已经比旧的偏移更长时，返回读方读到的新记录数"""
+    reader_log = SealedLog(path)
+    old_log = SealedLog(path)
+    for index in range(3):
+        old_log.append({"index": index})
+    reader_log.read_new()
+    os.remove(path)
+    new_log = SealedLog(path)
+    for index in range(10):
+        new_log.append({"index": index, "content": "新文件"})
+    return len(reader_log.read_new())
+
+if __name__ == '__main__':
+    import tempfile
+
+    temp_dir = tempfile.mkdtemp()
+    log_lost, log_duplicated, log_disordered, seq_errors = _hammer_log(os.path.join(temp_dir, "queue.jsonl"))
+    print(f"[追加日志] 4个写线程 丢失 {log_lost} 条, 重复 {log_duplicated} 条, 乱序 {log_disordered}, "
+          f"序号不递增 {seq_errors} 条")
+    if log_lost or log_duplicated or log_disordered or seq_errors:
+        raise SystemExit("追加日志压测失败")
+    print("追加日志压测通过：没有丢失、重复或乱序的消息")
+
+    replaced_count = _replaced_log(os.path.join(temp_dir, "replaced.jsonl"))
+    if replaced_count != 10:
+        raise SystemExit(f"日志删除重建后读到{replaced_count}条，应为10条")
+    print("日志删除重建后从新文件开头读取：10条全部读到")
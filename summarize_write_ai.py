@@ -1,26 +1,27 @@
-import os
-from openai import OpenAI
-
 import re
 from dotenv import load_dotenv
+from model_router import ModelRouter
+from resilient_llm import llm_caller
+from llm_clients import get_client
 
 load_dotenv()  # 默认会加载根目录下的.env文件
 
+# 长文本的总结、写作和代码生成/讲解输出很长且不是流式的，截止时间沿用原来SDK默认的600秒超时，
+# 不使用模型调用默认的截止时间（秒）
+LONG_OUTPUT_DEADLINE = 600
+
+# 按文本长度选择总结用的模型（阈值见 model_router.DEFAULT_MODEL_POLICY）
+summary_router = ModelRouter()
+
 def get_file_summary(file_content):
     #realtime_tts_speak("正在总结内容", rate=29000)
     if len(file_content) > 80000:
         return "文档长度过长。模型无法总结。"
-    elif len(file_content)<6000:
-        model='qwen-flash'
-    else:
-        model='qwen-long'
+    model = summary_router.route_summary(file_content)
     try:
-        client = OpenAI(
-            # 若没有配置环境变量，请用百炼API Key将下行替换为：api_key="sk-xxx",
-            api_key=os.getenv("ALIBABA_CLOUD_ACCESS_KEY_ID"),
-            base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-        )
-        completion = client.chat.completions.create(
+        # 共享的客户端和连接池（llm_clients），不再每次调用都重新建立连接和TLS握手
+        client = get_client()
+        completion = llm_caller.call(lambda timeout: client.chat.completions.create(
             # 模型列表：https://help.aliyun.com/zh/model-studio/getting-started/models
             model=model,
             messages=[
@@ -30,7 +31,8 @@ def get_file_summary(file_content):
             # Qwen3模型通过enable_thinking参数控制思考过程（开源版默认True，商业版默认False）
             # 使用Qwen3开源版模型时，若未启用流式输出，请将下行取消注释，否则会报错
             # extra_body={"enable_thinking": False},
-        )
+            timeout=timeout,
+        ), key=model, deadline=LONG_OUTPUT_DEADLINE)
         content = completion.choices[0].message.content
         return content
     except Exception as e:
@@ -40,12 +42,9 @@ def get_file_summary(file_content):
 
 def write_ai_model(user_content):
     try:
-        client = OpenAI(
-            # 若没有配置环境变量，请用百炼API Key将下行替换为：api_key="sk-xxx",
-            api_key=os.getenv("ALIBABA_CLOUD_ACCESS_KEY_ID"),
-            base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-        )
-        completion = client.chat.completions.create(
+        # 共享的客户端和连接池（llm_clients），不再每次调用都重新建立连接和TLS握手
+        client = get_client()
+        completion = llm_caller.call(lambda timeout: client.chat.completions.create(
             # 模型列表：https://help.aliyun.com/zh/model-studio/getting-started/models
             model="qwen-long",
             messages=[
@@ -55,7 +54,8 @@ def write_ai_model(user_content):
             # Qwen3模型通过enable_thinking参数控制思考过程（开源版默认True，商业版默认False）
             # 使用Qwen3开源版模型时，若未启用流式输出，请将下行取消注释，否则会报错
             # extra_body={"enable_thinking": False},
-        )
+            timeout=timeout,
+        ), key="qwen-long", deadline=LONG_OUTPUT_DEADLINE)
         content = completion.choices[0].message.content
         return content
     except Exception as e:
@@ -80,12 +80,9 @@ def extract_code_blocks(text):
 
 def code_ai_model(user_content):
     try:
-        client = OpenAI(
-            # 若没有配置环境变量，请用百炼API Key将下行替换为：api_key="sk-xxx",
-            api_key=os.getenv("ALIBABA_CLOUD_ACCESS_KEY_ID"),
-            base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-        )
-        completion = client.chat.completions.create(
+        # 共享的客户端和连接池（llm_clients），不再每次调用都重新建立连接和TLS握手
+        client = get_client()
+        completion = llm_caller.call(lambda timeout: client.chat.completions.create(
             # 模型列表：https://help.aliyun.com/zh/model-studio/getting-started/models
             model="qwen3-coder-flash",
             messages=[
@@ -95,7 +92,8 @@ def code_ai_model(user_content):
             # Qwen3模型通过enable_thinking参数控制思考过程（开源版默认True，商业版默认False）
             # 使用Qwen3开源版模型时，若未启用流式输出，请将下行取消注释，否则会报错
             # extra_body={"enable_thinking": False},
-        )
+            timeout=timeout,
+        ), key="qwen3-coder-flash", deadline=LONG_OUTPUT_DEADLINE)
         content = completion.choices[0].message.content
         content = extract_code_blocks(content)
         return content[0]
@@ -105,12 +103,9 @@ def code_ai_model(user_content):
 
 def code_ai_explain_model(user_content):
     try:
-        client = OpenAI(
-            # 若没有配置环境变量，请用百炼API Key将下行替换为：api_key="sk-xxx",
-            api_key=os.getenv("ALIBABA_CLOUD_ACCESS_KEY_ID"),
-            base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-        )
-        completion = client.chat.completions.create(
+        # 共享的客户端和连接池（llm_clients），不再每次调用都重新建立连接和TLS握手
+        client = get_client()
+        completion = llm_caller.call(lambda timeout: client.chat.completions.create(
             # 模型列表：https://help.aliyun.com/zh/model-studio/getting-started/models
             model="qwen3-coder-flash",
             messages=[
@@ -120,7 +115,8 @@ def code_ai_explain_model(user_content):
             # Qwen3模型通过enable_thinking参数控制思考过程（开源版默认True，商业版默认False）
             # 使用Qwen3开源版模型时，若未启用流式输出，请将下行取消注释，否则会报错
             # extra_body={"enable_thinking": False},
-        )
+            timeout=timeout,
+        ), key="qwen3-coder-flash", deadline=LONG_OUTPUT_DEADLINE)
         content = completion.choices[0].message.content
         # content = extract_code_blocks(content)
         return content
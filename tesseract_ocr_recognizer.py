@@ -3,6 +3,7 @@ from PIL import Image
 import cv2 
 import os 
 import subprocess
+import re
 
 # 自动检测Tesseract路径
 def find_tesseract_path():
@@ -81,7 +82,30 @@ def ocr_image(img_path, lang='chi_sim'):
     except Exception as e:
         return f"OCR识别出错: {str(e)}"
 
-if __name__ == '__main__': 
+def ocr_image_data(img_path, lang='chi_sim+eng'):
+    """
+    返回 (文字, 平均置信度0-100)，供 agent 判断识别结果是否可信
+    与 ocr_image 不同，出错时直接抛出异常，而不是返回错误提示文字
+    """
+    if not tesseract_path:
+        raise pytesseract.TesseractNotFoundError()
+    pil_img = Image.fromarray(preprocess(img_path))
+    data = pytesseract.image_to_data(pil_img, lang=lang, output_type=pytesseract.Output.DICT)
+    lines = {}
+    confidences = []
+    for i, word in enumerate(data['text']):
+        confidence = float(data['conf'][i])
+        if confidence < 0 or not word.strip():
+            continue
+        confidences.append(confidence)
+        key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        lines.setdefault(key, []).append(word)
+    # 中文按字切分后不需要空格，英文单词之间保留空格
+    text = "\n".join(" ".join(words) for _, words in sorted(lines.items()))
+    text = re.sub(r'(?<=[一-鿿]) (?=[一-鿿])', '', text)
+    return text, (sum(confidences) / len(confidences) if confidences else 0.0)
+
+if __name__ == '__main__':
     print("=== Tesseract OCR文字识别工具 ===")
     print()
     
@@ -0,0 +1,228 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+按相关度挑选每次请求要发给模型的工具
+1. 用工具名和描述建立本地 BM25 索引（中文按相邻两字切分，英文按单词切分），不依赖分词库
+2. 设置 top-k 后每条用户消息只发送得分最高的 top-k 个工具，再加上一组始终发送的常用工具；
+   默认 top-k 为0，始终发送全部工具（见下方 TOOL_TOP_K 的说明）
+3. 可选传入 embed 回调（文本列表 -> 向量列表），与 BM25 得分加权融合
+4. StickyToolSelection 让同一段对话中发送的工具只增不减、顺序固定，工具定义不会打断服务端的前缀缓存
+5. python tool_selector.py 会在一组标注好的示例请求上统计召回率和节省的提示词token
+"""
+import json
+import math
+import os
+import re
+from collections import Counter
+
+# 每次请求按相关度挑选的工具数，0 表示不挑选、发送全部工具（默认）
+# 取舍：工具定义位于提示词开头，子集一变，其后的历史消息全部无法命中服务端的前缀缓存。
+# python prompt_template.py 的模拟中，top_k=6 时单次提示词更小，但缓存命中率从约95%降到约40%，
+# 未命中的token反而是发送全部工具时的5倍多；只有服务端不做前缀缓存、或工具多到放不下时才值得打开
+TOOL_TOP_K = int(os.getenv("OPEN_ASSISTANT_TOOL_TOP_K", "0"))
+# 始终发送的工具（逗号分隔）
+ALWAYS_ON_TOOLS = [name for name in os.getenv(
+    "OPEN_ASSISTANT_ALWAYS_ON_TOOLS",
+    "search_chat,identify_current_screen_save_img_and_get_response,open_app"
+).split(",") if name]
+# 向量相似度在融合得分中的权重（提供 embed 回调时生效）
+EMBEDDING_WEIGHT = 0.5
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_CJK_RUN = re.compile(r"[一-鿿]+")
+_WORD = re.compile(r"[a-zA-Z]+|\d+")
+# 描述里几乎每个工具都会出现的词，不参与打分
+STOP_TOKENS = {"args", "str", "list", "return", "returns", "param", "user", "content", "用户", "内容", "当前",
+               "进行", "操作", "返回", "指定", "结果", "支持", "要求", "如果", "默认", "可以", "该函数", "函数",
+               "none", "the", "to", "a", "of", "and", "or", "is", "optional", "bool", "true", "false"}
+
+
+def tokenize(text):
+    """中文连续字符切成相邻两字（单字词保留单字），英文和数字按单词切分并转小写"""
+    tokens = []
+    for run in _CJK_RUN.findall(text or ""):
+        if len(run) == 1:
+            tokens.append(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(word.lower() for word in _WORD.findall(text or ""))
+    return [token for token in tokens if token not in STOP_TOKENS]
+
+
+def tool_text(tool):
+    """参与索引的文本：工具名（下划线拆成单词）+ 描述"""
+    function = tool["function"]
+    return function["name"].replace("_", " ") + "\n" + (function.get("description") or "")
+
+
+class ToolIndex:
+    """
+    tools: OpenAI 格式的工具列表 [{"type": "function", "function": {"name", "description", ...}}]
+    """
+
+    def __init__(self, tools, top_k=TOOL_TOP_K, always_on=ALWAYS_ON_TOOLS, embed=None):
+        self.tools = list(tools)
+        self.top_k = top_k
+        self.always_on = [name for name in always_on if any(t["function"]["name"] == name for t in self.tools)]
+        self.embed = embed
+
+        self._docs = [Counter(tokenize(tool_text(tool))) for tool in self.tools]
+        self._lengths = [sum(doc.values()) for doc in self._docs]
+        self._avg_length = sum(self._lengths) / len(self._lengths) if self._lengths else 0
+        document_frequency = Counter(token for doc in self._docs for token in doc)
+        count = len(self._docs)
+        self._idf = {token: math.log(1 + (count - df + 0.5) / (df + 0.5)) for token, df in document_frequency.items()}
+        self._vectors = embed([tool_text(tool) for tool in self.tools]) if embed else None
+
+    def scores(self, query):
+        """每个工具对查询的 BM25 得分（有向量时与余弦相似度融合）"""
+        query_tokens = set(tokenize(query))
+        scores = []
+        for doc, length in zip(self._docs, self._lengths):
+            score = 0.0
+            for token in query_tokens:
+                frequency = doc.get(token)
+                if frequency:
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * length / self._avg_length)
+                    score += self._idf[token] * frequency * (BM25_K1 + 1) / (frequency + norm)
+            scores.append(score)
+        if self._vectors is not None:
+            top = max(scores) or 1.0
+            query_vector = self.embed([query])[0]
+            scores = [(1 - EMBEDDING_WEIGHT) * score / top + EMBEDDING_WEIGHT * _cosine(query_vector, vector)
+                      for score, vector in zip(scores, self._vectors)]
+        return scores
+
+    def select(self, query):
+        """返回本次请求要发送的工具，保持工具的原始顺序"""
+        if self.top_k <= 0 or len(self.tools) <= self.top_k + len(self.always_on):
+            return self.tools
+        scores = self.scores(query)
+        ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])
+        chosen = set(ranked[:self.top_k])
+        chosen.update(i for i, tool in enumerate(self.tools) if tool["function"]["name"] in self.always_on)
+        return [tool for i, tool in enumerate(self.tools) if i in chosen]
+
+
+class StickyToolSelection:
+    """
+    工具定义位于提示词中历史消息之前，每轮换一组工具会让服务端的前缀缓存全部失效
+    这里让发送的工具只增不减：常驻工具在最前，之后按首次被选中的顺序追加，
+    只有出现新工具的那一轮缓存失效；超过 max_tools 个或调用方要求时（例如历史被压缩）重新开始
+    """
+
+    def __init__(self, index, max_tools=None):
+        self.index = index
+        self.max_tools = max_tools or 2 * index.top_k + len(index.always_on)
+        self._names = []
+        self.reset()
+
+    def reset(self):
+        self._names = list(self.index.always_on)
+
+    def select(self, query):
+        if self.index.top_k <= 0:
+            # 不挑选时工具列表本身就是固定的
+            return self.index.tools
+        selected = [tool["function"]["name"] for tool in self.index.select(query)]
+        new_names = [name for name in selected if name not in self._names]
+        if new_names and len(self._names) + len(new_names) > self.max_tools:
+            self.reset()
+            new_names = [name for name in selected if name not in self._names]
+        self._names.extend(new_names)
+        by_name = {tool["function"]["name"]: tool for tool in self.index.tools}
+        return [by_name[name] for name in self._names if name in by_name]
+
+
+def _cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def load_tools_from_source(path="server.py"):
+    """不导入 server.py（它依赖桌面环境），直接从源码中解析出 @mcp.tool() 工具的名称、文档和参数"""
+    import ast
+
+    with open(path, 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    tools = []
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and any("tool" in ast.unparse(d) for d in node.decorator_list):
+            properties = {arg.arg: {"type": ast.unparse(arg.annotation) if arg.annotation else "string"}
+                          for arg in node.args.args}
+            tools.append({"type": "function", "function": {
+                "name": node.name,
+                "description": ast.get_docstring(node) or "",
+                "input_schema": {"type": "object", "properties": properties},
+            }})
+    return tools
+
+
+# 标注好的示例请求：(用户消息, 期望用到的工具)
+LABELED_REQUESTS = [
+    ("今天北京天气怎么样", {"fetch_current_weather_for_city"}),
+    ("明天上海会下雨吗", {"fetch_current_weather_for_city"}),
+    ("帮我搜索一下最新的人工智能新闻", {"search_chat"}),
+    ("在B站和知乎上搜索机器学习教程", {"search_in_websites"}),
+    ("打开 https://www.python.org", {"launch_urls_in_browser"}),
+    ("打开百度和淘宝网站", {"open_popular_websites"}),
+    ("总结一下当前网页的内容", {"read_and_summary_webpage"}),
+    ("看看我屏幕上显示的是什么", {"identify_current_screen_save_img_and_get_response"}),
+    ("帮我写一个快速排序的代码", {"generate_code_from_prompt"}),
+    ("解释一下当前这段代码", {"explain_code"}),
+    ("讲解这段代码是做什么的", {"explain_code"}),
+    ("获取当前文本内容", {"get_text_content"}),
+    ("总结这个文件的重点内容", {"explain_file_content"}),
+    ("写一篇关于环保的文章", {"write_articles_and_reports"}),
+    ("帮我写一份工作周报", {"write_articles_and_reports"}),
+    ("用心流AI帮我解决这个问题", {"control_iflow_agent"}),
+    ("把这段Markdown转换成Word文档", {"markdown_to_word_server"}),
+    ("把表格转成Excel文件", {"markdown_to_excel_server"}),
+    ("把当前Word文档的标题加粗", {"change_word_file"}),
+    ("在当前Excel表格里求和第一列", {"change_excel_file"}),
+    ("读取这个PPT并总结", {"read_ppt"}),
+    ("读取PDF并翻译第一页", {"read_pdf"}),
+    ("在当前网页上点击登录按钮", {"control_web"}),
+    ("打开D盘的下载文件夹", {"open_folder"}),
+    ("打开微信", {"open_app"}),
+    ("打开网易云音乐", {"open_netease_music_server"}),
+    ("网易云音乐下一首", {"control_netease"}),
+    ("暂停音乐播放", {"control_netease"}),
+    ("启动手势识别", {"gesture_control"}),
+    ("关闭手势控制", {"stop_gesture_control"}),
+    ("看看剪切板里有什么", {"get_clipboard_content"}),
+    ("按一下快捷键截图", {"execute_system_shortcut"}),
+    ("在当前目录下新建三个文件夹", {"create_folders_in_active_directory"}),
+    ("新建一个 hello.txt 文件写入 hello world", {"create_or_write_file"}),
+    ("搜索天气预报然后写成报告", {"search_chat", "write_articles_and_reports"}),
+]
+
+
+if __name__ == '__main__':
+    import sys
+    from conversation_memory import count_tokens
+
+    tools = load_tools_from_source(os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"))
+    full_tokens = count_tokens(json.dumps(tools, ensure_ascii=False))
+    print(f"共{len(tools)}个工具，全部发送约 {full_tokens} token")
+
+    for top_k in ([int(sys.argv[1])] if len(sys.argv) > 1 else [3, 6, 10]):
+        index = ToolIndex(tools, top_k=top_k)
+        hits = total = 0
+        selected_tokens = []
+        misses = []
+        for query, expected in LABELED_REQUESTS:
+            selected = index.select(query)
+            names = {tool["function"]["name"] for tool in selected}
+            hits += len(expected & names)
+            total += len(expected)
+            selected_tokens.append(count_tokens(json.dumps(selected, ensure_ascii=False)))
+            misses.extend(f"{query} -> {name}" for name in expected - names)
+        average = sum(selected_tokens) / len(selected_tokens)
+        print(f"[top_k={top_k} + 常驻{len(index.always_on)}个] 召回率={hits / total:.1%} "
+              f"平均工具token={average:.0f}（节省{1 - average / full_tokens:.0%}）")
+        for miss in misses:
+            print(f"    未召回: {miss}")
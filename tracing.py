@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+请求链路的耗时追踪
+1. 每个 request_id 记录一棵 span 树：IPC接收、环境信息、视觉预处理、每次模型调用、每次MCP工具调用、
+   响应写出（socket或响应日志文件）以及悬浮球渲染
+2. 当前 span 放在 contextvars 中，asyncio.gather 创建的任务和 asyncio.to_thread 的线程自动继承父 span，
+   不需要在函数之间传递
+3. 默认只计时不落盘；设置 OPEN_ASSISTANT_TRACE=1 后每个 span 结束时写一行JSON到 data/trace.jsonl，
+   文件超过上限后自动轮转（保留若干个备份）。各模块的 __main__ 演示和压测因此不会往里混入记录
+4. python tracing.py [文件...] 汇总各阶段的 p50/p95/p99；--request <id> 打印单个请求的 span 树
+"""
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+import uuid
+
+TRACE_ENABLED = os.getenv("OPEN_ASSISTANT_TRACE", "0") == "1"
+TRACE_FILE = os.getenv("OPEN_ASSISTANT_TRACE_FILE", "data/trace.jsonl")
+# 单个文件的大小上限与保留的轮转备份数
+TRACE_MAX_BYTES = int(os.getenv("OPEN_ASSISTANT_TRACE_MAX_BYTES", str(5 * 1024 * 1024)))
+TRACE_BACKUP_COUNT = 3
+
+_current_span = contextvars.ContextVar("open_assistant_span", default=None)
+
+
+def _new_id():
+    return uuid.uuid4().hex[:16]
+
+
+class Span:
+    """一段计时区间；用作上下文管理器，退出时写出。attrs 可在区间内用 set() 补充"""
+
+    __slots__ = ("tracer", "name", "request_id", "span_id", "parent_id", "attrs", "start", "_t0", "_token")
+
+    def __init__(self, tracer, name, request_id, parent_id, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.request_id = request_id
+        self.span_id = _new_id()
+        self.parent_id = parent_id
+        self.attrs = attrs
+        self.start = None
+        self._t0 = None
+        self._token = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration_ms = (time.perf_counter() - self._t0) * 1000
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.tracer.emit(self.name, self.request_id, self.span_id, self.parent_id, self.start, duration_ms,
+                         self.attrs)
+        return False
+
+
+class Tracer:
+    """写出 span 记录；enabled=False 时 span 照常计时但不落盘"""
+
+    def __init__(self, path=TRACE_FILE, enabled=TRACE_ENABLED, max_bytes=TRACE_MAX_BYTES,
+                 backup_count=TRACE_BACKUP_COUNT):
+        self.path = path
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._handler = None
+        self._lock = threading.Lock()
+
+    def span(self, name, request_id=None, **attrs):
+        """子 span：父 span 与 request_id 取自当前上下文"""
+        parent = _current_span.get()
+        if request_id is None:
+            request_id = parent.request_id if parent is not None else ""
+        return Span(self, name, request_id, parent.span_id if parent is not None else None, attrs)
+
+    def request(self, request_id, **attrs):
+        """一个请求的根 span，之后在其中创建的 span 都挂在它下面"""
+        return Span(self, "request", request_id, None, attrs)
+
+    def record(self, name, start, duration_ms, request_id=None, **attrs):
+        """记录在别处测得的区间（如排队等待、UI渲染），挂在当前 span 下"""
+        parent = _current_span.get()
+        if request_id is None:
+            request_id = parent.request_id if parent is not None else ""
+        self.emit(name, request_id, _new_id(), parent.span_id if parent is not None else None, start,
+                  duration_ms, attrs)
+
+    def emit(self, name, request_id, span_id, parent_id, start, duration_ms, attrs):
+        if not self.enabled:
+            return
+        line = json.dumps({"request_id": request_id, "span_id": span_id, "parent_id": parent_id, "name": name,
+                           "start": round(start, 6), "duration_ms": round(duration_ms, 3), "attrs": attrs},
+                          ensure_ascii=False, default=str)
+        try:
+            handler = self._handler or self._open()
+            handler.emit(logging.makeLogRecord({"msg": line}))
+        except OSError as e:
+            print(f"[追踪] 写入{self.path}失败，停止记录: {e}")
+            self.enabled = False
+
+    def _open(self):
+        # 第一次写入时才创建文件，没有请求时不会在磁盘上留下空文件
+        with self._lock:
+            if self._handler is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                handler = logging.handlers.RotatingFileHandler(self.path, maxBytes=self.max_bytes,
+                                                               backupCount=self.backup_count, encoding="utf-8")
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                self._handler = handler
+        return self._handler
+
+    def close(self):
+        if self._handler is not None:
+            self._handler.close()
+            self._handler = None
+
+
+tracer = Tracer()
+
+
+def load_spans(paths):
+    """读取追踪文件（含轮转备份），跳过损坏的行"""
+    spans = []
+    for path in paths:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        spans.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except OSError:
+            continue
+    return spans
+
+
+def trace_files(path=TRACE_FILE, backup_count=TRACE_BACKUP_COUNT):
+    """当前文件与轮转备份，旧的在前"""
+    return [f"{path}.{i}" for i in range(backup_count, 0, -1)] + [path]
+
+
+def percentile(values, q):
+    """最近秩法的百分位数，values 需已排序"""
+    if not values:
+        return 0.0
+    rank = max(1, -(-len(values) * q // 100))
+    return values[int(rank) - 1]
+
+
+def stage_name(span):
+    # 工具调用按工具名分开统计，其余按 span 名称
+    if span["name"] == "mcp_tool" and span.get("attrs", {}).get("tool"):
+        return f"mcp_tool:{span['attrs']['tool']}"
+    return span["name"]
+
+
+def report(spans):
+    """各阶段的次数与 p50/p95/p99/max（毫秒），按p95降序"""
+    durations = {}
+    for span in spans:
+        durations.setdefault(stage_name(span), []).append(float(span.get("duration_ms", 0.0)))
+    rows = []
+    for name, values in durations.items():
+        values.sort()
+        rows.append((name, len(values), percentile(values, 50), percentile(values, 95), percentile(values, 99),
+                     values[-1]))
+    rows.sort(key=lambda row: row[3], reverse=True)
+    requests = {span.get("request_id") for span in spans if span.get("request_id")}
+    lines = [f"共 {len(requests)} 个请求，{len(spans)} 个span",
+             f"{'阶段':<28}{'次数':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}"]
+    for name, count, p50, p95, p99, maximum in rows:
+        lines.append(f"{name:<30}{count:>6}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}{maximum:>10.1f}")
+    return "\n".join(lines)
+
+
+def request_tree(spans, request_id):
+    """单个请求的 span 树，按开始时间排列，显示相对请求开始的偏移"""
+    own = [span for span in spans if span.get("request_id") == request_id]
+    if not own:
+        return f"没有 request_id={request_id} 的记录"
+    children = {}
+    ids = {span["span_id"] for span in own}
+    for span in sorted(own, key=lambda s: s["start"]):
+        parent = span.get("parent_id") if span.get("parent_id") in ids else None
+        children.setdefault(parent, []).append(span)
+    origin = min(span["start"] for span in own)
+    lines = []
+
+    def walk(parent, depth):
+        for span in children.get(parent, []):
+            attrs = " ".join(f"{key}={value}" for key, value in span.get("attrs", {}).items())
+            lines.append(f"{'  ' * depth}{span['name']:<{30 - 2 * depth}} +{(span['start'] - origin) * 1000:>8.1f}ms "
+                         f"{span['duration_ms']:>9.1f}ms  {attrs}")
+            walk(span["span_id"], depth + 1)
+
+    walk(None, 0)
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="汇总请求链路各阶段的耗时")
+    parser.add_argument("files", nargs="*", help=f"追踪文件，默认读取 {TRACE_FILE} 及其轮转备份")
+    parser.add_argument("--request", help="打印指定 request_id 的 span 树")
+    args = parser.parse_args()
+
+    all_spans = load_spans(args.files or trace_files())
+    if not all_spans:
+        print("没有追踪记录（运行时设置 OPEN_ASSISTANT_TRACE=1 才会记录）")
+        sys.exit(1)
+    if args.request:
+        print(request_tree(all_spans, args.request))
+    else:
+        print(report(all_spans))
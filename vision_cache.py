@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+视觉模型分析结果的缓存
+1. 用户围绕同一块截图连续追问时，每一轮都会把整张图重新发给视觉模型；这里按图片的感知哈希缓存分析结果
+2. 键 = 图片的 dHash（16x16，256位）+ 问题类别（表格、代码、文字、一般描述），
+   截图工具每次都写同一个文件名，因此按内容而不是路径识别图片
+3. 汉明距离不超过阈值、且宽高比相近的图片视为同一张（重新截图时的压缩噪声、光标闪烁等）；
+   不同文字内容的截图距离远大于阈值，不会误命中
+4. 条目数超过上限时淘汰最久未使用的（LRU），命中率和节省的视觉模型耗时会打印出来
+5. python vision_cache.py 会演示各种情况下的汉明距离和命中情况
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image
+
+VISION_CACHE_ENABLED = os.getenv("OPEN_ASSISTANT_VISION_CACHE", "1") == "1"
+VISION_CACHE_MAX_ENTRIES = 64
+# dHash 的边长（hash_size x hash_size 位）
+HASH_SIZE = 16
+# 视为同一张图的最大汉明距离（256位中）：重新编码约5位，不同文字内容的截图在90位以上
+MAX_HAMMING_DISTANCE = int(os.getenv("OPEN_ASSISTANT_VISION_CACHE_DISTANCE", "12"))
+# 宽高比的最大相对差
+MAX_ASPECT_DIFFERENCE = 0.02
+
+# 问题类别：视觉模型的描述会按问题侧重不同内容，类别不同的追问不复用结果
+PROMPT_CLASSES = [
+    ("table", ["表格", "excel", "数据", "图表", "统计"]),
+    ("code", ["代码", "程序", "报错", "错误", "bug", "函数"]),
+    ("text", ["文字", "翻译", "识别", "ocr", "提取", "原文"]),
+]
+
+
+def prompt_class(question):
+    text = (question or "").lower()
+    for name, keywords in PROMPT_CLASSES:
+        if any(keyword in text for keyword in keywords):
+            return name
+    return "describe"
+
+
+def dhash(image, hash_size=HASH_SIZE):
+    """差值哈希：缩小为灰度图，比较每行相邻像素的明暗，返回整数形式的位串"""
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+    pixels = gray.tobytes()
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return bits
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def image_fingerprint(path):
+    """返回 (dHash, 宽高比)"""
+    with Image.open(path) as image:
+        return dhash(image), image.size[0] / max(image.size[1], 1)
+
+
+class VisionCache:
+    """按 (图片指纹, 问题类别) 缓存视觉模型的分析文本"""
+
+    def __init__(self, max_entries=VISION_CACHE_MAX_ENTRIES, max_distance=MAX_HAMMING_DISTANCE):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self._entries = OrderedDict()  # (dHash, 宽高比, 类别) -> (分析结果, 视觉模型耗时ms)
+        self._lock = threading.Lock()
+        self.stats = {"hit": 0, "miss": 0, "saved_ms": 0.0}
+
+    def make_key(self, image_path, question=""):
+        image_hash, aspect = image_fingerprint(image_path)
+        return image_hash, aspect, prompt_class(question)
+
+    def get(self, key):
+        """返回缓存的分析结果，未命中时返回None"""
+        image_hash, aspect, category = key
+        with self._lock:
+            best, best_distance = None, self.max_distance + 1
+            for other in self._entries:
+                other_hash, other_aspect, other_category = other
+                if other_category != category or abs(other_aspect - aspect) > MAX_ASPECT_DIFFERENCE * aspect:
+                    continue
+                distance = hamming(image_hash, other_hash)
+                if distance < best_distance:
+                    best, best_distance = other, distance
+            if best is None:
+                self.stats["miss"] += 1
+                return None
+            self._entries.move_to_end(best)
+            analysis, elapsed_ms = self._entries[best]
+            self.stats["hit"] += 1
+            self.stats["saved_ms"] += elapsed_ms
+        print(f"[视觉缓存] 命中（汉明距离{best_distance}），跳过视觉模型，约节省{elapsed_ms:.0f}ms {self.summary()}")
+        return analysis
+
+    def put(self, key, analysis, elapsed_ms):
+        if not analysis:
+            return
+        with self._lock:
+            self._entries[key] = (analysis, elapsed_ms)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def summary(self):
+        lookups = self.stats["hit"] + self.stats["miss"]
+        hit_rate = self.stats["hit"] / lookups if lookups else 0.0
+        return (f"条目={len(self._entries)} 命中率={hit_rate:.0%}（{self.stats['hit']}/{lookups}） "
+                f"累计节省{self.stats['saved_ms'] / 1000:.1f}秒")
+
+
+if __name__ == '__main__':
+    import random
+    import tempfile
+    from PIL import ImageDraw
+
+    def make_shot(seed, cursor=False, size=(1200, 800)):
+        """模拟一块文字截图，seed 决定文字内容"""
+        random.seed(seed)
+        image = Image.new("RGB", size, (255, 255, 255))
+        draw = ImageDraw.Draw(image)
+        draw.rectangle([0, 0, size[0], 40], fill=(30, 30, 30))
+        for row in range(80, size[1] - 40, 30):
+            x = 40
+            while x < size[0] - 100:
+                width = random.randint(20, 90)
+                draw.rectangle([x, row, x + width, row + 12], fill=(40, 40, 40))
+                x += width + random.randint(8, 16)
+        if cursor:
+            draw.rectangle([600, 400, 602, 420], fill=(0, 0, 0))
+        return image
+
+    def save(image, name, **kwargs):
+        path = os.path.join(tempfile.mkdtemp(), name)
+        image.save(path, **kwargs)
+        return path
+
+    original = save(make_shot(1), "test2.png")
+    variants = {
+        "重新截图(光标闪烁)": save(make_shot(1, cursor=True), "test2.png"),
+        "JPEG q60重新编码": save(make_shot(1), "test2.jpg", quality=60),
+        "同一窗口的另一段文字": save(make_shot(2), "test2.png"),
+        "宽高不同的截图": save(make_shot(1, size=(1200, 600)), "test2.png"),
+    }
+    base_hash, _ = image_fingerprint(original)
+    for label, path in variants.items():
+        print(f"[{label}] 汉明距离={hamming(base_hash, image_fingerprint(path)[0])}")
+
+    cache = VisionCache()
+    vision_ms = 2300  # 视觉模型一次调用的典型耗时
+    questions = [("这张图里写了什么", original), ("把图中的文字翻译成英文", original),
+                 ("图里主要讲了什么", variants["重新截图(光标闪烁)"]), ("总结一下这张图", variants["JPEG q60重新编码"]),
+                 ("这段讲了什么", variants["同一窗口的另一段文字"]), ("帮我描述一下", variants["宽高不同的截图"])]
+    for question, path in questions:
+        start = time.perf_counter()
+        key = cache.make_key(path, question)
+        hit = cache.get(key) is not None
+        lookup_ms = (time.perf_counter() - start) * 1000
+        if not hit:
+            cache.put(key, f"（{question} 的分析结果）", vision_ms)
+        print(f"  {question} [{key[2]}] -> {'命中' if hit else '调用视觉模型'}（查找{lookup_ms:.1f}ms）")
+    print(cache.summary())